@@ -0,0 +1,313 @@
+import os
+import re
+import json
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import llm
+import metrics
+from context_builder import count_tokens, split_into_chunks
+
+# Размер фрагмента для map-шага в токенах
+ANALYSIS_CHUNK_TOKENS = int(os.getenv("ANALYSIS_CHUNK_TOKENS", "1500"))
+# Сколько запросов к LLM выполняется одновременно
+ANALYSIS_CONCURRENCY = int(os.getenv("ANALYSIS_CONCURRENCY", "4"))
+# Сколько частичных результатов объединяется одним reduce-запросом
+ANALYSIS_REDUCE_FANOUT = int(os.getenv("ANALYSIS_REDUCE_FANOUT", "8"))
+# Кэш результатов по хешу фрагмента
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "2048"))
+# Ограничение длины списков в итоговом анализе
+ANALYSIS_MAX_ITEMS = 8
+
+# Версия промптов входит в ключ кэша: после их изменения старые результаты не используются
+PROMPT_VERSION = "1"
+FIELDS = ("key_points", "risks", "recommendations")
+
+# Заголовки структурных разделов: статьи, главы, разделы, нумерованные пункты верхнего уровня
+HEADING_RE = re.compile(
+    r"^\s*(?:(?:статья|глава|раздел|часть|article|section|chapter)\s+[\dIVXLC]+|\d{1,3}\.\s+\S|[IVXLC]{1,6}\.\s+\S)",
+    re.IGNORECASE | re.MULTILINE,
+)
+PARAGRAPH_RE = re.compile(r"\n\s*\n")
+SENTENCE_RE = re.compile(r"[^.!?\n]+[.!?]?")
+
+FOCUS = {
+    "general": "ключевые положения документа",
+    "legal": "правовые основания, юрисдикцию, порядок разрешения споров и обязательства сторон",
+    "risks": "риски для сторон, неясные или односторонние условия и рекомендации по их устранению",
+}
+
+MAP_PROMPT = (
+    "Ты юрист-аналитик. Проанализируй фрагмент документа, обращая внимание на {focus}. "
+    "Верни JSON-объект с полями summary (1-2 предложения), key_points, risks, recommendations "
+    "(списки коротких строк). Используй только то, что есть во фрагменте."
+)
+REDUCE_PROMPT = (
+    "Ты юрист-аналитик. Ниже частичные анализы фрагментов одного документа в формате JSON. "
+    "Объедини их в один анализ, обращая внимание на {focus}: убери повторы, оставь главное. "
+    "Верни JSON-объект с полями summary, key_points, risks, recommendations."
+)
+
+# Правила локального анализа без LLM: (маркер в тексте, ключевой момент, риск, рекомендация)
+KEYWORD_RULES = [
+    (("gdpr", "персональн"), "Содержит положения о персональных данных",
+     "Требуется проверка на соответствие GDPR", "Провести комплаенс-чек по GDPR"),
+    (("неконкурен", "non-compete"), "Содержит положения о неконкуренции",
+     "Требуется проверка положений о неконкуренции на соответствие законодательству", None),
+    (("конфиденциальн",), "Присутствуют положения о конфиденциальности", None, None),
+    (("неустойк", "штраф", "пени"), "Предусмотрены штрафные санкции",
+     "Размер санкций может быть несоразмерным", "Проверить размер и основания неустойки"),
+    (("в одностороннем порядке",), "Предусмотрено одностороннее изменение или расторжение",
+     "Одна из сторон может изменить условия в одностороннем порядке", "Ограничить основания одностороннего изменения условий"),
+    (("оплат", "стоимост"), "Указаны условия оплаты", None, None),
+    (("срок",), "Указаны сроки исполнения", None, None),
+    (("арбитраж", "подсудн", "спор"), "Указан порядок разрешения споров", None, None),
+]
+OBLIGATION_MARKERS = ("обязуется", "обязан", "вправе", "должен", "shall", "must")
+
+_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _is_anchor(piece: str, tokens: int, target_tokens: int) -> bool:
+    """Закрывает ли раздел фрагмент: решение зависит только от содержимого раздела
+
+    Вероятность пропорциональна доле раздела в целевом размере, поэтому фрагменты
+    в среднем получаются около target_tokens при любой длине разделов.
+    """
+    digest = int.from_bytes(hashlib.sha256(piece.encode("utf-8", errors="surrogatepass")).digest()[:8], "big")
+    return digest < (1 << 64) * min(1.0, tokens / max(1, target_tokens))
+
+
+def split_structural(text: str, max_tokens: int = ANALYSIS_CHUNK_TOKENS) -> List[str]:
+    """Разбиение по структуре документа: разделы по заголовкам, затем абзацы
+
+    Слишком длинный раздел делится по абзацам, а абзац - по размеру. Соседние разделы
+    склеиваются во фрагменты, границы которых определяются содержимым (как в
+    content-defined chunking): фрагмент закрывается после раздела-якоря, выбранного
+    по хешу самого раздела, или при достижении max_tokens. Правка раздела меняет
+    его фрагмент и, возможно, соседний; дальше границы совпадают со следующего якоря,
+    и остальные фрагменты берутся из кэша.
+    """
+    starts = [match.start() for match in HEADING_RE.finditer(text)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+    sections = [text[start:end] for start, end in zip(starts, starts[1:] + [len(text)])]
+
+    pieces: List[str] = []
+    for section in sections:
+        if count_tokens(section) <= max_tokens:
+            pieces.append(section)
+            continue
+        for paragraph in PARAGRAPH_RE.split(section):
+            if count_tokens(paragraph) <= max_tokens:
+                pieces.append(paragraph)
+            else:
+                # Примерно 4 символа на токен
+                pieces.extend(chunk["text"] for chunk in split_into_chunks(paragraph, max_tokens * 4))
+
+    # Запас до max_tokens: принудительные границы по размеру (сдвигающие соседние фрагменты) редки
+    target_tokens = max_tokens * 3 // 4
+    chunks: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+    for piece in pieces:
+        piece = piece.strip()
+        if not piece:
+            continue
+        tokens = count_tokens(piece)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += tokens
+        if _is_anchor(piece, tokens, target_tokens):
+            chunks.append("\n\n".join(current))
+            current, current_tokens = [], 0
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def _cache_key(kind: str, analysis_type: str, text: str) -> str:
+    digest = hashlib.sha256(f"{PROMPT_VERSION}\0{kind}\0{analysis_type}\0".encode("utf-8"))
+    digest.update(text.encode("utf-8", errors="surrogatepass"))
+    return digest.hexdigest()
+
+
+def _cache_get(key: str) -> Optional[Dict[str, Any]]:
+    with _cache_lock:
+        result = _cache.get(key)
+        if result is not None:
+            _cache.move_to_end(key)
+        return result
+
+
+def _cache_put(key: str, result: Dict[str, Any]):
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > ANALYSIS_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _normalize(data: Any) -> Dict[str, Any]:
+    """Приведение ответа модели к {summary, key_points, risks, recommendations}"""
+    if not isinstance(data, dict):
+        raise ValueError("Ответ модели не является JSON-объектом")
+    result = {"summary": str(data.get("summary") or "").strip()}
+    for field in FIELDS:
+        items = data.get(field) or []
+        if isinstance(items, str):
+            items = [items]
+        result[field] = [str(item).strip() for item in items if str(item).strip()]
+    return result
+
+
+def _merge(parts: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Объединение частичных результатов без LLM: склейка сводок и списков без повторов"""
+    merged: Dict[str, Any] = {"summary": " ".join(part["summary"] for part in parts if part["summary"])}
+    for field in FIELDS:
+        seen = set()
+        items = []
+        for part in parts:
+            for item in part[field]:
+                key = " ".join(item.lower().split())
+                if key not in seen:
+                    seen.add(key)
+                    items.append(item)
+        merged[field] = items
+    return merged
+
+
+def local_extract(text: str, analysis_type: str) -> Dict[str, Any]:
+    """Анализ фрагмента без LLM: правила по ключевым словам и положения с обязательствами"""
+    text_lower = text.lower()
+    result: Dict[str, Any] = {"summary": "", "key_points": [], "risks": [], "recommendations": []}
+    for markers, key_point, risk, recommendation in KEYWORD_RULES:
+        if any(marker in text_lower for marker in markers):
+            result["key_points"].append(key_point)
+            if analysis_type == "risks":
+                if risk:
+                    result["risks"].append(risk)
+                if recommendation:
+                    result["recommendations"].append(recommendation)
+
+    obligations = [
+        sentence.strip() for sentence in SENTENCE_RE.findall(text)
+        if any(marker in sentence.lower() for marker in OBLIGATION_MARKERS)
+    ]
+    result["key_points"].extend(sentence[:200] for sentence in obligations[:2])
+    first = next((s.strip() for s in SENTENCE_RE.findall(text) if len(s.strip()) > 20), "")
+    result["summary"] = first[:300]
+    return result
+
+
+async def _map_chunk(chunk: str, analysis_type: str, semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+    """Извлечение из одного фрагмента (результат кэшируется по хешу фрагмента)"""
+    key = _cache_key("map", analysis_type, chunk)
+    cached = _cache_get(key)
+    metrics.cache_lookup("analysis_map", cached is not None)
+    if cached is not None:
+        return {**cached, "cached": True}
+
+    result = None
+    if llm.is_available():
+        messages = [
+            {"role": "system", "content": MAP_PROMPT.format(focus=FOCUS.get(analysis_type, FOCUS["general"]))},
+            {"role": "user", "content": chunk},
+        ]
+        try:
+            async with semaphore:
+                content = await llm.chat_completion(messages, temperature=0.1, max_tokens=600, json_mode=True)
+            result = _normalize(json.loads(content))
+        except Exception as e:
+            logging.warning(f"Анализ фрагмента через LLM не удался, используется локальный: {e}")
+    if result is None:
+        metrics.fallback("analysis_map")
+        result = local_extract(chunk, analysis_type)
+    else:
+        # Кэшируем только ответы модели: локальный анализ дешев, а при появлении LLM его стоит заменить
+        _cache_put(key, result)
+    return {**result, "cached": False}
+
+
+async def _reduce(parts: List[Dict[str, Any]], analysis_type: str, semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+    """Иерархическое объединение: группы по ANALYSIS_REDUCE_FANOUT, пока не останется один результат"""
+    parts = [{"summary": part["summary"], **{field: part[field] for field in FIELDS}} for part in parts]
+    if not llm.is_available():
+        return _merge(parts)
+
+    async def reduce_group(group: List[Dict[str, Any]]) -> Dict[str, Any]:
+        payload = json.dumps(group, ensure_ascii=False)
+        key = _cache_key("reduce", analysis_type, payload)
+        cached = _cache_get(key)
+        metrics.cache_lookup("analysis_reduce", cached is not None)
+        if cached is not None:
+            return cached
+        messages = [
+            {"role": "system", "content": REDUCE_PROMPT.format(focus=FOCUS.get(analysis_type, FOCUS["general"]))},
+            {"role": "user", "content": payload},
+        ]
+        try:
+            async with semaphore:
+                content = await llm.chat_completion(messages, temperature=0.1, max_tokens=1000, json_mode=True)
+            result = _normalize(json.loads(content))
+        except Exception as e:
+            logging.warning(f"Объединение через LLM не удалось, используется локальное: {e}")
+            metrics.fallback("analysis_reduce")
+            return _merge(group)
+        _cache_put(key, result)
+        return result
+
+    while len(parts) > 1:
+        groups = [parts[i:i + ANALYSIS_REDUCE_FANOUT] for i in range(0, len(parts), ANALYSIS_REDUCE_FANOUT)]
+        parts = await asyncio.gather(*(reduce_group(group) for group in groups))
+    return parts[0]
+
+
+async def analyze(text: str, analysis_type: str = "general", progress: Optional[Callable[[float, str], None]] = None) -> Dict[str, Any]:
+    """Map-reduce анализ документа: summary, key_points, risks, recommendations
+
+    Фрагменты обрабатываются параллельно (не более ANALYSIS_CONCURRENCY запросов к LLM),
+    при повторном анализе после правок пересчитываются только измененные фрагменты.
+    """
+    chunks = split_structural(text)
+    if not chunks:
+        return {"summary": "Документ пуст.", "key_points": [], "risks": [], "recommendations": [],
+                "chunks": 0, "cached_chunks": 0}
+
+    semaphore = asyncio.Semaphore(ANALYSIS_CONCURRENCY)
+    done = 0
+
+    async def map_one(chunk: str) -> Dict[str, Any]:
+        nonlocal done
+        result = await _map_chunk(chunk, analysis_type, semaphore)
+        done += 1
+        if progress:
+            progress(0.9 * done / len(chunks), f"map {done}/{len(chunks)}")
+        return result
+
+    parts = await asyncio.gather(*(map_one(chunk) for chunk in chunks))
+    cached_chunks = sum(1 for part in parts if part["cached"])
+    if progress:
+        progress(0.9, "reduce")
+    result = await _reduce(parts, analysis_type, semaphore)
+
+    words = len(text.split())
+    summary = result["summary"] or f"Документ содержит примерно {words} слов и относится к юридической документации."
+    analysis = {
+        "summary": summary,
+        "key_points": result["key_points"][:ANALYSIS_MAX_ITEMS],
+        "risks": result["risks"][:ANALYSIS_MAX_ITEMS],
+        "recommendations": result["recommendations"][:ANALYSIS_MAX_ITEMS],
+        "chunks": len(chunks),
+        "cached_chunks": cached_chunks,
+    }
+    if not llm.is_available():
+        # Без LLM сводка склеена из первых предложений фрагментов - даем короткую
+        analysis["summary"] = f"Документ содержит примерно {words} слов и относится к юридической документации. {parts[0]['summary']}".strip()
+    return analysis
@@ -0,0 +1,104 @@
+"""Бенчмарк сравнения договоров: diff_engine против difflib.ndiff
+
+Запуск: python bench_compare.py [--pages 1000] [--ndiff-pages 20]
+"""
+import argparse
+import difflib
+import random
+import time
+
+import diff_engine
+
+LINES_PER_PAGE = 45
+
+WORDS = [
+    "сторона", "договор", "исполнитель", "заказчик", "обязуется", "оплата", "срок", "поставка",
+    "ответственность", "неустойка", "расторжение", "уведомление", "конфиденциальность", "акт",
+    "услуги", "работы", "приемка", "гарантия", "претензия", "спор", "арбитраж", "сумма", "рублей",
+]
+
+
+def make_contract(pages: int, rng: random.Random) -> list:
+    """Синтетический договор: нумерованные пункты по LINES_PER_PAGE строк на страницу"""
+    lines = []
+    for n in range(pages * LINES_PER_PAGE):
+        if n % 15 == 0:
+            lines.append(f"Статья {n // 15 + 1}. {rng.choice(WORDS).capitalize()}")
+        elif n % 7 == 0:
+            lines.append("")
+        else:
+            body = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 14)))
+            lines.append(f"{n // 15 + 1}.{n % 15}. {body.capitalize()}.")
+    return lines
+
+
+def edit_contract(lines: list, rng: random.Random) -> list:
+    """Типичная редакция: правки ~1% строк, вставки, удаления и перенос нескольких пунктов"""
+    result = list(lines)
+    edits = max(1, len(result) // 100)
+    for _ in range(edits):
+        i = rng.randrange(len(result))
+        words = result[i].split(" ")
+        if len(words) > 3:
+            words[rng.randrange(1, len(words))] = rng.choice(WORDS)
+            result[i] = " ".join(words)
+    for _ in range(edits // 4):
+        result.insert(rng.randrange(len(result)), "Дополнительно: " + " ".join(rng.choice(WORDS) for _ in range(10)))
+    for _ in range(edits // 4):
+        del result[rng.randrange(len(result))]
+    for _ in range(5):
+        start = rng.randrange(len(result) - 10)
+        block = result[start:start + 5]
+        del result[start:start + 5]
+        target = rng.randrange(len(result))
+        result[target:target] = block
+    return result
+
+
+def run_engine(doc_a: str, doc_b: str) -> dict:
+    started = time.perf_counter()
+    result = diff_engine.compare_texts(doc_a, doc_b)
+    elapsed = time.perf_counter() - started
+    # Пословные различия считаются лениво - учитываем их стоимость для всех записей
+    started = time.perf_counter()
+    entries = sum(len(hunk["lines"]) for hunk in diff_engine.iter_hunks(result))
+    render = time.perf_counter() - started
+    return {"diff": elapsed, "render": render, "entries": entries, "hunks": len(result["hunks"]), "added": result["added"], "removed": result["removed"], "moved": result["moved"]}
+
+
+def run_ndiff(doc_a: str, doc_b: str) -> float:
+    started = time.perf_counter()
+    for _ in difflib.ndiff(doc_a.splitlines(), doc_b.splitlines()):
+        pass
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк сравнения документов")
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--ndiff-pages", type=int, default=20, help="размер для сравнения с difflib.ndiff (0 - пропустить)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    lines = make_contract(args.pages, rng)
+    doc_a = "\n".join(lines)
+    doc_b = "\n".join(edit_contract(lines, rng))
+    print(f"📄 Договор: {args.pages} страниц, {len(lines)} строк, {len(doc_a) // 1024} КБ")
+
+    stats = run_engine(doc_a, doc_b)
+    print(f"⚡ diff_engine: {stats['diff']:.3f} c сравнение, {stats['render']:.3f} c выдача {stats['hunks']} блоков / {stats['entries']} строк")
+    print(f"   +{stats['added']} / -{stats['removed']}, перемещено строк: {stats['moved']}")
+
+    if args.ndiff_pages:
+        small = make_contract(args.ndiff_pages, rng)
+        small_a = "\n".join(small)
+        small_b = "\n".join(edit_contract(small, rng))
+        ndiff_time = run_ndiff(small_a, small_b)
+        engine_time = run_engine(small_a, small_b)
+        print(f"🐢 difflib.ndiff на {args.ndiff_pages} страницах: {ndiff_time:.3f} c "
+              f"(diff_engine: {engine_time['diff'] + engine_time['render']:.3f} c)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""Микробенчмарки CPU-путей: чанкинг и эмбеддинги, пакетное кодирование запросов, векторный поиск, diff,
+проверка соответствия, заголовок чата, сохранение и чтение больших чатов
+
+Запуск: python bench_cpu.py [--profile quick|full] [--only compare] [--output bench.json]
+        python bench_cpu.py --write-thresholds  # пересчитать bench_thresholds.json на этой машине
+
+Работает офлайн: эмбеддинги - локальная заглушка (EMBEDDING_BACKEND=stub), база - во временном каталоге.
+Медиана времени сравнивается с порогом из bench_thresholds.json; при превышении код выхода 1.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import statistics
+import tempfile
+from typing import Any, Callable, Dict, List, Tuple
+
+os.environ.setdefault("EMBEDDING_BACKEND", "stub")
+os.environ.setdefault("LLM_BACKEND", "stub")
+os.environ.setdefault("TRACING_ENABLED", "0")
+
+import numpy as np
+
+import database
+import embeddings
+import embedding_service
+import rag_indexer
+import context_builder
+import diff_engine
+import compliance
+from bench_compare import WORDS, make_contract, edit_contract
+
+THRESHOLDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_thresholds.json")
+# Запас при --write-thresholds: порог = медиана * THRESHOLD_FACTOR, но не меньше THRESHOLD_MIN_S
+THRESHOLD_FACTOR = 3.0
+THRESHOLD_MIN_S = 0.001
+
+KB = 1024
+MB = 1024 * KB
+DOCUMENT_SIZES = {"quick": [KB, 100 * KB, MB], "full": [KB, 100 * KB, MB, 10 * MB]}
+VECTOR_COUNTS = {"quick": [1000, 10_000, 100_000], "full": [1000, 10_000, 100_000, 1_000_000]}
+CHAT_MESSAGES = {"quick": [10, 1000], "full": [10, 1000, 10_000]}
+CONCURRENT_QUERIES = {"quick": [64], "full": [64, 512]}
+# Стоимость вызова модели в бенчмарке пакетов: постоянная часть и добавка за текст (секунды)
+ENCODE_CALL_COST_S = 0.002
+ENCODE_TEXT_COST_S = 0.0001
+
+COMPLIANCE_PHRASES = [
+    "Оператор обрабатывает персональные данные субъекта с его согласия.",
+    "Субъект вправе отозвать согласие и потребовать удаления данных.",
+    "Данные передаются третьим лицам только по договору поручения.",
+    "Исполнитель обязуется соблюдать конфиденциальность.",
+]
+
+
+def size_label(size: int) -> str:
+    return f"{size // MB}MB" if size >= MB else f"{size // KB}KB"
+
+
+def count_label(count: int) -> str:
+    return f"{count // 1_000_000}M" if count >= 1_000_000 else f"{count // 1000}k" if count >= 1000 else str(count)
+
+
+def make_document(size: int, seed: int = 42) -> str:
+    """Синтетический договор заданного размера в байтах UTF-8 (с абзацами и терминами комплаенса)"""
+    rng = random.Random(seed)
+    parts = []
+    total = 0
+    while total < size:
+        lines = make_contract(5, rng)
+        lines.insert(rng.randrange(len(lines)), rng.choice(COMPLIANCE_PHRASES))
+        block = "\n".join(lines) + "\n\n"
+        parts.append(block)
+        total += len(block.encode("utf-8"))
+    text = "".join(parts)
+    return text.encode("utf-8")[:size].decode("utf-8", errors="ignore")
+
+
+# Бенчмарки: функция(profile) -> [(имя, подготовленный вызов, объем работы, единица объема)]
+Case = Tuple[str, Callable[[], Any], float, str]
+
+
+def bench_chunking(profile: str) -> List[Case]:
+    cases = []
+    for size in DOCUMENT_SIZES[profile]:
+        text = make_document(size)
+        cases.append((f"chunking/{size_label(size)}", lambda text=text: sum(1 for _ in rag_indexer.iter_chunks(text)), size / MB, "MB"))
+    return cases
+
+
+def bench_embedding(profile: str) -> List[Case]:
+    cases = []
+    for size in DOCUMENT_SIZES[profile][:3]:
+        chunks = [chunk for _, chunk in rag_indexer.iter_chunks(make_document(size)) if len(chunk.strip()) >= 50]
+        cases.append((f"embedding/{size_label(size)}", lambda chunks=chunks: embeddings.encode(chunks), len(chunks), "chunks"))
+    return cases
+
+
+class FixedCostEncoder:
+    """Кодировщик с постоянной стоимостью вызова: выигрыш пакетов не зависит от наличия модели"""
+
+    def __init__(self):
+        self.calls = 0
+        self.texts = 0
+        self.max_batch = 0
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        self.calls += 1
+        self.texts += len(texts)
+        self.max_batch = max(self.max_batch, len(texts))
+        time.sleep(ENCODE_CALL_COST_S + ENCODE_TEXT_COST_S * len(texts))
+        return np.full((len(texts), embeddings.STUB_DIMENSION), embeddings.STUB_DIMENSION ** -0.5, dtype=np.float32)
+
+
+def bench_embedding_service(profile: str) -> List[Case]:
+    """EmbeddingService под одновременными запросами: без пакетов, пакеты, повторы в пакете, LRU-кеш"""
+    cases = []
+    for count in CONCURRENT_QUERIES[profile]:
+        variants = [
+            # (имя, max_batch, cache_size, запросы раунда): без кеша каждый раунд кодируется заново
+            ("serial", 1, 0, lambda count=count: [f"запрос {index}" for index in range(count)]),
+            ("batched", embedding_service.EMBEDDING_BATCH_MAX_SIZE, 0, lambda count=count: [f"запрос {index}" for index in range(count)]),
+            ("duplicates", embedding_service.EMBEDDING_BATCH_MAX_SIZE, 0, lambda count=count: [f"запрос {index % 8}" for index in range(count)]),
+            ("cached", embedding_service.EMBEDDING_BATCH_MAX_SIZE, count, lambda count=count: [f"запрос {index}" for index in range(count)]),
+        ]
+        for variant, max_batch, cache_size, queries in variants:
+            service = embedding_service.EmbeddingService(max_batch=max_batch, cache_size=cache_size, encode=FixedCostEncoder())
+
+            def run(service=service, queries=queries):
+                futures = [service.submit(text) for text in queries()]
+                return [future.result() for future in futures]
+            cases.append((f"embedding_service/{variant}_{count_label(count)}", run, count, "queries"))
+    return cases
+
+
+def bench_vector_search(profile: str) -> List[Case]:
+    """Поиск top-k по матрице эмбеддингов (как в context_builder/whatif) на 1k-1M чанков"""
+    rng = np.random.default_rng(42)
+    cases = []
+    for count in VECTOR_COUNTS[profile]:
+        vectors = rng.standard_normal((count, embeddings.STUB_DIMENSION), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        query = vectors[count // 2]
+
+        def search(vectors=vectors, query=query):
+            scores = vectors @ query
+            top = np.argpartition(-scores, 10)[:10]
+            return top[np.argsort(-scores[top])]
+        cases.append((f"vector_search/{count_label(count)}", search, count, "vectors"))
+    return cases
+
+
+def bench_build_context(profile: str) -> List[Case]:
+    """Отбор контекста по документу с уже построенным индексом (кеш context_builder)"""
+    cases = []
+    for size in DOCUMENT_SIZES[profile]:
+        documents = [{"id": "bench", "name": "contract.txt", "content": make_document(size)}]
+        context_builder.build_context("ответственность сторон за просрочку оплаты", documents)  # Прогрев индекса
+        cases.append((f"build_context/{size_label(size)}", lambda documents=documents: context_builder.build_context("неустойка за просрочку", documents), size / MB, "MB"))
+    return cases
+
+
+def bench_compare(profile: str) -> List[Case]:
+    """compare_documents: diff и первая страница блоков, как в /api/compare"""
+    cases = []
+    for size in DOCUMENT_SIZES[profile]:
+        lines = make_document(size).split("\n")
+        doc_a = "\n".join(lines)
+        # Маленький документ: правка одной строки вместо типичной редакции
+        edited = edit_contract(lines, random.Random(7)) if len(lines) > 20 else lines[:-1] + [lines[-1] + " изменено"]
+        doc_b = "\n".join(edited)
+
+        def compare(doc_a=doc_a, doc_b=doc_b):
+            result = diff_engine.compare_texts(doc_a, doc_b)
+            return list(diff_engine.iter_hunks(result, 0, 50))
+        cases.append((f"compare/{size_label(size)}", compare, size / MB, "MB"))
+    return cases
+
+
+def bench_compliance(profile: str) -> List[Case]:
+    """check_compliance: полный скан и инкрементальная проверка после правки одного абзаца"""
+    cases = []
+    for size in DOCUMENT_SIZES[profile]:
+        text = make_document(size)
+        cases.append((f"compliance/{size_label(size)}", lambda text=text: compliance.check(text, ["GDPR"]), size / MB, "MB"))
+        compliance.check_incremental(text, ["GDPR"])
+        edited = text.replace(WORDS[0], WORDS[1], 1)
+        cases.append((f"compliance_incremental/{size_label(size)}", lambda edited=edited: compliance.check_incremental(edited, ["GDPR"]), size / MB, "MB"))
+    return cases
+
+
+def bench_chat_title(profile: str) -> List[Case]:
+    from main import generate_chat_title
+
+    rng = random.Random(42)
+    messages = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 60))) + rng.choice([".", "?", ""]) for _ in range(1000)]
+
+    def titles():
+        for message in messages:
+            generate_chat_title(message)
+    return [("chat_title/1k", titles, len(messages), "titles")]
+
+
+def bench_database(profile: str) -> List[Case]:
+    """database.save_chat / get_user_chats на больших чатах (база во временном каталоге)"""
+    rng = random.Random(42)
+    user = database.register_user("bench", f"bench-{time.time_ns()}@example.com", "benchmark")
+    user_id = user["user_id"]
+    cases = []
+    for count in CHAT_MESSAGES[profile]:
+        messages = [
+            {"role": "user" if i % 2 == 0 else "assistant",
+             "content": " ".join(rng.choice(WORDS) for _ in range(40)),
+             "timestamp": "2025-01-01T00:00:00"}
+            for i in range(count)
+        ]
+        chat_id = f"bench_{count}"
+        cases.append((f"save_chat/{count_label(count)}msg", lambda chat_id=chat_id, messages=messages: database.save_chat(user_id, chat_id, "Бенчмарк", messages), count, "messages"))
+        database.save_chat(user_id, chat_id, "Бенчмарк", messages)
+    # Список чатов пользователя: 50 чатов по наибольшему размеру
+    largest = CHAT_MESSAGES[profile][-1]
+    for i in range(50):
+        database.save_chat(user_id, f"bench_list_{i}", "Бенчмарк", [{"role": "user", "content": "x" * 200, "timestamp": ""}] * largest)
+    cases.append((f"get_user_chats/50x{count_label(largest)}msg", lambda: database.get_user_chats(user_id), 50, "chats"))
+    return cases
+
+
+BENCHMARKS: Dict[str, Callable[[str], List[Case]]] = {
+    "chunking": bench_chunking,
+    "embedding": bench_embedding,
+    "embedding_service": bench_embedding_service,
+    "vector_search": bench_vector_search,
+    "build_context": bench_build_context,
+    "compare": bench_compare,
+    "compliance": bench_compliance,
+    "chat_title": bench_chat_title,
+    "database": bench_database,
+}
+
+
+def measure(func: Callable[[], Any], min_repeats: int, min_time: float) -> List[float]:
+    """Повторы до min_repeats и не меньше min_time секунд суммарно (после одного прогрева)"""
+    func()
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < min_repeats or (time.perf_counter() - started < min_time and len(timings) < 1000):
+        t0 = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - t0)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки CPU-путей")
+    parser.add_argument("--profile", choices=["quick", "full"], default="quick", help="full добавляет документы 10 МБ и 1M векторов")
+    parser.add_argument("--only", action="append", choices=list(BENCHMARKS), help="запустить только указанные группы")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--min-time", type=float, default=0.5, help="минимальное суммарное время замеров одного случая (с)")
+    parser.add_argument("--output", help="путь JSON-отчета")
+    parser.add_argument("--thresholds", default=THRESHOLDS_PATH)
+    parser.add_argument("--write-thresholds", action="store_true", help="записать пороги = медиана * %.0f" % THRESHOLD_FACTOR)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench_cpu_") as tmp:
+        database.DB_PATH = os.path.join(tmp, "bench_users.db")
+        database.init_db()
+
+        thresholds = {}
+        if os.path.exists(args.thresholds) and not args.write_thresholds:
+            with open(args.thresholds, "r", encoding="utf-8") as f:
+                thresholds = json.load(f)
+
+        results = []
+        regressions = []
+        for group in args.only or BENCHMARKS:
+            for name, func, amount, unit in BENCHMARKS[group](args.profile):
+                timings = measure(func, args.repeats, args.min_time)
+                median = statistics.median(timings)
+                threshold = thresholds.get(name)
+                status = "ok" if threshold is None or median <= threshold else "REGRESSION"
+                results.append({
+                    "name": name,
+                    "median_s": round(median, 6),
+                    "min_s": round(min(timings), 6),
+                    "runs": len(timings),
+                    "throughput": round(amount / median, 2) if median else None,
+                    "unit": f"{unit}/s",
+                    "threshold_s": threshold,
+                    "status": status,
+                })
+                if status != "ok":
+                    regressions.append(name)
+                marker = "❌" if status != "ok" else "✓"
+                limit = f" (порог {threshold:.4f}s)" if threshold is not None else ""
+                print(f"{marker} {name:<36} {median * 1000:>10.2f} мс  {amount / median:>14,.1f} {unit}/s{limit}")
+
+    if args.write_thresholds:
+        updated = {}
+        if os.path.exists(args.thresholds):
+            with open(args.thresholds, "r", encoding="utf-8") as f:
+                updated = json.load(f)
+        for result in results:
+            updated[result["name"]] = round(max(result["median_s"] * THRESHOLD_FACTOR, THRESHOLD_MIN_S), 6)
+        with open(args.thresholds, "w", encoding="utf-8") as f:
+            json.dump(dict(sorted(updated.items())), f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"📄 Пороги записаны: {args.thresholds}")
+
+    if args.output:
+        report = {
+            "profile": args.profile,
+            "environment": {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(), "cpus": os.cpu_count(),
+                            "embedding_backend": embeddings.EMBEDDING_BACKEND, "ahocorasick": compliance._pyahocorasick is not None},
+            "results": results,
+            "regressions": regressions,
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"📄 Отчет: {args.output}")
+
+    if regressions:
+        print(f"❌ Превышены пороги: {', '.join(regressions)}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
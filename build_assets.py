@@ -0,0 +1,126 @@
+"""Сборка интерфейса: вынос встроенных CSS/JS из templates/new.html в ассеты с хешем в имени
+
+Запуск: python build_assets.py [--output static/dist] [--inline-max-bytes 4096]
+
+Крупные блоки <style>/<script> заменяются ссылками на /assets/app.<hash>.css|js на том же
+месте страницы (порядок выполнения скриптов не меняется), мелкие остаются встроенными.
+Для страницы и ассетов пишутся предсжатые варианты .gz и .br (brotli - если установлен
+пакет brotli). Сервер (delivery.py) отдает их по Accept-Encoding с сильными ETag.
+"""
+import os
+import re
+import gzip
+import json
+import hashlib
+import argparse
+from typing import Dict, List, Tuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SOURCE_HTML = "templates/new.html"
+# Каталог сборки (должен совпадать с ASSETS_DIR сервера)
+ASSETS_DIR = os.getenv("ASSETS_DIR", "static/dist")
+# Блоки меньше этого размера остаются встроенными: отдельный запрос дороже
+ASSET_INLINE_MAX_BYTES = int(os.getenv("ASSET_INLINE_MAX_BYTES", "4096"))
+ASSETS_URL = "/assets"
+
+# Только блоки без атрибутов: <script src=...> и <script type=module> не трогаем
+BLOCK_RE = re.compile(r"<(style|script)>(.*?)</\1>", re.S)
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def extract(html: str, inline_max_bytes: int) -> Tuple[str, Dict[str, bytes]]:
+    """Страница со ссылками на ассеты и словарь {имя файла: содержимое}"""
+    assets: Dict[str, bytes] = {}
+    counters = {"style": 0, "script": 0}
+
+    def replace(match: re.Match) -> str:
+        tag, content = match.group(1), match.group(2)
+        data = content.strip("\n").encode("utf-8")
+        if len(data) < inline_max_bytes:
+            return match.group(0)
+        counters[tag] += 1
+        ext = "css" if tag == "style" else "js"
+        stem = "app" if counters[tag] == 1 else f"app-{counters[tag]}"
+        name = f"{stem}.{_digest(data)}.{ext}"
+        assets[name] = data + b"\n"
+        if tag == "style":
+            return f'<link rel="stylesheet" href="{ASSETS_URL}/{name}">'
+        return f'<script src="{ASSETS_URL}/{name}"></script>'
+
+    return BLOCK_RE.sub(replace, html), assets
+
+
+def compress(data: bytes) -> Dict[str, bytes]:
+    variants = {".gz": gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = brotli.compress(data, quality=11)
+    return variants
+
+
+def _write(path: str, data: bytes):
+    # Через временный файл: работающий сервер не увидит недописанный ассет
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def build(source: str = SOURCE_HTML, output: str = ASSETS_DIR, inline_max_bytes: int = ASSET_INLINE_MAX_BYTES) -> Dict[str, Dict[str, int]]:
+    """Сборка в каталог output; возвращает размеры файлов (исходный и сжатые)"""
+    with open(source, "r", encoding="utf-8") as f:
+        html, assets = extract(f.read(), inline_max_bytes)
+    os.makedirs(output, exist_ok=True)
+
+    # Сначала ассеты, index.html последним: страница не ссылается на еще не записанные файлы
+    files = dict(assets)
+    files["index.html"] = html.encode("utf-8")
+    written: List[str] = []
+    sizes: Dict[str, Dict[str, int]] = {}
+    for name, data in files.items():
+        path = os.path.join(output, name)
+        sizes[name] = {"raw": len(data)}
+        for ext, compressed in compress(data).items():
+            _write(path + ext, compressed)
+            written.append(name + ext)
+            sizes[name][ext.lstrip(".")] = len(compressed)
+        _write(path, data)
+        written.append(name)
+
+    # Ассеты прошлых сборок больше не упоминаются в index.html (каталог принадлежит сборке целиком)
+    for name in os.listdir(output):
+        if name not in written and name != "manifest.json":
+            os.remove(os.path.join(output, name))
+
+    _write(os.path.join(output, "manifest.json"), json.dumps(
+        {"source": source, "files": sizes},
+        ensure_ascii=False, indent=2,
+    ).encode("utf-8"))
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--source", default=SOURCE_HTML)
+    parser.add_argument("--output", default=ASSETS_DIR)
+    parser.add_argument("--inline-max-bytes", type=int, default=ASSET_INLINE_MAX_BYTES)
+    args = parser.parse_args()
+
+    sizes = build(args.source, args.output, args.inline_max_bytes)
+    print(f"{'файл':<32} {'исходный':>10} {'gzip':>10} {'brotli':>10}")
+    for name, size in sizes.items():
+        br = size.get("br")
+        print(f"{name:<32} {size['raw']:>10} {size['gz']:>10} {br if br is not None else '-':>10}")
+    if brotli is None:
+        print("brotli не установлен: собраны только .gz (pip install brotli)")
+    print(f"✅ Сборка в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+import os
+import re
+import json
+import asyncio
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Dict, Iterator, List, Any, Optional, Tuple
+
+import documents
+import metrics
+import tracing
+
+# Необязательное C-ускорение (pyahocorasick)
+try:
+    import ahocorasick as _pyahocorasick
+except ImportError:
+    _pyahocorasick = None
+
+# Декларативные правила проверки: профиль, обязательные/запрещенные термины, замечание, рекомендация, вес
+RULES_PATH = os.getenv("COMPLIANCE_RULES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "compliance_rules.json"))
+# Сколько совпадений с позициями возвращать в ответе
+COMPLIANCE_MAX_MATCHES = int(os.getenv("COMPLIANCE_MAX_MATCHES", "500"))
+# Число процессов для пакетной проверки
+COMPLIANCE_WORKERS = int(os.getenv("COMPLIANCE_WORKERS", str(os.cpu_count() or 2)))
+# Размер кеша совпадений по абзацам (инкрементальная проверка)
+COMPLIANCE_PARAGRAPH_CACHE_SIZE = int(os.getenv("COMPLIANCE_PARAGRAPH_CACHE_SIZE", "50000"))
+
+PARAGRAPH_BREAK_RE = re.compile(r"\n\s*\n")
+DEFAULT_WEIGHT = 15
+# Термины не длиннее этого (аббревиатуры PHI, BAA, CCPA) совпадают только целым словом;
+# более длинные - с начала слова, чтобы основы вроде "соглас" находили все словоформы
+WHOLE_WORD_MAX_CHARS = 4
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+class AhoCorasick:
+    """Автомат Ахо-Корасик: все термины ищутся за один проход по тексту"""
+
+    def __init__(self, patterns: List[str]):
+        self.patterns = patterns
+        if _pyahocorasick is not None:
+            self._automaton = _pyahocorasick.Automaton()
+            for index, pattern in enumerate(patterns):
+                self._automaton.add_word(pattern, index)
+            self._automaton.make_automaton()
+            return
+
+        self._automaton = None
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[int]] = [[]]
+
+        for index, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.output[state].append(index)
+
+        # Суффиксные ссылки строятся обходом в ширину
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def iter(self, text: str) -> Iterator[Tuple[int, int]]:
+        """Совпадения (позиция последнего символа, индекс термина), включая перекрывающиеся"""
+        if self._automaton is not None:
+            yield from self._automaton.iter(text)
+            return
+
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                for index in output[state]:
+                    yield position, index
+
+
+class RuleSet:
+    """Скомпилированный набор правил: единый автомат по всем терминам всех профилей"""
+
+    def __init__(self, rules: List[Dict[str, Any]]):
+        self.rules = rules
+        self.terms: List[str] = []
+        term_ids: Dict[str, int] = {}
+        for rule in rules:
+            for term in rule.get("required", []) + rule.get("forbidden", []):
+                term = term.lower()
+                if term not in term_ids:
+                    term_ids[term] = len(self.terms)
+                    self.terms.append(term)
+        self.term_ids = term_ids
+        self.whole_word = [len(term) <= WHOLE_WORD_MAX_CHARS for term in self.terms]
+        self.profiles = sorted({rule["profile"] for rule in rules})
+        self.automaton = AhoCorasick(self.terms)
+        # Версия словаря терминов: кеш абзацев недействителен при смене правил
+        self.version = hashlib.sha1("\0".join(self.terms).encode("utf-8")).hexdigest()
+
+    def scan(self, text: str) -> List[Tuple[int, int, int]]:
+        """Один проход по тексту: список (начало, конец, индекс термина)"""
+        lowered = text.lower()
+        offsets = None
+        if len(lowered) != len(text):
+            # Редкие символы меняют длину при lower() - сохраняем соответствие позиций
+            parts = []
+            offsets = []
+            for position, char in enumerate(text):
+                lower_char = char.lower()
+                parts.append(lower_char)
+                offsets.extend([position] * len(lower_char))
+            lowered = "".join(parts)
+
+        matches = []
+        last = len(lowered) - 1
+        for end, index in self.automaton.iter(lowered):
+            start = end - len(self.terms[index]) + 1
+            # Совпадение внутри слова не считается: "phi" в "philosophy", "соглас" в "несогласие"
+            if start > 0 and _is_word_char(lowered[start - 1]):
+                continue
+            if self.whole_word[index] and end < last and _is_word_char(lowered[end + 1]):
+                continue
+            if offsets is not None:
+                start, end = offsets[start], offsets[end]
+            matches.append((start, end + 1, index))
+        return matches
+
+    def evaluate(self, found_terms: set, profiles: List[str]) -> Dict[str, Any]:
+        """Оценка правил выбранных профилей по множеству найденных терминов"""
+        issues = []
+        suggestions = []
+        penalty = 0
+        for rule in self.rules:
+            if rule["profile"] not in profiles:
+                continue
+            required = [self.term_ids[term.lower()] for term in rule.get("required", [])]
+            forbidden = [self.term_ids[term.lower()] for term in rule.get("forbidden", [])]
+            violated = (required and not any(term in found_terms for term in required)) or \
+                any(term in found_terms for term in forbidden)
+            if violated:
+                issues.append(rule["issue"])
+                if rule.get("suggestion") and rule["suggestion"] not in suggestions:
+                    suggestions.append(rule["suggestion"])
+                penalty += rule.get("weight", DEFAULT_WEIGHT)
+
+        return {"score": max(0, 100 - penalty), "issues": issues, "suggestions": suggestions}
+
+
+_ruleset: Optional[RuleSet] = None
+
+
+def load_rules(path: str = RULES_PATH) -> List[Dict[str, Any]]:
+    """Загрузка правил из JSON"""
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def get_ruleset() -> RuleSet:
+    """Скомпилированный набор правил (строится один раз)"""
+    global _ruleset
+    if _ruleset is None:
+        _ruleset = RuleSet(load_rules())
+        logging.info(f"Правила комплаенса скомпилированы: {len(_ruleset.rules)} правил, {len(_ruleset.terms)} терминов")
+    return _ruleset
+
+
+def normalize_profiles(profiles: List[str]) -> List[str]:
+    """Имена профилей в нижнем регистре без дефисов (GDPR, 152-FZ -> gdpr, 152fz)"""
+    return [profile.lower().replace("-", "").replace(" ", "") for profile in profiles]
+
+
+@tracing.traced("compliance.check")
+def check(text: str, profiles: List[str]) -> Dict[str, Any]:
+    """Проверка текста по выбранным профилям: оценка, замечания, рекомендации и совпадения с позициями"""
+    ruleset = get_ruleset()
+    profiles = normalize_profiles(profiles)
+    matches = ruleset.scan(text)
+    result = ruleset.evaluate({index for _, _, index in matches}, profiles)
+    result["matches"] = [
+        {"term": ruleset.terms[index], "start": start, "end": end}
+        for start, end, index in matches[:COMPLIANCE_MAX_MATCHES]
+    ]
+    return result
+
+
+# (версия правил, хеш абзаца) -> (совпадения, множество найденных терминов)
+_paragraph_cache: "OrderedDict[Tuple[str, str], Tuple[List[Tuple[int, int, int]], frozenset]]" = OrderedDict()
+_paragraph_cache_lock = threading.Lock()
+
+
+def split_paragraphs(text: str) -> List[Tuple[int, str]]:
+    """Разбиение текста на абзацы: список (смещение, текст абзаца)"""
+    paragraphs = []
+    start = 0
+    for match in PARAGRAPH_BREAK_RE.finditer(text):
+        if match.start() > start:
+            paragraphs.append((start, text[start:match.start()]))
+        start = match.end()
+    if start < len(text):
+        paragraphs.append((start, text[start:]))
+    return paragraphs
+
+
+@tracing.traced("compliance.check")
+def check_incremental(text: str, profiles: List[str]) -> Dict[str, Any]:
+    """Проверка с кешем совпадений по абзацам
+
+    Сканируются только абзацы, которых нет в кеше (по хешу содержимого); оценка
+    пересчитывается из сохраненных совпадений. Термины, разорванные границей
+    абзаца, не учитываются.
+    """
+    ruleset = get_ruleset()
+    profiles = normalize_profiles(profiles)
+    matches = []
+    found_terms = set()
+    rescanned = 0
+    paragraphs = split_paragraphs(text)
+
+    for offset, paragraph in paragraphs:
+        key = (ruleset.version, hashlib.sha1(paragraph.encode("utf-8")).hexdigest())
+        with _paragraph_cache_lock:
+            entry = _paragraph_cache.get(key)
+            if entry is not None:
+                _paragraph_cache.move_to_end(key)
+        if entry is None:
+            hits = ruleset.scan(paragraph)
+            entry = (hits, frozenset(index for _, _, index in hits))
+            rescanned += 1
+            with _paragraph_cache_lock:
+                _paragraph_cache[key] = entry
+                while len(_paragraph_cache) > COMPLIANCE_PARAGRAPH_CACHE_SIZE:
+                    _paragraph_cache.popitem(last=False)
+        hits, terms = entry
+        found_terms |= terms
+        if len(matches) < COMPLIANCE_MAX_MATCHES:
+            matches.extend((offset + start, offset + end, index) for start, end, index in hits)
+
+    result = ruleset.evaluate(found_terms, profiles)
+    result["matches"] = [
+        {"term": ruleset.terms[index], "start": start, "end": end}
+        for start, end, index in matches[:COMPLIANCE_MAX_MATCHES]
+    ]
+    result["incremental"] = {"paragraphs": len(paragraphs), "rescanned": rescanned}
+    metrics.cache_lookup("compliance_paragraph", True, len(paragraphs) - rescanned)
+    metrics.cache_lookup("compliance_paragraph", False, rescanned)
+    return result
+
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """Пул процессов пакетной проверки. Воркеры компилируют правила один раз при запуске"""
+    global _process_pool
+    if _process_pool is None:
+        # spawn, а не fork: пул создается в работающем сервере, где уже есть потоки
+        # (uvicorn, httpx, пулы исполнителей) и захваченные ими локи
+        _process_pool = ProcessPoolExecutor(
+            max_workers=COMPLIANCE_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=get_ruleset,
+        )
+    return _process_pool
+
+
+def shutdown_pool():
+    """Остановка пула процессов (при завершении приложения)"""
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+
+def check_document(document_id: str, text: Optional[str], profiles: List[str], include_matches: bool = False) -> Dict[str, Any]:
+    """Проверка одного документа пакета (выполняется в процессе-воркере)
+
+    Если text не передан, документ читается из загруженных файлов по document_id.
+    Возвращает общую оценку и разбивку по профилям.
+    """
+    try:
+        if text is None:
+            path = documents.resolve_upload(document_id)
+            if not path:
+                return {"id": document_id, "error": "Документ не найден"}
+            text = documents.extract_text(path)
+
+        ruleset = get_ruleset()
+        profiles = normalize_profiles(profiles)
+        matches = ruleset.scan(text)
+        found_terms = {index for _, _, index in matches}
+
+        result = ruleset.evaluate(found_terms, profiles)
+        result["id"] = document_id
+        result["profiles"] = {profile: ruleset.evaluate(found_terms, [profile]) for profile in profiles}
+        if include_matches:
+            result["matches"] = [
+                {"term": ruleset.terms[index], "start": start, "end": end}
+                for start, end, index in matches[:COMPLIANCE_MAX_MATCHES]
+            ]
+        return result
+    except Exception as e:
+        logging.error(f"Ошибка проверки документа {document_id}: {e}")
+        return {"id": document_id, "error": str(e)}
+
+
+def _summarize(stats: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """Итоговая статистика по профилям"""
+    summary = {}
+    for profile, item in stats.items():
+        summary[profile] = {
+            "documents": item["documents"],
+            "avg_score": round(item["score_sum"] / item["documents"], 2) if item["documents"] else None,
+            "min_score": item["min_score"],
+            "passed": item["passed"],
+            "issues": dict(sorted(item["issues"].items(), key=lambda kv: kv[1], reverse=True)),
+        }
+    return summary
+
+
+async def check_batch(items: List[Tuple[str, Optional[str]]], profiles: List[str], include_matches: bool = False) -> AsyncIterator[Dict[str, Any]]:
+    """Пакетная проверка в пуле процессов
+
+    Результаты отдаются по мере готовности; последним идет сводка по профилям.
+    items - список (id документа, текст или None для загруженных файлов).
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+    futures = [
+        loop.run_in_executor(pool, check_document, document_id, text, profiles, include_matches)
+        for document_id, text in items
+    ]
+
+    stats: Dict[str, Dict[str, Any]] = {}
+    failed = 0
+    for future in asyncio.as_completed(futures):
+        result = await future
+        if "error" in result:
+            failed += 1
+        else:
+            for profile, profile_result in result["profiles"].items():
+                item = stats.setdefault(profile, {"documents": 0, "score_sum": 0, "min_score": 100, "passed": 0, "issues": {}})
+                item["documents"] += 1
+                item["score_sum"] += profile_result["score"]
+                item["min_score"] = min(item["min_score"], profile_result["score"])
+                if not profile_result["issues"]:
+                    item["passed"] += 1
+                for issue in profile_result["issues"]:
+                    item["issues"][issue] = item["issues"].get(issue, 0) + 1
+        yield {"type": "result", **result}
+
+    yield {"type": "summary", "documents": len(items), "failed": failed, "profiles": _summarize(stats)}
@@ -0,0 +1,187 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional
+
+import embeddings
+import embedding_service
+import metrics
+import tracing
+
+# Бюджет токенов на контекст документов в одном запросе к LLM
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Размер чанка в символах
+CHUNK_SIZE = int(os.getenv("CONTEXT_CHUNK_SIZE", "1200"))
+# Сколько документов держим в кеше эмбеддингов
+CONTEXT_CACHE_SIZE = int(os.getenv("CONTEXT_CACHE_SIZE", "64"))
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+# Кеш: хеш документа -> чанки и матрица эмбеддингов
+_document_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _get_tokenizer():
+    """Ленивая загрузка токенизатора tiktoken"""
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                try:
+                    import tiktoken
+                    _tokenizer = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    logging.warning(f"tiktoken недоступен ({e}). Используем приблизительный подсчет токенов.")
+                    _tokenizer = False
+    return _tokenizer or None
+
+
+def count_tokens(text: str) -> int:
+    """Подсчет токенов в тексте"""
+    tokenizer = _get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, disallowed_special=()))
+    # Приблизительно: ~4 байта UTF-8 на токен
+    return (len(text.encode("utf-8")) + 3) // 4
+
+
+def document_hash(content: str) -> str:
+    """Хеш содержимого документа"""
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def split_into_chunks(text: str, chunk_size: int = CHUNK_SIZE) -> List[Dict[str, Any]]:
+    """Разбиение текста на чанки по абзацам с сохранением смещений"""
+    chunks = []
+    start = None
+    end = 0
+    pos = 0
+
+    def flush(chunk_start: int, chunk_end: int):
+        if text[chunk_start:chunk_end].strip():
+            chunks.append({"start": chunk_start, "end": chunk_end, "text": text[chunk_start:chunk_end]})
+
+    for paragraph in text.split("\n"):
+        p_start, p_end = pos, pos + len(paragraph)
+        pos = p_end + 1
+
+        # Слишком длинный абзац режем на окна
+        if p_end - p_start > chunk_size:
+            if start is not None:
+                flush(start, end)
+                start = None
+            for w_start in range(p_start, p_end, chunk_size):
+                flush(w_start, min(w_start + chunk_size, p_end))
+            continue
+
+        if start is None:
+            start = p_start
+        elif p_end - start > chunk_size:
+            flush(start, end)
+            start = p_start
+        end = p_end
+
+    if start is not None:
+        flush(start, end)
+    return chunks
+
+
+def _get_document_index(content: str) -> Dict[str, Any]:
+    """Чанки и эмбеддинги документа (из кеша или вычисленные заново)"""
+    key = document_hash(content)
+    with _cache_lock:
+        cached = _document_cache.get(key)
+        if cached is not None:
+            _document_cache.move_to_end(key)
+    metrics.cache_lookup("context_document", cached is not None)
+    if cached is not None:
+        return cached
+
+    chunks = split_into_chunks(content)
+    vectors = embeddings.encode([chunk["text"] for chunk in chunks])
+    for chunk in chunks:
+        chunk["tokens"] = count_tokens(chunk["text"])
+    index = {"hash": key, "chunks": chunks, "vectors": vectors}
+
+    with _cache_lock:
+        _document_cache[key] = index
+        while len(_document_cache) > CONTEXT_CACHE_SIZE:
+            _document_cache.popitem(last=False)
+    return index
+
+
+@tracing.traced("context.build")
+def build_context(question: str, documents: List[Dict[str, Any]], token_budget: Optional[int] = None) -> Dict[str, Any]:
+    """Отбор релевантных чанков документов под бюджет токенов
+
+    Возвращает текст контекста, источники со смещениями и число токенов.
+    """
+    token_budget = token_budget or CONTEXT_TOKEN_BUDGET
+
+    candidates = []
+    for doc_index, doc in enumerate(documents):
+        content = doc.get("content") or ""
+        if not content.strip():
+            continue
+        index = _get_document_index(content)
+        if not index["chunks"]:
+            continue
+        candidates.append((doc_index, doc, index))
+
+    if not candidates:
+        return {"context": "", "sources": [], "tokens": 0}
+
+    # Вектор вопроса - через пакетное кодирование: одновременные запросы кодируются одним вызовом модели
+    query_vector = embedding_service.encode_query(question)
+    scored = []
+    for doc_index, doc, index in candidates:
+        scores = index["vectors"] @ query_vector
+        for chunk_index, score in enumerate(scores):
+            scored.append((float(score), doc_index, chunk_index, doc, index["chunks"][chunk_index]))
+    scored.sort(key=lambda item: item[0], reverse=True)
+
+    # Жадно набираем самые релевантные чанки, пока помещаются в бюджет
+    selected = []
+    used_tokens = 0
+    for score, doc_index, chunk_index, doc, chunk in scored:
+        if used_tokens + chunk["tokens"] > token_budget:
+            continue
+        selected.append((doc_index, chunk_index, score, doc, chunk))
+        used_tokens += chunk["tokens"]
+        if token_budget - used_tokens < 50:
+            break
+
+    # Восстанавливаем порядок следования текста
+    selected.sort(key=lambda item: (item[0], item[1]))
+
+    parts = []
+    sources = []
+    for number, (doc_index, chunk_index, score, doc, chunk) in enumerate(selected, start=1):
+        name = doc.get("name") or f"Документ {doc_index + 1}"
+        parts.append(f"[{number}] {name} (символы {chunk['start']}–{chunk['end']}):\n{chunk['text'].strip()}")
+        sources.append({
+            "ref": number,
+            "document_id": doc.get("id"),
+            "name": name,
+            "chunk": chunk_index,
+            "start": chunk["start"],
+            "end": chunk["end"],
+            "score": round(score, 4),
+            "tokens": chunk["tokens"],
+        })
+
+    return {"context": "\n\n".join(parts), "sources": sources, "tokens": used_tokens}
+
+
+def compose_prompt(message: str, context: Dict[str, Any]) -> str:
+    """Промпт с релевантными фрагментами документов"""
+    if not context.get("context"):
+        return message
+    return (
+        "Релевантные фрагменты документов (ссылайтесь на номера в квадратных скобках):\n\n"
+        f"{context['context']}\n\n{message}"
+    )
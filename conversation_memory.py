@@ -0,0 +1,110 @@
+import os
+import logging
+from typing import Dict, List, Any
+
+import database
+import llm
+import metrics
+import tracing
+from context_builder import count_tokens
+
+# Сколько последних ходов (вопрос + ответ) передаем дословно
+MEMORY_RECENT_TURNS = int(os.getenv("MEMORY_RECENT_TURNS", "3"))
+# Ограничение длины одного дословного сообщения в символах
+MEMORY_MESSAGE_MAX_CHARS = int(os.getenv("MEMORY_MESSAGE_MAX_CHARS", "2000"))
+# Ограничение размера сводки в токенах
+MEMORY_SUMMARY_MAX_TOKENS = int(os.getenv("MEMORY_SUMMARY_MAX_TOKENS", "400"))
+
+SUMMARY_PROMPT = (
+    "Ты ведешь краткое содержание юридической консультации. Обнови краткое содержание, "
+    "добавив в него новые реплики. Сохраняй факты, документы, суммы, сроки, ссылки на статьи "
+    "и выводы. Пиши сжато, без вступлений, не более {limit} токенов."
+)
+
+ROLE_NAMES = {"user": "Пользователь", "assistant": "Ассистент"}
+
+
+def _trim_message(content: str) -> str:
+    """Обрезка слишком длинного сообщения"""
+    if len(content) <= MEMORY_MESSAGE_MAX_CHARS:
+        return content
+    return content[:MEMORY_MESSAGE_MAX_CHARS] + "…"
+
+
+def _format_delta(delta: List[Dict[str, Any]]) -> str:
+    """Новые реплики в виде текста для суммаризации"""
+    return "\n".join(
+        f"{ROLE_NAMES.get(message.get('role'), message.get('role'))}: {_trim_message(message.get('content', ''))}"
+        for message in delta
+    )
+
+
+def _fallback_summary(previous_summary: str, delta: List[Dict[str, Any]]) -> str:
+    """Экстрактивная сводка без LLM: первые предложения реплик, старое вытесняется"""
+    lines = [line for line in previous_summary.split("\n") if line.strip()]
+    for message in delta:
+        content = " ".join(message.get("content", "").split())
+        head = content[:200]
+        for end_char in [".", "?", "!"]:
+            pos = head.find(end_char)
+            if pos > 20:
+                head = head[:pos + 1]
+                break
+        lines.append(f"{ROLE_NAMES.get(message.get('role'), message.get('role'))}: {head}")
+
+    while len(lines) > 1 and count_tokens("\n".join(lines)) > MEMORY_SUMMARY_MAX_TOKENS:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+async def summarize_delta(previous_summary: str, delta: List[Dict[str, Any]]) -> str:
+    """Инкрементальное обновление сводки только новыми репликами"""
+    if not llm.is_available():
+        metrics.fallback("memory_summary")
+        return _fallback_summary(previous_summary, delta)
+
+    try:
+        summary = await llm.chat_completion(
+            [
+                {"role": "system", "content": SUMMARY_PROMPT.format(limit=MEMORY_SUMMARY_MAX_TOKENS)},
+                {"role": "user", "content": f"Текущее краткое содержание:\n{previous_summary or '(пусто)'}\n\nНовые реплики:\n{_format_delta(delta)}"},
+            ],
+            temperature=0.1,
+            max_tokens=MEMORY_SUMMARY_MAX_TOKENS,
+        )
+        return summary.strip() or _fallback_summary(previous_summary, delta)
+    except Exception as e:
+        logging.error(f"Ошибка суммаризации истории чата: {e}")
+        metrics.fallback("memory_summary")
+        return _fallback_summary(previous_summary, delta)
+
+
+@tracing.traced("memory.build")
+async def build_memory(user_id: int, chat_id: str, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Память диалога: сводка старых ходов и последние ходы дословно
+
+    messages - сообщения чата до текущего вопроса. Сводка хранится в chat_history
+    и дополняется только сообщениями, вышедшими за окно последних ходов.
+    """
+    keep = MEMORY_RECENT_TURNS * 2
+    boundary = max(0, len(messages) - keep)
+
+    state = database.get_chat_memory(user_id, chat_id)
+    summary = state.get("summary", "") if state["success"] else ""
+    summarized_count = state.get("summarized_count", 0) if state["success"] else 0
+
+    # История была перезаписана короче, чем уже свернутая часть - начинаем заново
+    if summarized_count > len(messages):
+        summary, summarized_count = "", 0
+
+    if boundary > summarized_count:
+        summary = await summarize_delta(summary, messages[summarized_count:boundary])
+        summarized_count = boundary
+        database.save_chat_memory(user_id, chat_id, summary, summarized_count)
+
+    recent = [
+        {"role": message["role"], "content": _trim_message(message.get("content", ""))}
+        for message in messages[max(boundary, summarized_count):]
+        if message.get("role") in ("user", "assistant")
+    ]
+    return {"summary": summary, "recent": recent}
@@ -0,0 +1,131 @@
+import os
+import hashlib
+import threading
+import contextlib
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: несколько воркеров не поддерживаются, достаточно блокировки внутри процесса
+    fcntl = None
+
+# Каталог счетчиков версий (канал инвалидации кешей между воркерами) и общих матриц
+COORDINATION_DIR = os.getenv("COORDINATION_DIR", os.path.join("cache", "coordination"))
+SHARED_ARRAYS_DIR = os.getenv("SHARED_ARRAYS_DIR", os.path.join("cache", "shared"))
+
+_thread_locks: Dict[str, threading.Lock] = {}
+_thread_locks_guard = threading.Lock()
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """Эксклюзивная блокировка файла для всех процессов и потоков (flock на path.lock)
+
+    Потоки одного процесса сериализуются обычным Lock: flock принадлежит
+    открытому файлу и внутри процесса не защищает.
+    """
+    with _thread_locks_guard:
+        thread_lock = _thread_locks.setdefault(path, threading.Lock())
+    with thread_lock:
+        if fcntl is None:
+            yield
+            return
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def version(name: str) -> int:
+    """Текущая версия данных: размер файла-счетчика (один stat, без чтения)"""
+    try:
+        return os.stat(os.path.join(COORDINATION_DIR, name)).st_size
+    except FileNotFoundError:
+        return 0
+
+
+def bump(name: str) -> int:
+    """Новая версия данных для всех воркеров; возвращает ее номер
+
+    Дозапись одного байта с O_APPEND атомарна, поэтому одновременные
+    изменения из разных процессов не теряются.
+    """
+    os.makedirs(COORDINATION_DIR, exist_ok=True)
+    fd = os.open(os.path.join(COORDINATION_DIR, name), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, b"\n")
+        return os.fstat(fd).st_size
+    finally:
+        os.close(fd)
+
+
+class Channel:
+    """Согласованность локального кеша с изменениями из других воркеров
+
+    Владелец кеша запоминает версию на момент построения (mark), проверяет
+    stale() при обращении и после собственного изменения, уже примененного
+    к локальной копии, вызывает published(): чужие изменения между версиями
+    делают копию устаревшей.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.seen: Optional[int] = None
+
+    def current(self) -> int:
+        return version(self.name)
+
+    def mark(self, seen: int):
+        self.seen = seen
+
+    def stale(self) -> bool:
+        return self.seen != version(self.name)
+
+    def published(self):
+        new = bump(self.name)
+        if self.seen is not None and new == self.seen + 1:
+            self.seen = new
+
+
+def shared_array(name: str, key: str, build: Callable[[], np.ndarray]) -> np.ndarray:
+    """Матрица только для чтения, общая для всех воркеров через mmap
+
+    Первый воркер строит ее и сохраняет в .npy (под блокировкой), остальные
+    отображают тот же файл: страницы лежат в памяти один раз, сколько бы
+    процессов их ни читали. key - хеш входных данных: изменились данные - новый файл.
+    """
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    path = os.path.join(SHARED_ARRAYS_DIR, f"{name}-{digest}.npy")
+    while True:
+        if not os.path.exists(path):
+            with file_lock(path):
+                if not os.path.exists(path):
+                    _save_array(name, path, np.ascontiguousarray(build()))
+        try:
+            return np.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            # Файл удален сборкой более новой версии между проверкой и открытием
+            continue
+
+
+def _save_array(name: str, path: str, array: np.ndarray):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp, path)
+    # Матрицы прошлых версий данных новым воркерам не нужны (уже открытые отображения остаются валидными)
+    for stale in os.listdir(SHARED_ARRAYS_DIR):
+        if stale.startswith(f"{name}-") and stale.endswith((".npy", ".npy.lock")) and not stale.startswith(os.path.basename(path)):
+            try:
+                os.remove(os.path.join(SHARED_ARRAYS_DIR, stale))
+            except OSError:
+                # Windows не удаляет файл, пока он отображен в память
+                pass
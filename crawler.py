@@ -0,0 +1,382 @@
+"""Асинхронный обход источников правового корпуса: нормализованный текст в kodeks/ и переиндексация изменений
+
+Запуск: python crawler.py [--sources data/crawler_sources.json] [--reindex job|inline|none]
+
+Повторный обход дешевый: условные GET (ETag/Last-Modified) отсекают неизменные
+страницы без тела, хеш ответа и хеш нормализованного текста - изменившиеся
+только в разметке. Переиндексируются лишь файлы, текст которых изменился.
+"""
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import logging
+import argparse
+import contextlib
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+
+import httpx
+
+import jobs
+import metrics
+import rag_indexer
+
+# Список источников: [{"url": ..., "filename": ..., "selector": необязательный CSS-селектор текста}]
+CRAWLER_SOURCES_PATH = os.getenv("CRAWLER_SOURCES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "crawler_sources.json"))
+# Состояние обхода: валидаторы и хеши по URL
+CRAWLER_DB_PATH = os.getenv("CRAWLER_DB_PATH", "crawler.db")
+# Одновременные запросы всего и к одному хосту, пауза между запросами к хосту (секунды)
+CRAWLER_CONCURRENCY = int(os.getenv("CRAWLER_CONCURRENCY", "8"))
+CRAWLER_PER_HOST = int(os.getenv("CRAWLER_PER_HOST", "2"))
+CRAWLER_HOST_DELAY = float(os.getenv("CRAWLER_HOST_DELAY", "1.0"))
+CRAWLER_TIMEOUT = float(os.getenv("CRAWLER_TIMEOUT", "30"))
+# Повторы при 429/5xx и сетевых ошибках (пауза из Retry-After или экспоненциальная)
+CRAWLER_MAX_RETRIES = int(os.getenv("CRAWLER_MAX_RETRIES", "3"))
+CRAWLER_RETRY_MAX_DELAY = 60.0
+# Процессы разбора HTML (BeautifulSoup не отдает GIL)
+CRAWLER_PARSE_WORKERS = int(os.getenv("CRAWLER_PARSE_WORKERS", str(min(4, os.cpu_count() or 2))))
+CRAWLER_USER_AGENT = os.getenv("CRAWLER_USER_AGENT", "explAiner-crawler/1.0")
+
+# Где искать текст документа, если у источника нет своего селектора
+CONTENT_SELECTORS = ["#divCont", ".docBody", "article", "main", "#content", "body"]
+NOISE_TAGS = ["script", "style", "noscript", "nav", "header", "footer", "form", "iframe", "button"]
+# Переводы строк только на границах блоков: ссылка "статья 5" внутри абзаца не становится заголовком
+BLOCK_TAGS = ["p", "div", "br", "li", "tr", "table", "section", "article", "blockquote", "pre",
+              "h1", "h2", "h3", "h4", "h5", "h6", "dt", "dd"]
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def normalize_text(text: str) -> str:
+    """Единая форма текста: NFC, без неразрывных пробелов, одна пустая строка между абзацами"""
+    text = unicodedata.normalize("NFC", text).replace("\xa0", " ").replace("\r\n", "\n").replace("\r", "\n")
+    lines = []
+    for line in text.split("\n"):
+        line = " ".join(line.split())
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    return "\n".join(lines).strip() + "\n"
+
+
+def parse_document(body: bytes, encoding: Optional[str], selector: Optional[str]) -> str:
+    """HTML -> нормализованный текст документа (выполняется в пуле процессов)"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(body, "html.parser", from_encoding=encoding)
+    for tag in soup(NOISE_TAGS):
+        tag.decompose()
+    root = None
+    for candidate in ([selector] if selector else []) + CONTENT_SELECTORS:
+        root = soup.select_one(candidate)
+        if root is not None:
+            break
+    root = root or soup
+    # "Статья N." в начале абзаца остается в начале строки - по ней строится индекс статей
+    for tag in root.find_all(BLOCK_TAGS):
+        tag.insert_before("\n")
+        tag.insert_after("\n")
+    return normalize_text(root.get_text())
+
+
+def _sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS crawl_state (
+            url TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            content_hash TEXT,
+            text_hash TEXT,
+            status TEXT,
+            fetched_at TEXT,
+            changed_at TEXT
+        )
+    ''')
+    return conn
+
+
+def load_sources(path: str = CRAWLER_SOURCES_PATH) -> List[Dict[str, Any]]:
+    """Источники корпуса из JSON"""
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class HostLimiter:
+    """Вежливость к хосту: не больше N одновременных запросов и пауза между их началами"""
+
+    def __init__(self, concurrency: int, delay: float):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.delay = delay
+        self._next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        async with self.semaphore:
+            async with self._lock:
+                now = time.monotonic()
+                if self._next_start > now:
+                    await asyncio.sleep(self._next_start - now)
+                self._next_start = max(now, self._next_start) + self.delay
+            yield
+
+    def pause(self, seconds: float):
+        """Хост попросил подождать (Retry-After): пауза для всех запросов к нему"""
+        self._next_start = max(self._next_start, time.monotonic() + seconds)
+
+
+def _retry_after(response: httpx.Response, attempt: int) -> float:
+    value = response.headers.get("retry-after", "")
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            delay = 2.0 ** attempt
+    return min(max(delay, 0.0), CRAWLER_RETRY_MAX_DELAY)
+
+
+class Crawler:
+    """Обход списка источников с ограничением параллелизма, условными GET и разбором HTML в пуле процессов"""
+
+    def __init__(
+        self,
+        output_dir: str = rag_indexer.KODEKS_DIR,
+        db_path: str = CRAWLER_DB_PATH,
+        concurrency: int = CRAWLER_CONCURRENCY,
+        per_host: int = CRAWLER_PER_HOST,
+        host_delay: float = CRAWLER_HOST_DELAY,
+        parse_workers: int = CRAWLER_PARSE_WORKERS,
+        respect_robots: bool = True,
+        client: Optional[httpx.AsyncClient] = None,
+    ):
+        self.output_dir = output_dir
+        self.db_path = db_path
+        self.concurrency = concurrency
+        self.per_host = per_host
+        self.host_delay = host_delay
+        self.parse_workers = parse_workers
+        self.respect_robots = respect_robots
+        self.client = client
+        self._hosts: Dict[str, HostLimiter] = {}
+        self._robots: Dict[str, "asyncio.Task"] = {}
+
+    def _limiter(self, host: str) -> HostLimiter:
+        if host not in self._hosts:
+            self._hosts[host] = HostLimiter(self.per_host, self.host_delay)
+        return self._hosts[host]
+
+    async def _fetch(self, client: httpx.AsyncClient, url: str, headers: Dict[str, str]) -> httpx.Response:
+        """GET с повторами на 429/5xx и сетевых ошибках; пауза из Retry-After действует на весь хост"""
+        limiter = self._limiter(urlsplit(url).netloc)
+        for attempt in range(CRAWLER_MAX_RETRIES + 1):
+            async with limiter.slot():
+                try:
+                    with metrics.track_upstream("crawler", "http", "fetch"):
+                        response = await client.get(url, headers=headers)
+                except httpx.TransportError:
+                    if attempt == CRAWLER_MAX_RETRIES:
+                        raise
+                    limiter.pause(min(2.0 ** attempt, CRAWLER_RETRY_MAX_DELAY))
+                    continue
+            if response.status_code not in RETRY_STATUSES or attempt == CRAWLER_MAX_RETRIES:
+                return response
+            limiter.pause(_retry_after(response, attempt))
+        return response
+
+    async def _robots_for(self, client: httpx.AsyncClient, url: str) -> Optional[RobotFileParser]:
+        """robots.txt хоста (один раз за обход); None - ограничений нет"""
+        parts = urlsplit(url)
+        if parts.netloc not in self._robots:
+            self._robots[parts.netloc] = asyncio.ensure_future(self._load_robots(client, f"{parts.scheme}://{parts.netloc}/robots.txt"))
+        return await self._robots[parts.netloc]
+
+    async def _load_robots(self, client: httpx.AsyncClient, robots_url: str) -> Optional[RobotFileParser]:
+        try:
+            response = await self._fetch(client, robots_url, {})
+        except httpx.HTTPError:
+            return None
+        if response.status_code != 200:
+            return None
+        parser = RobotFileParser()
+        parser.parse(response.text.splitlines())
+        delay = parser.crawl_delay(CRAWLER_USER_AGENT)
+        if delay:
+            limiter = self._limiter(urlsplit(robots_url).netloc)
+            limiter.delay = max(limiter.delay, float(delay))
+        return parser
+
+    def _state(self, url: str) -> Optional[sqlite3.Row]:
+        conn = _connect(self.db_path)
+        try:
+            return conn.execute("SELECT * FROM crawl_state WHERE url = ?", (url,)).fetchone()
+        finally:
+            conn.close()
+
+    def _save_state(self, url: str, filename: str, status: str, **fields):
+        now = datetime.now().isoformat()
+        conn = _connect(self.db_path)
+        try:
+            conn.execute(
+                "INSERT INTO crawl_state (url, filename, status, fetched_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(url) DO UPDATE SET filename = excluded.filename, status = excluded.status, fetched_at = excluded.fetched_at",
+                (url, filename, status, now)
+            )
+            if status == "changed":
+                fields["changed_at"] = now
+            for column, value in fields.items():
+                conn.execute(f"UPDATE crawl_state SET {column} = ? WHERE url = ?", (value, url))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _write(self, filename: str, text: str):
+        # Через временный файл: индексатор не прочитает недописанный текст
+        path = os.path.join(self.output_dir, filename)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8", newline="") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    async def _crawl_one(self, client: httpx.AsyncClient, pool: ProcessPoolExecutor, source: Dict[str, Any]) -> str:
+        """Обход одного источника; возвращает not_modified, unchanged, changed или skipped"""
+        url, filename = source["url"], source["filename"]
+        if self.respect_robots:
+            robots = await self._robots_for(client, url)
+            if robots is not None and not robots.can_fetch(CRAWLER_USER_AGENT, url):
+                return "skipped"
+
+        # SQLite с ожиданием блокировки - в потоке: обход идет в цикле событий сервера
+        state = await asyncio.to_thread(self._state, url)
+        file_exists = os.path.exists(os.path.join(self.output_dir, filename))
+        headers = {}
+        # Без локального файла валидаторы бесполезны: 304 не вернет текст
+        if state is not None and file_exists:
+            if state["etag"]:
+                headers["If-None-Match"] = state["etag"]
+            if state["last_modified"]:
+                headers["If-Modified-Since"] = state["last_modified"]
+
+        response = await self._fetch(client, url, headers)
+        if response.status_code == 304:
+            await asyncio.to_thread(self._save_state, url, filename, "not_modified")
+            return "not_modified"
+        response.raise_for_status()
+
+        validators = {"etag": response.headers.get("etag"), "last_modified": response.headers.get("last-modified")}
+        content_hash = _sha256(response.content)
+        if state is not None and file_exists and state["content_hash"] == content_hash:
+            await asyncio.to_thread(self._save_state, url, filename, "unchanged", **validators)
+            return "unchanged"
+
+        loop = asyncio.get_running_loop()
+        text = await loop.run_in_executor(pool, parse_document, response.content, response.charset_encoding, source.get("selector"))
+        text_hash = _sha256(text.encode("utf-8"))
+        # Страница изменилась только в разметке (меню, счетчики) - текст тот же
+        if state is not None and file_exists and state["text_hash"] == text_hash:
+            await asyncio.to_thread(self._save_state, url, filename, "unchanged", content_hash=content_hash, **validators)
+            return "unchanged"
+
+        await asyncio.to_thread(self._write, filename, text)
+        await asyncio.to_thread(self._save_state, url, filename, "changed", content_hash=content_hash, text_hash=text_hash, **validators)
+        return "changed"
+
+    async def run(self, sources: List[Dict[str, Any]], progress: Optional[Callable[[float, str], None]] = None) -> Dict[str, Any]:
+        """Обход всех источников. Отчет: счетчики по статусам, измененные файлы и ошибки"""
+        started = time.perf_counter()
+        os.makedirs(self.output_dir, exist_ok=True)
+        report: Dict[str, Any] = {"sources": len(sources), "not_modified": 0, "unchanged": 0, "skipped": 0, "changed": [], "failed": []}
+        semaphore = asyncio.Semaphore(self.concurrency)
+        done = 0
+
+        client = self.client or httpx.AsyncClient(
+            timeout=CRAWLER_TIMEOUT, follow_redirects=True, headers={"User-Agent": CRAWLER_USER_AGENT},
+            limits=httpx.Limits(max_connections=self.concurrency),
+        )
+        pool = ProcessPoolExecutor(max_workers=max(1, self.parse_workers))
+
+        async def crawl(source: Dict[str, Any]):
+            nonlocal done
+            async with semaphore:
+                try:
+                    status = await self._crawl_one(client, pool, source)
+                except Exception as e:
+                    logging.warning(f"Обход {source['url']} не удался: {e}")
+                    report["failed"].append({"url": source["url"], "error": str(e)})
+                    status = None
+                if status == "changed":
+                    report["changed"].append(source["filename"])
+                elif status:
+                    report[status] += 1
+                done += 1
+                if progress:
+                    progress(done / len(sources), source["url"])
+
+        try:
+            await asyncio.gather(*(crawl(source) for source in sources))
+        finally:
+            pool.shutdown(wait=True)
+            if self.client is None:
+                await client.aclose()
+        report["changed"].sort()
+        report["seconds"] = round(time.perf_counter() - started, 3)
+        logging.info(
+            f"Обход корпуса за {report['seconds']}s: изменено {len(report['changed'])}, "
+            f"не изменилось {report['not_modified'] + report['unchanged']}, ошибок {len(report['failed'])}"
+        )
+        return report
+
+
+def trigger_reindex(filenames: List[str], mode: str = "job") -> Optional[Dict[str, Any]]:
+    """Переиндексация измененных файлов: задача в очереди (ее выполнит сервер) или сразу в этом процессе"""
+    if not filenames or mode == "none":
+        return None
+    if mode == "inline":
+        return rag_indexer.update_index(filenames)
+    jobs.init_db()
+    return jobs.enqueue("index.update", {"files": filenames})
+
+
+@jobs.handler("corpus.crawl", queue="default", executor="async", max_attempts=1)
+async def crawl_job(ctx: jobs.JobContext, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Фоновый обход корпуса; измененные файлы ставятся в очередь переиндексации"""
+    sources = payload.get("sources") or await asyncio.to_thread(load_sources)
+    report = await Crawler().run(sources, progress=lambda share, message: ctx.report(share * 0.99, message))
+    job = await asyncio.to_thread(trigger_reindex, report["changed"])
+    report["reindex_job_id"] = job["id"] if job else None
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sources", default=CRAWLER_SOURCES_PATH)
+    parser.add_argument("--output", default=rag_indexer.KODEKS_DIR)
+    parser.add_argument("--concurrency", type=int, default=CRAWLER_CONCURRENCY)
+    parser.add_argument("--per-host", type=int, default=CRAWLER_PER_HOST)
+    parser.add_argument("--host-delay", type=float, default=CRAWLER_HOST_DELAY)
+    parser.add_argument("--reindex", choices=["job", "inline", "none"], default="job",
+                        help="job - задача для сервера, inline - переиндексация здесь же, none - только обход")
+    args = parser.parse_args()
+
+    crawler = Crawler(output_dir=args.output, concurrency=args.concurrency, per_host=args.per_host, host_delay=args.host_delay)
+    report = asyncio.run(crawler.run(load_sources(args.sources)))
+    report["reindex"] = trigger_reindex(report["changed"], args.reindex)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -5,17 +5,28 @@ import logging
 from datetime import datetime
 from typing import Dict, List, Any, Optional
 
+import metrics
+
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
 # Путь к базе данных
 DB_PATH = "users.db"
+# Сколько ждать освобождения базы другим процессом-воркером, прежде чем вернуть ошибку (секунды)
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "30"))
+
+def get_connection() -> sqlite3.Connection:
+    """Соединение с базой пользователей (с ожиданием блокировки, а не мгновенной ошибкой)"""
+    return sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
 
 def init_db():
     """Инициализация базы данных"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     
+    # WAL: чтения не блокируются записью из других воркеров (режим сохраняется в файле базы)
+    cursor.execute("PRAGMA journal_mode=WAL")
+    
     # Создание таблицы пользователей
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS users (
@@ -41,13 +52,46 @@ def init_db():
     )
     ''')
     
+    # Миграция: сводка старых сообщений для памяти диалога
+    cursor.execute("PRAGMA table_info(chat_history)")
+    columns = {row[1] for row in cursor.fetchall()}
+    if "summary" not in columns:
+        cursor.execute("ALTER TABLE chat_history ADD COLUMN summary TEXT NOT NULL DEFAULT ''")
+    if "summarized_count" not in columns:
+        cursor.execute("ALTER TABLE chat_history ADD COLUMN summarized_count INTEGER NOT NULL DEFAULT 0")
+    
+    # Библиотека типовых шаблонов договоров (сравнение один-ко-многим)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS templates (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        content TEXT NOT NULL,
+        content_hash TEXT UNIQUE NOT NULL,
+        signature BLOB NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    
+    # Сгенерированные What-if сценарии (ключ - нормализованный вопрос и хеш контекста)
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS whatif_scenarios (
+        cache_key TEXT PRIMARY KEY,
+        question TEXT NOT NULL,
+        diagram TEXT NOT NULL,
+        explanation TEXT NOT NULL,
+        tags TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    
     conn.commit()
     conn.close()
     logging.info("База данных инициализирована")
 
+@metrics.timed_query("users")
 def register_user(username: str, email: str, password: str) -> Dict[str, Any]:
     """Регистрация нового пользователя"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -79,9 +123,10 @@ def register_user(username: str, email: str, password: str) -> Dict[str, Any]:
     finally:
         conn.close()
 
+@metrics.timed_query("users")
 def login_user(email: str, password: str) -> Dict[str, Any]:
     """Авторизация пользователя"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -108,9 +153,10 @@ def login_user(email: str, password: str) -> Dict[str, Any]:
     finally:
         conn.close()
 
+@metrics.timed_query("users")
 def save_chat(user_id: int, chat_id: str, title: str, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
     """Сохранение истории чата"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -142,9 +188,10 @@ def save_chat(user_id: int, chat_id: str, title: str, messages: List[Dict[str, A
     finally:
         conn.close()
 
+@metrics.timed_query("users")
 def get_user_chats(user_id: int) -> Dict[str, Any]:
     """Получение всех чатов пользователя"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -171,9 +218,10 @@ def get_user_chats(user_id: int) -> Dict[str, Any]:
     finally:
         conn.close()
 
+@metrics.timed_query("users")
 def get_chat(user_id: int, chat_id: str) -> Dict[str, Any]:
     """Получение конкретного чата пользователя"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -202,9 +250,10 @@ def get_chat(user_id: int, chat_id: str) -> Dict[str, Any]:
     finally:
         conn.close()
 
+@metrics.timed_query("users")
 def delete_chat(user_id: int, chat_id: str) -> Dict[str, Any]:
     """Удаление чата"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -224,9 +273,10 @@ def delete_chat(user_id: int, chat_id: str) -> Dict[str, Any]:
     finally:
         conn.close()
 
+@metrics.timed_query("users")
 def update_chat_title(user_id: int, chat_id: str, title: str) -> Dict[str, Any]:
     """Обновление заголовка чата"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     
     try:
@@ -246,5 +296,211 @@ def update_chat_title(user_id: int, chat_id: str, title: str) -> Dict[str, Any]:
     finally:
         conn.close()
 
-# Инициализация базы данных при импорте модуля
-init_db()
+@metrics.timed_query("users")
+def get_chat_memory(user_id: int, chat_id: str) -> Dict[str, Any]:
+    """Получение сводки старых сообщений чата"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(
+            "SELECT summary, summarized_count FROM chat_history WHERE user_id = ? AND chat_id = ?",
+            (user_id, chat_id)
+        )
+        row = cursor.fetchone()
+        
+        if not row:
+            return {"success": False, "message": "Чат не найден"}
+        
+        return {"success": True, "summary": row[0], "summarized_count": row[1]}
+    except Exception as e:
+        logging.error(f"Ошибка при получении сводки чата: {e}")
+        return {"success": False, "message": f"Ошибка при получении сводки: {str(e)}"}
+    finally:
+        conn.close()
+
+@metrics.timed_query("users")
+def save_chat_memory(user_id: int, chat_id: str, summary: str, summarized_count: int) -> Dict[str, Any]:
+    """Сохранение сводки старых сообщений чата"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(
+            "UPDATE chat_history SET summary = ?, summarized_count = ? WHERE user_id = ? AND chat_id = ?",
+            (summary, summarized_count, user_id, chat_id)
+        )
+        conn.commit()
+        
+        if cursor.rowcount == 0:
+            return {"success": False, "message": "Чат не найден"}
+        
+        return {"success": True}
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении сводки чата: {e}")
+        return {"success": False, "message": f"Ошибка при сохранении сводки: {str(e)}"}
+    finally:
+        conn.close()
+
+@metrics.timed_query("users")
+def add_template(name: str, content: str, content_hash: str, signature: bytes) -> Dict[str, Any]:
+    """Добавление шаблона договора с MinHash-сигнатурой"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("SELECT id, name FROM templates WHERE content_hash = ?", (content_hash,))
+        existing = cursor.fetchone()
+        if existing:
+            return {"success": False, "message": f"Такой шаблон уже есть: {existing[1]}", "template_id": existing[0]}
+        
+        cursor.execute(
+            "INSERT INTO templates (name, content, content_hash, signature, created_at) VALUES (?, ?, ?, ?, ?)",
+            (name, content, content_hash, signature, datetime.now().isoformat())
+        )
+        conn.commit()
+        
+        return {"success": True, "template_id": cursor.lastrowid}
+    except Exception as e:
+        logging.error(f"Ошибка при добавлении шаблона: {e}")
+        return {"success": False, "message": f"Ошибка при добавлении шаблона: {str(e)}"}
+    finally:
+        conn.close()
+
+@metrics.timed_query("users")
+def get_templates() -> Dict[str, Any]:
+    """Список шаблонов без содержимого"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("SELECT id, name, content_hash, LENGTH(content), created_at FROM templates ORDER BY name")
+        templates = [
+            {"id": row[0], "name": row[1], "content_hash": row[2], "size": row[3], "created_at": row[4]}
+            for row in cursor.fetchall()
+        ]
+        return {"success": True, "templates": templates}
+    except Exception as e:
+        logging.error(f"Ошибка при получении шаблонов: {e}")
+        return {"success": False, "message": f"Ошибка при получении шаблонов: {str(e)}"}
+    finally:
+        conn.close()
+
+@metrics.timed_query("users")
+def get_template_signatures() -> Dict[str, Any]:
+    """Сигнатуры всех шаблонов для построения LSH-индекса"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("SELECT id, signature FROM templates")
+        return {"success": True, "signatures": cursor.fetchall()}
+    except Exception as e:
+        logging.error(f"Ошибка при получении сигнатур шаблонов: {e}")
+        return {"success": False, "message": f"Ошибка при получении сигнатур: {str(e)}"}
+    finally:
+        conn.close()
+
+@metrics.timed_query("users")
+def get_template(template_id: int) -> Dict[str, Any]:
+    """Получение шаблона с содержимым"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("SELECT id, name, content, content_hash FROM templates WHERE id = ?", (template_id,))
+        row = cursor.fetchone()
+        
+        if not row:
+            return {"success": False, "message": "Шаблон не найден"}
+        
+        return {"success": True, "template": {"id": row[0], "name": row[1], "content": row[2], "content_hash": row[3]}}
+    except Exception as e:
+        logging.error(f"Ошибка при получении шаблона: {e}")
+        return {"success": False, "message": f"Ошибка при получении шаблона: {str(e)}"}
+    finally:
+        conn.close()
+
+@metrics.timed_query("users")
+def delete_template(template_id: int) -> Dict[str, Any]:
+    """Удаление шаблона"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("DELETE FROM templates WHERE id = ?", (template_id,))
+        conn.commit()
+        
+        if cursor.rowcount == 0:
+            return {"success": False, "message": "Шаблон не найден"}
+        
+        return {"success": True, "message": "Шаблон удален"}
+    except Exception as e:
+        logging.error(f"Ошибка при удалении шаблона: {e}")
+        return {"success": False, "message": f"Ошибка при удалении шаблона: {str(e)}"}
+    finally:
+        conn.close()
+
+@metrics.timed_query("users")
+def get_whatif_scenario(cache_key: str) -> Dict[str, Any]:
+    """Получение сгенерированного What-if сценария по ключу"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(
+            "SELECT question, diagram, explanation, tags FROM whatif_scenarios WHERE cache_key = ?",
+            (cache_key,)
+        )
+        row = cursor.fetchone()
+        
+        if not row:
+            return {"success": False, "message": "Сценарий не найден"}
+        
+        return {
+            "success": True,
+            "scenario": {"question": row[0], "diagram": row[1], "explanation": row[2], "tags": json.loads(row[3])}
+        }
+    except Exception as e:
+        logging.error(f"Ошибка при получении сценария: {e}")
+        return {"success": False, "message": f"Ошибка при получении сценария: {str(e)}"}
+    finally:
+        conn.close()
+
+@metrics.timed_query("users")
+def get_whatif_scenarios() -> Dict[str, Any]:
+    """Все сгенерированные What-if сценарии"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("SELECT cache_key, question, diagram, explanation, tags FROM whatif_scenarios ORDER BY created_at")
+        scenarios = [
+            {"cache_key": row[0], "question": row[1], "diagram": row[2], "explanation": row[3], "tags": json.loads(row[4])}
+            for row in cursor.fetchall()
+        ]
+        return {"success": True, "scenarios": scenarios}
+    except Exception as e:
+        logging.error(f"Ошибка при получении сценариев: {e}")
+        return {"success": False, "message": f"Ошибка при получении сценариев: {str(e)}"}
+    finally:
+        conn.close()
+
+@metrics.timed_query("users")
+def save_whatif_scenario(cache_key: str, question: str, diagram: str, explanation: str, tags: List[str]) -> Dict[str, Any]:
+    """Сохранение сгенерированного What-if сценария"""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute(
+            "INSERT OR REPLACE INTO whatif_scenarios (cache_key, question, diagram, explanation, tags, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (cache_key, question, diagram, explanation, json.dumps(tags, ensure_ascii=False), datetime.now().isoformat())
+        )
+        conn.commit()
+        return {"success": True}
+    except Exception as e:
+        logging.error(f"Ошибка при сохранении сценария: {e}")
+        return {"success": False, "message": f"Ошибка при сохранении сценария: {str(e)}"}
+    finally:
+        conn.close()
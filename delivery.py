@@ -0,0 +1,228 @@
+import os
+import gzip
+import zlib
+import hashlib
+import threading
+import mimetypes
+from typing import Dict, Optional
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.requests import Request
+from starlette.responses import Response
+
+# Каталог собранных ассетов (python build_assets.py); без сборки отдается исходный templates/new.html
+ASSETS_DIR = os.getenv("ASSETS_DIR", "static/dist")
+SOURCE_HTML = "templates/new.html"
+# Сжатие JSON-ответов: минимальный размер тела (байт) и уровень gzip
+JSON_COMPRESS_MIN_BYTES = int(os.getenv("JSON_COMPRESS_MIN_BYTES", "1024"))
+JSON_COMPRESS_LEVEL = int(os.getenv("JSON_COMPRESS_LEVEL", "6"))
+
+# Имена ассетов содержат хеш содержимого: изменившийся файл получает новый URL
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Страница всегда перепроверяется по ETag (повторная загрузка - 304 без тела)
+REVALIDATE = "no-cache"
+# Порядок предпочтения кодировок и расширения предсжатых вариантов
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+# Ответы API, которые сжимает JSONCompressionMiddleware (NDJSON - потоки сравнения и пакетного комплаенса)
+JSON_COMPRESSIBLE = ("application/json", "application/x-ndjson")
+
+
+class _File:
+    """Файл в памяти: тело, хеш содержимого и сжатые варианты"""
+
+    def __init__(self, path: str, mtime: int, body: bytes):
+        self.path = path
+        self.mtime = mtime
+        self.body = body
+        self.digest = hashlib.sha256(body).hexdigest()[:16]
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if self.media_type.startswith("text/") or self.media_type == "application/javascript":
+            self.media_type += "; charset=utf-8"
+        self.variants: Dict[str, bytes] = {}
+
+    def etag(self, encoding: Optional[str]) -> str:
+        # Сильный ETag на каждое представление: сжатое и несжатое тела различаются побайтно
+        return f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"'
+
+
+_files: Dict[str, _File] = {}
+_lock = threading.Lock()
+
+
+def _load(path: str) -> Optional[_File]:
+    """Файл из кэша в памяти; перечитывается, если изменился на диске (новая сборка)"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    with _lock:
+        cached = _files.get(path)
+    if cached is not None and cached.mtime == mtime:
+        return cached
+
+    with open(path, "rb") as f:
+        file = _File(path, mtime, f.read())
+    for encoding, ext in ENCODINGS:
+        if os.path.exists(path + ext):
+            with open(path + ext, "rb") as f:
+                file.variants[encoding] = f.read()
+    if "gzip" not in file.variants and file.media_type.startswith(COMPRESSIBLE):
+        # Несобранный исходник: сжимаем один раз при загрузке, а не на каждый запрос
+        file.variants["gzip"] = gzip.compress(file.body, compresslevel=9, mtime=0)
+    with _lock:
+        _files[path] = file
+    return file
+
+
+def _accepted_encodings(header: str) -> Dict[str, float]:
+    """Accept-Encoding -> {кодировка: q}"""
+    accepted = {}
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip().lower()] = q
+    return accepted
+
+
+def _choose_encoding(file: _File, header: str) -> Optional[str]:
+    accepted = _accepted_encodings(header)
+    for encoding, _ in ENCODINGS:
+        if encoding in file.variants and accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def _not_modified(request: Request, etag: str) -> bool:
+    # If-None-Match сравнивается слабо (RFC 9110): прокси могут добавить W/
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag in tags
+
+
+def _respond(request: Request, file: _File, cache_control: str) -> Response:
+    encoding = _choose_encoding(file, request.headers.get("accept-encoding", ""))
+    etag = file.etag(encoding)
+    headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if _not_modified(request, etag):
+        return Response(status_code=304, headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    body = file.variants[encoding] if encoding else file.body
+    return Response(content=body, headers=headers, media_type=file.media_type)
+
+
+def page_response(request: Request) -> Response:
+    """Одностраничный интерфейс: собранный index.html или исходный шаблон"""
+    built = os.path.join(ASSETS_DIR, "index.html")
+    file = _load(built) or _load(SOURCE_HTML)
+    return _respond(request, file, REVALIDATE)
+
+
+def asset_response(request: Request, name: str) -> Optional[Response]:
+    """Ассет сборки с хешем в имени; None, если такого файла нет"""
+    if os.path.basename(name) != name or name.startswith(".") or name.endswith((".gz", ".br")):
+        return None
+    file = _load(os.path.join(ASSETS_DIR, name))
+    if file is None:
+        return None
+    return _respond(request, file, IMMUTABLE)
+
+
+def warm_up():
+    """Чтение страницы и ее ассетов в память до первого запроса"""
+    file = _load(os.path.join(ASSETS_DIR, "index.html")) or _load(SOURCE_HTML)
+    if file is None:
+        raise FileNotFoundError(SOURCE_HTML)
+    if os.path.isdir(ASSETS_DIR):
+        for name in os.listdir(ASSETS_DIR):
+            if name.startswith("app") and not name.endswith((".gz", ".br")):
+                _load(os.path.join(ASSETS_DIR, name))
+
+
+class JSONCompressionMiddleware:
+    """ASGI-middleware: gzip для JSON- и NDJSON-ответов крупнее JSON_COMPRESS_MIN_BYTES
+
+    Ответ из одного чанка сжимается целиком (с Content-Length). Потоковый ответ
+    сжимается по частям с Z_SYNC_FLUSH: каждый чанк уходит клиенту сразу и
+    распаковывается без ожидания конца потока.
+    """
+
+    def __init__(self, app, minimum_size: int = JSON_COMPRESS_MIN_BYTES, level: int = JSON_COMPRESS_LEVEL):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _accepts_gzip(scope):
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor = None
+        passthrough = False
+
+        async def send_wrapper(message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                # Заголовки откладываются до первого чанка тела: от него зависит, сжимать ли
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if compressor is not None:
+                data = compressor.compress(body)
+                data += compressor.flush(zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+                await send({"type": "http.response.body", "body": data, "more_body": more_body})
+                return
+
+            headers = MutableHeaders(scope=start_message)
+            eligible = (
+                start_message["status"] not in (204, 304)
+                and headers.get("content-type", "").startswith(JSON_COMPRESSIBLE)
+                and "content-encoding" not in headers
+            )
+            if not eligible or (not more_body and len(body) < self.minimum_size):
+                passthrough = True
+                await send(start_message)
+                await send(message)
+                return
+
+            headers["Content-Encoding"] = "gzip"
+            headers.add_vary_header("Accept-Encoding")
+            if not more_body:
+                data = gzip.compress(body, compresslevel=self.level, mtime=0)
+                headers["Content-Length"] = str(len(data))
+                await send(start_message)
+                await send({"type": "http.response.body", "body": data})
+                return
+
+            # wbits=31: формат gzip (заголовок и CRC), а не голый deflate
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+            if "content-length" in headers:
+                del headers["Content-Length"]
+            await send(start_message)
+            data = compressor.compress(body) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            await send({"type": "http.response.body", "body": data, "more_body": True})
+
+        await self.app(scope, receive, send_wrapper)
+
+
+def _accepts_gzip(scope) -> bool:
+    accepted = _accepted_encodings(Headers(scope=scope).get("accept-encoding", ""))
+    return accepted.get("gzip", accepted.get("*", 0.0)) > 0
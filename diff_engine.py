@@ -0,0 +1,387 @@
+import os
+import re
+import hashlib
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Sequence, Tuple
+
+import metrics
+import tracing
+
+# Предел числа правок для одного участка без якорей; выше - участок считается замененным целиком
+DIFF_MAX_EDIT_DISTANCE = int(os.getenv("DIFF_MAX_EDIT_DISTANCE", "2000"))
+# Минимальная длина строки, чтобы считать ее перемещенным пунктом, а не совпадением шаблонной строки
+DIFF_MOVE_MIN_CHARS = int(os.getenv("DIFF_MOVE_MIN_CHARS", "20"))
+# Строк контекста вокруг изменений в блоке (hunk)
+DIFF_CONTEXT_LINES = int(os.getenv("DIFF_CONTEXT_LINES", "3"))
+# Число последних сравнений в памяти - для постраничной выдачи по курсору без пересчета
+COMPARE_CACHE_SIZE = int(os.getenv("COMPARE_CACHE_SIZE", "8"))
+
+WORD_RE = re.compile(r"\w+|\s+|[^\w\s]", re.UNICODE)
+
+# Опкод: (тег, a_начало, a_конец, b_начало, b_конец); теги equal, delete, insert, replace
+Opcode = Tuple[str, int, int, int, int]
+
+
+def _intern(a_items: Sequence[Hashable], b_items: Sequence[Hashable]) -> Tuple[List[int], List[int]]:
+    """Замена элементов целыми id: дальше сравниваются числа, а не строки"""
+    ids: Dict[Hashable, int] = {}
+    a = [ids.setdefault(item, len(ids)) for item in a_items]
+    b = [ids.setdefault(item, len(ids)) for item in b_items]
+    return a, b
+
+
+def _myers(a: List[int], a_lo: int, a_hi: int, b: List[int], b_lo: int, b_hi: int) -> Optional[List[Tuple[str, int, int]]]:
+    """Алгоритм Майерса O(ND) на участке. None, если правок больше DIFF_MAX_EDIT_DISTANCE
+
+    Возвращает поэлементный сценарий: (equal, i, j), (delete, i, -1), (insert, -1, j).
+    """
+    n, m = a_hi - a_lo, b_hi - b_lo
+    max_d = min(n + m, DIFF_MAX_EDIT_DISTANCE)
+    v = {1: 0}
+    trace = []
+    for d in range(max_d + 1):
+        trace.append(v.copy())
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m, a_lo, b_lo)
+    return None
+
+
+def _backtrack(trace: List[Dict[int, int]], n: int, m: int, a_lo: int, b_lo: int) -> List[Tuple[str, int, int]]:
+    script = []
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v.get(k - 1, -1) < v.get(k + 1, -1)):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v.get(prev_k, 0)
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            script.append(("equal", a_lo + x, b_lo + y))
+        if d > 0:
+            if x == prev_x:
+                script.append(("insert", -1, b_lo + prev_y))
+            else:
+                script.append(("delete", a_lo + prev_x, -1))
+        x, y = prev_x, prev_y
+    script.reverse()
+    return script
+
+
+def _unique_anchors(a: List[int], a_lo: int, a_hi: int, b: List[int], b_lo: int, b_hi: int) -> List[Tuple[int, int]]:
+    """Якоря patience diff: строки, уникальные в обоих участках, в порядке наибольшей возрастающей подпоследовательности"""
+    counts: Dict[int, List[int]] = {}
+    for i in range(a_lo, a_hi):
+        entry = counts.get(a[i])
+        if entry is None:
+            counts[a[i]] = [1, 0, i, -1]
+        else:
+            entry[0] += 1
+    for j in range(b_lo, b_hi):
+        entry = counts.get(b[j])
+        if entry is not None:
+            entry[1] += 1
+            entry[3] = j
+
+    pairs = sorted((entry[2], entry[3]) for entry in counts.values() if entry[0] == 1 and entry[1] == 1)
+    if not pairs:
+        return []
+
+    # Наибольшая возрастающая подпоследовательность по позициям в b (patience sorting)
+    tails: List[int] = []
+    tail_index: List[int] = []
+    previous = [-1] * len(pairs)
+    for index, (_, j) in enumerate(pairs):
+        pos = bisect_left(tails, j)
+        if pos == len(tails):
+            tails.append(j)
+            tail_index.append(index)
+        else:
+            tails[pos] = j
+            tail_index[pos] = index
+        previous[index] = tail_index[pos - 1] if pos > 0 else -1
+
+    anchors = []
+    index = tail_index[-1]
+    while index != -1:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def _diff_region(a: List[int], a_lo: int, a_hi: int, b: List[int], b_lo: int, b_hi: int, out: List[Tuple[str, int, int]]):
+    """Рекурсивный patience diff с Майерсом на участках без уникальных якорей"""
+    # Общие префикс и суффикс снимаются без поиска
+    while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+        out.append(("equal", a_lo, b_lo))
+        a_lo += 1
+        b_lo += 1
+    suffix = []
+    while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+        a_hi -= 1
+        b_hi -= 1
+        suffix.append(("equal", a_hi, b_hi))
+
+    if a_lo == a_hi or b_lo == b_hi:
+        out.extend(("delete", i, -1) for i in range(a_lo, a_hi))
+        out.extend(("insert", -1, j) for j in range(b_lo, b_hi))
+    else:
+        anchors = _unique_anchors(a, a_lo, a_hi, b, b_lo, b_hi)
+        if anchors:
+            for i, j in anchors:
+                _diff_region(a, a_lo, i, b, b_lo, j, out)
+                out.append(("equal", i, j))
+                a_lo, b_lo = i + 1, j + 1
+            _diff_region(a, a_lo, a_hi, b, b_lo, b_hi, out)
+        else:
+            script = _myers(a, a_lo, a_hi, b, b_lo, b_hi)
+            if script is None:
+                out.extend(("delete", i, -1) for i in range(a_lo, a_hi))
+                out.extend(("insert", -1, j) for j in range(b_lo, b_hi))
+            else:
+                out.extend(script)
+
+    suffix.reverse()
+    out.extend(suffix)
+
+
+def diff_sequences(a_items: Sequence[Hashable], b_items: Sequence[Hashable]) -> List[Opcode]:
+    """Опкоды различий двух последовательностей (как у difflib.SequenceMatcher.get_opcodes)"""
+    a, b = _intern(a_items, b_items)
+    script: List[Tuple[str, int, int]] = []
+    _diff_region(a, 0, len(a), b, 0, len(b), script)
+
+    opcodes: List[Opcode] = []
+    i = j = 0
+    for tag, ai, bj in script:
+        if tag == "equal":
+            if opcodes and opcodes[-1][0] == "equal":
+                opcodes[-1] = ("equal", opcodes[-1][1], ai + 1, opcodes[-1][3], bj + 1)
+            else:
+                opcodes.append(("equal", ai, ai + 1, bj, bj + 1))
+            i, j = ai + 1, bj + 1
+            continue
+
+        if tag == "delete":
+            i_end, j_end = ai + 1, j
+        else:
+            i_end, j_end = i, bj + 1
+        if opcodes and opcodes[-1][0] != "equal":
+            _, i1, _, j1, _ = opcodes[-1]
+            opcodes[-1] = ("change", i1, i_end, j1, j_end)
+        else:
+            opcodes.append(("change", i, i_end, j, j_end))
+        i, j = i_end, j_end
+
+    result = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "change":
+            tag = "replace" if i1 < i2 and j1 < j2 else ("delete" if i1 < i2 else "insert")
+        result.append((tag, i1, i2, j1, j2))
+    return result
+
+
+def detect_moves(a_lines: Sequence[str], b_lines: Sequence[str], opcodes: List[Opcode]) -> Tuple[Dict[int, int], Dict[int, int]]:
+    """Перемещенные пункты: удаленная строка, вставленная без изменений в другом месте
+
+    Возвращает (строка a -> строка b, строка b -> строка a).
+    """
+    removed: Dict[str, List[int]] = {}
+    for tag, i1, i2, _, _ in opcodes:
+        if tag in ("delete", "replace"):
+            for i in range(i1, i2):
+                key = a_lines[i].strip()
+                if len(key) >= DIFF_MOVE_MIN_CHARS:
+                    removed.setdefault(key, []).append(i)
+
+    moved_from: Dict[int, int] = {}
+    moved_to: Dict[int, int] = {}
+    if not removed:
+        return moved_from, moved_to
+    for tag, _, _, j1, j2 in opcodes:
+        if tag in ("insert", "replace"):
+            for j in range(j1, j2):
+                candidates = removed.get(b_lines[j].strip())
+                if candidates:
+                    i = candidates.pop(0)
+                    moved_from[i] = j
+                    moved_to[j] = i
+    return moved_from, moved_to
+
+
+def word_diff(a_line: str, b_line: str) -> List[Dict[str, str]]:
+    """Пословные различия двух строк"""
+    a_words = WORD_RE.findall(a_line)
+    b_words = WORD_RE.findall(b_line)
+    parts = []
+    for tag, i1, i2, j1, j2 in diff_sequences(a_words, b_words):
+        if tag == "equal":
+            parts.append({"type": "unchanged", "text": "".join(a_words[i1:i2])})
+            continue
+        if i1 < i2:
+            parts.append({"type": "removed", "text": "".join(a_words[i1:i2])})
+        if j1 < j2:
+            parts.append({"type": "added", "text": "".join(b_words[j1:j2])})
+    return parts
+
+
+def iter_entries(a_lines: Sequence[str], b_lines: Sequence[str], opcodes: List[Opcode], moves: Tuple[Dict[int, int], Dict[int, int]]) -> Iterator[Dict[str, Any]]:
+    """Построчные записи различий. Пословный diff считается лениво - только для выдаваемых замен"""
+    moved_from, moved_to = moves
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal":
+            for offset in range(i2 - i1):
+                yield {"type": "unchanged", "text": a_lines[i1 + offset], "a_line": i1 + offset, "b_line": j1 + offset}
+            continue
+
+        # В замене строки сопоставляются попарно по порядку (кроме перемещенных)
+        paired = tag == "replace"
+        for i in range(i1, i2):
+            entry = {"type": "removed", "text": a_lines[i], "a_line": i}
+            if i in moved_from:
+                entry["moved_to"] = moved_from[i]
+            elif paired and j1 + (i - i1) < j2 and (j1 + (i - i1)) not in moved_to:
+                entry["replaced_by"] = j1 + (i - i1)
+            yield entry
+
+        for j in range(j1, j2):
+            entry = {"type": "added", "text": b_lines[j], "b_line": j}
+            i = i1 + (j - j1)
+            if j in moved_to:
+                entry["moved_from"] = moved_to[j]
+            elif paired and i < i2 and i not in moved_from:
+                # Пословный diff парной строки считается только здесь, при выдаче
+                entry["replaces"] = i
+                entry["words"] = word_diff(a_lines[i], b_lines[j])
+            yield entry
+
+
+def group_hunks(opcodes: List[Opcode], context: int = DIFF_CONTEXT_LINES) -> Tuple[List[List[Opcode]], int, int]:
+    """Группировка опкодов в блоки с context строками вокруг изменений
+
+    За тот же проход считаются добавленные и удаленные строки. Возвращает (блоки, added, removed).
+    """
+    hunks: List[List[Opcode]] = []
+    group: List[Opcode] = []
+    added = removed = 0
+    last = len(opcodes) - 1
+    for index, (tag, i1, i2, j1, j2) in enumerate(opcodes):
+        if tag != "equal":
+            removed += i2 - i1
+            added += j2 - j1
+            group.append((tag, i1, i2, j1, j2))
+            continue
+
+        if group:
+            if index < last and i2 - i1 <= 2 * context:
+                # Короткий общий участок не разрывает блок
+                group.append((tag, i1, i2, j1, j2))
+                continue
+            # Хвост контекста закрывает текущий блок
+            tail = min(i2 - i1, context)
+            if tail:
+                group.append(("equal", i1, i1 + tail, j1, j1 + tail))
+            hunks.append(group)
+            group = []
+        # Голова контекста для следующего блока
+        if index < last:
+            head = min(i2 - i1, context)
+            if head:
+                group.append(("equal", i2 - head, i2, j2 - head, j2))
+    if group and any(code[0] != "equal" for code in group):
+        hunks.append(group)
+    return hunks, added, removed
+
+
+@tracing.traced("diff.compare")
+def compare_texts(doc_a: str, doc_b: str, context: int = DIFF_CONTEXT_LINES) -> Dict[str, Any]:
+    """Построчное сравнение двух текстов: блоки изменений, перемещения и счетчики"""
+    a_lines = doc_a.splitlines()
+    b_lines = doc_b.splitlines()
+    opcodes = diff_sequences(a_lines, b_lines)
+    moves = detect_moves(a_lines, b_lines, opcodes)
+    hunks, added, removed = group_hunks(opcodes, context)
+
+    return {
+        "a_lines": a_lines,
+        "b_lines": b_lines,
+        "hunks": hunks,
+        "moves": moves,
+        "added": added,
+        "removed": removed,
+        "moved": len(moves[0]),
+    }
+
+
+_compare_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_compare_cache_lock = threading.Lock()
+
+
+def compare_cached(doc_a: str, doc_b: str, context: int = DIFF_CONTEXT_LINES) -> Dict[str, Any]:
+    """compare_texts с LRU-кэшем по хешу документов: следующие страницы не пересчитывают diff"""
+    digest = hashlib.sha256()
+    for part in (doc_a, "\0", doc_b, "\0", str(context)):
+        digest.update(part.encode("utf-8", errors="surrogatepass"))
+    key = digest.hexdigest()
+
+    with _compare_cache_lock:
+        result = _compare_cache.get(key)
+        if result is not None:
+            _compare_cache.move_to_end(key)
+    metrics.cache_lookup("compare", result is not None)
+    if result is not None:
+        return result
+
+    result = compare_texts(doc_a, doc_b, context)
+    with _compare_cache_lock:
+        _compare_cache[key] = result
+        while len(_compare_cache) > COMPARE_CACHE_SIZE:
+            _compare_cache.popitem(last=False)
+    return result
+
+
+def build_hunk(result: Dict[str, Any], index: int) -> Dict[str, Any]:
+    """Блок изменений с номерами строк (с нуля) и записями для вывода"""
+    group = result["hunks"][index]
+    return {
+        "index": index,
+        "a_start": group[0][1],
+        "a_end": group[-1][2],
+        "b_start": group[0][3],
+        "b_end": group[-1][4],
+        "lines": list(iter_entries(result["a_lines"], result["b_lines"], group, result["moves"])),
+    }
+
+
+def iter_hunks(result: Dict[str, Any], start: int = 0, limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """Блоки изменений по одному, начиная с start: в памяти держится только текущий"""
+    end = len(result["hunks"]) if limit is None else min(len(result["hunks"]), start + limit)
+    for index in range(start, end):
+        yield build_hunk(result, index)
+
+
+def summarize(result: Dict[str, Any]) -> str:
+    """Краткий отчет о различиях"""
+    added = result["added"]
+    removed = result["removed"]
+    summary = f"Найдено {added + removed} изменений: {added} добавлений, {removed} удалений."
+    if result["moved"]:
+        summary += f" Перемещено строк: {result['moved']}."
+    return summary
@@ -0,0 +1,41 @@
+import os
+import logging
+from typing import Optional
+
+# Каталог загруженных файлов (см. /api/upload)
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+
+
+def resolve_upload(document_id: str) -> Optional[str]:
+    """Путь к загруженному документу по его id (имени файла) или None"""
+    filename = os.path.basename(document_id)
+    if not filename:
+        return None
+    path = os.path.join(UPLOAD_DIR, filename)
+    return path if os.path.isfile(path) else None
+
+
+def warm_up():
+    """Импорт библиотеки PDF заранее (при первом извлечении текста он не нужен)"""
+    try:
+        import PyPDF2
+    except ImportError:
+        logging.warning("PyPDF2 не установлен: текст из PDF извлекаться не будет")
+
+
+def extract_text(path: str) -> str:
+    """Извлечение текста из загруженного файла (PDF или текст)"""
+    if path.lower().endswith(".pdf"):
+        from PyPDF2 import PdfReader
+        reader = PdfReader(path)
+        return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+    with open(path, "rb") as f:
+        data = f.read()
+    for encoding in ("utf-8", "cp1251"):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    logging.warning(f"Не удалось определить кодировку {path}, символы будут заменены")
+    return data.decode("utf-8", errors="replace")
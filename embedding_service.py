@@ -0,0 +1,191 @@
+import os
+import time
+import queue
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+import embeddings
+import metrics
+
+# Сколько пакет ждет попутные запросы после первого (миллисекунды)
+EMBEDDING_BATCH_MAX_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_MAX_WAIT_MS", "5"))
+# Максимум текстов в одном пакете
+EMBEDDING_BATCH_MAX_SIZE = int(os.getenv("EMBEDDING_BATCH_MAX_SIZE", "32"))
+# Сколько эмбеддингов запросов держим в LRU-кеше
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+
+_STOP = object()
+
+
+def normalize(text: str) -> str:
+    """Ключ кеша и текст для кодирования: пробелы схлопнуты"""
+    return " ".join(text.split())
+
+
+class EmbeddingService:
+    """Пакетное кодирование запросов в отдельном потоке
+
+    Запросы из любых потоков и корутин попадают в очередь; поток сервиса
+    берет первый, ждет попутные до max_wait_ms или max_batch штук и кодирует
+    их одним вызовом. Пока идет кодирование, очередь копит следующий пакет.
+    Кодирование всегда в одном потоке: параллельные вызовы модели не делят ядра.
+    """
+
+    def __init__(self, max_wait_ms: float = EMBEDDING_BATCH_MAX_WAIT_MS, max_batch: int = EMBEDDING_BATCH_MAX_SIZE,
+                 cache_size: int = EMBEDDING_CACHE_SIZE, encode: Optional[Callable[[List[str]], np.ndarray]] = None):
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max(1, max_batch)
+        self.cache_size = cache_size
+        self.encode_batch = encode or embeddings.encode
+        self._reset()
+
+    def _reset(self):
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, text: str) -> Future:
+        """Future с L2-нормированным вектором текста (только для чтения)"""
+        key = normalize(text)
+        with self._cache_lock:
+            vector = self._cache.get(key)
+            if vector is not None:
+                self._cache.move_to_end(key)
+        metrics.cache_lookup("embedding_query", vector is not None)
+        future: Future = Future()
+        if vector is not None:
+            future.set_result(vector)
+            return future
+        self._ensure_started()
+        self._queue.put((key, future, time.perf_counter()))
+        return future
+
+    def encode(self, text: str) -> np.ndarray:
+        """Вектор текста (блокирует вызывающий поток до готовности пакета)"""
+        return self.submit(text).result()
+
+    async def encode_async(self, text: str) -> np.ndarray:
+        """Вектор текста без блокировки цикла событий"""
+        return await asyncio.wrap_future(self.submit(text))
+
+    def _ensure_started(self):
+        # Поток перезапускается, если он неожиданно завершился: иначе запросы в очереди ждали бы вечно
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Остановка потока после обработки уже поставленных запросов"""
+        with self._start_lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(_STOP)
+            thread.join()
+
+    def _collect(self) -> Tuple[List[tuple], bool]:
+        # Первый запрос ждем без ограничения, попутные - до дедлайна; уже накопленные забираем сразу
+        first = self._queue.get()
+        if first is _STOP:
+            return [], True
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._collect()
+            if not batch:
+                continue
+            try:
+                self._process(batch)
+            except Exception as e:
+                logging.error(f"Ошибка обработки пакета эмбеддингов: {e}")
+
+    def _process(self, batch: List[tuple]):
+        # Отмененные ожидающие (клиент отключился, сработал таймаут) из пакета выбрасываются
+        batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        started = time.perf_counter()
+        for _, _, enqueued in batch:
+            metrics.EMBEDDING_QUEUE_WAIT.observe(started - enqueued)
+        # Одинаковые одновременные запросы кодируются один раз
+        texts = list(dict.fromkeys(key for key, _, _ in batch))
+        metrics.EMBEDDING_BATCH_SIZE.observe(len(texts))
+        try:
+            matrix = self.encode_batch(texts)
+        except Exception as e:
+            logging.error(f"Ошибка пакетного кодирования эмбеддингов: {e}")
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        vectors = {}
+        for text, row in zip(texts, matrix):
+            # Копия строки: кеш не держит всю матрицу пакета, вызывающий код не может ее изменить
+            vector = np.array(row, dtype=np.float32)
+            vector.setflags(write=False)
+            vectors[text] = vector
+        with self._cache_lock:
+            self._cache.update(vectors)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        for key, future, _ in batch:
+            future.set_result(vectors[key])
+
+
+_service = EmbeddingService()
+
+
+def get_service() -> EmbeddingService:
+    """Общий сервис кодирования запросов"""
+    return _service
+
+
+def set_service(service: EmbeddingService):
+    """Подмена сервиса (например, с другими параметрами пакетов в тестах и бенчмарках)"""
+    global _service
+    _service = service
+
+
+def encode_query(text: str) -> np.ndarray:
+    """Вектор поискового запроса через пакетное кодирование и LRU-кеш"""
+    return _service.encode(text)
+
+
+async def encode_query_async(text: str) -> np.ndarray:
+    return await _service.encode_async(text)
+
+
+def shutdown():
+    _service.stop()
+
+
+def _reset_after_fork():
+    # Поток сервиса в дочерний процесс не переходит, очередь и локи могли остаться в состоянии родителя
+    _service._reset()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
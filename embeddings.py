@@ -0,0 +1,91 @@
+import os
+import re
+import sys
+import hashlib
+import logging
+import threading
+from typing import List
+
+import numpy as np
+
+import tracing
+
+# Модель для эмбеддингов (та же, что использует rag_indexer)
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+
+# auto - sentence_transformers, если установлен, иначе локальная заглушка
+# stub - всегда заглушка (для тестов и офлайн-бенчмарков)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "auto")
+
+# Размерность векторов заглушки совпадает с all-MiniLM-L6-v2
+STUB_DIMENSION = 384
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """Ленивая загрузка модели SentenceTransformer. Возвращает None, если используется заглушка"""
+    global _model
+    if EMBEDDING_BACKEND == "stub":
+        return None
+    # False - загрузка уже не удалась, работаем на локальных эмбеддингах
+    if _model is not None:
+        return _model or None
+    with _model_lock:
+        if _model is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+                _model = SentenceTransformer(EMBEDDING_MODEL)
+                logging.info(f"Модель эмбеддингов загружена: {EMBEDDING_MODEL}")
+            except ImportError:
+                logging.warning("sentence_transformers не установлен. Используем локальные эмбеддинги.")
+                _model = False
+            except Exception as e:
+                logging.error(f"Ошибка загрузки модели эмбеддингов: {e}")
+                _model = False
+    return _model or None
+
+
+def set_threads(count: int):
+    """Число потоков torch для кодирования в этом процессе (если torch уже загружен)"""
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        torch.set_num_threads(max(1, count))
+
+
+def backend_id() -> str:
+    """Чем кодируются тексты: векторы разных моделей несовместимы (ключ кешей)"""
+    return EMBEDDING_MODEL if get_model() is not None else f"stub-{STUB_DIMENSION}"
+
+
+def _stub_encode(texts: List[str]) -> np.ndarray:
+    """Детерминированные эмбеддинги на основе хеширования слов и триграмм"""
+    vectors = np.zeros((len(texts), STUB_DIMENSION), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in _TOKEN_RE.findall(text.lower()):
+            features = [word] + [word[i:i + 3] for i in range(max(1, len(word) - 2))]
+            for feature in features:
+                digest = hashlib.md5(feature.encode("utf-8")).digest()
+                index = int.from_bytes(digest[:4], "little") % STUB_DIMENSION
+                vectors[row, index] += 1.0 if digest[4] & 1 else -1.0
+    return vectors
+
+
+@tracing.traced("embeddings.encode")
+def encode(texts: List[str]) -> np.ndarray:
+    """Кодирование списка текстов в L2-нормированную матрицу float32"""
+    if not texts:
+        return np.zeros((0, STUB_DIMENSION), dtype=np.float32)
+
+    model = get_model()
+    if model is not None:
+        vectors = np.asarray(model.encode(texts, batch_size=32, show_progress_bar=False), dtype=np.float32)
+    else:
+        vectors = _stub_encode(texts)
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
@@ -0,0 +1,458 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+import metrics
+
+# Путь к базе задач
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "jobs.db")
+# Аренда задачи: если воркер не продлил ее, задача возвращается в очередь
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+# Пауза между опросами пустой очереди
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.5"))
+# Базовая задержка повтора (удваивается с каждой попыткой)
+JOB_RETRY_BASE_DELAY = float(os.getenv("JOB_RETRY_BASE_DELAY", "2"))
+# Выполнять ли задачи в этом процессе (при нескольких воркерах serve.py включает очередь не во всех)
+JOBS_ENABLED = os.getenv("JOBS_ENABLED", "1") == "1"
+
+CPU_COUNT = os.cpu_count() or 2
+
+# Параллелизм по очередям; переопределяется JOB_QUEUE_CONCURRENCY="video=8,analysis=2"
+QUEUE_CONCURRENCY = {
+    "default": 2,
+    "video": 8,
+    "analysis": CPU_COUNT,
+    "index": 1,
+}
+for item in filter(None, os.getenv("JOB_QUEUE_CONCURRENCY", "").split(",")):
+    name, _, value = item.partition("=")
+    QUEUE_CONCURRENCY[name.strip()] = int(value)
+
+# Зарегистрированные обработчики: kind -> {func, queue, executor, max_attempts}
+HANDLERS: Dict[str, Dict[str, Any]] = {}
+
+_thread_pool: Optional[ThreadPoolExecutor] = None
+_process_pool: Optional[ProcessPoolExecutor] = None
+_workers: List["asyncio.Task"] = []
+_wakeup: Dict[str, "asyncio.Event"] = {}
+_running: Dict[str, float] = {}
+_worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+_loop: Optional[asyncio.AbstractEventLoop] = None
+# Записи состояния задач из цикла событий идут через один поток: цикл не ждет
+# блокировку базы, а прогресс и итоговый статус задачи пишутся в порядке вызова
+_writer: Optional[ThreadPoolExecutor] = None
+
+
+def _reset_after_fork():
+    # Воркеры, форкнутые от одного мастера, не должны делить аренды задач
+    global _worker_id, _writer
+    _worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    _writer = None
+
+
+def _get_writer() -> ThreadPoolExecutor:
+    global _writer
+    if _writer is None:
+        _writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs-writer")
+    return _writer
+
+
+def _log_write_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"Ошибка записи состояния задачи: {future.exception()}")
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(JOBS_DB_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def init_db():
+    """Создание таблицы задач"""
+    conn = _connect()
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            queue TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            idempotency_key TEXT UNIQUE,
+            progress REAL NOT NULL DEFAULT 0,
+            message TEXT,
+            result TEXT,
+            error TEXT,
+            run_after REAL NOT NULL DEFAULT 0,
+            locked_by TEXT,
+            lease_until REAL,
+            created_at TEXT NOT NULL,
+            updated_at TEXT NOT NULL
+        )
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (queue, status, run_after)")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+class JobContext:
+    """Контекст выполняемой задачи: прогресс и сохранение промежуточного состояния
+
+    Сериализуется в процесс-воркер, поэтому хранит только идентификаторы.
+    """
+
+    def __init__(self, job_id: str, state: Dict[str, Any], db_path: str = JOBS_DB_PATH):
+        self.job_id = job_id
+        self.state = state
+        self.db_path = db_path
+
+    def _execute(self, sql: str, params: tuple):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # Поток или процесс-воркер: можно ждать базу на месте
+            self._write(sql, params)
+            return
+        # async-обработчик: запись в фоне, цикл событий не блокируется
+        _get_writer().submit(self._write, sql, params).add_done_callback(_log_write_error)
+
+    def _write(self, sql: str, params: tuple):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            conn.execute(sql, params)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def report(self, progress: float, message: Optional[str] = None):
+        """Отчет о прогрессе (0..1). Заодно продлевает аренду задачи"""
+        self._execute(
+            "UPDATE jobs SET progress = ?, message = COALESCE(?, message), lease_until = ?, updated_at = ? WHERE id = ?",
+            (max(0.0, min(1.0, progress)), message, time.time() + JOB_LEASE_SECONDS, datetime.now().isoformat(), self.job_id)
+        )
+
+    def checkpoint(self, **state):
+        """Сохранение состояния, переживающего перезапуск (например, внешний id)"""
+        self.state.update(state)
+        self._execute(
+            "UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(self.state, ensure_ascii=False), datetime.now().isoformat(), self.job_id)
+        )
+
+
+def handler(kind: str, queue: str = "default", executor: str = "async", max_attempts: int = 3):
+    """Регистрация обработчика задач
+
+    executor: async - корутина в цикле событий, thread - пул потоков,
+    process - пул процессов (функция должна быть на уровне модуля).
+    Обработчик получает (ctx: JobContext, payload: dict) и возвращает JSON-совместимый результат.
+    """
+    def decorator(func: Callable):
+        HANDLERS[kind] = {"func": func, "queue": queue, "executor": executor, "max_attempts": max_attempts}
+        QUEUE_CONCURRENCY.setdefault(queue, 1)
+        return func
+    return decorator
+
+
+def _row_to_job(row: sqlite3.Row) -> Dict[str, Any]:
+    return {
+        "id": row["id"],
+        "kind": row["kind"],
+        "queue": row["queue"],
+        "status": row["status"],
+        "attempts": row["attempts"],
+        "progress": row["progress"],
+        "message": row["message"],
+        "result": json.loads(row["result"]) if row["result"] else None,
+        "error": row["error"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+    }
+
+
+@metrics.timed_query("jobs")
+def enqueue(kind: str, payload: Dict[str, Any], idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+    """Постановка задачи в очередь. С тем же idempotency_key возвращается уже созданная задача"""
+    if kind not in HANDLERS:
+        raise ValueError(f"Неизвестный тип задачи: {kind}")
+    spec = HANDLERS[kind]
+    now = datetime.now().isoformat()
+    job_id = uuid.uuid4().hex
+
+    conn = _connect()
+    try:
+        if idempotency_key:
+            row = conn.execute("SELECT * FROM jobs WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+            if row:
+                return _row_to_job(row)
+        try:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, queue, payload, status, max_attempts, idempotency_key, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, kind, spec["queue"], json.dumps(payload, ensure_ascii=False), spec["max_attempts"], idempotency_key, now, now)
+            )
+            conn.commit()
+        except sqlite3.IntegrityError:
+            # Параллельный запрос с тем же ключом успел раньше
+            row = conn.execute("SELECT * FROM jobs WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+            return _row_to_job(row)
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+
+    _wake(spec["queue"])
+    return _row_to_job(row)
+
+
+def _wake(queue: str):
+    """Разбудить воркеры очереди; enqueue может вызываться и из потоков"""
+    event = _wakeup.get(queue)
+    if event is None or _loop is None or _loop.is_closed():
+        return
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is _loop:
+        event.set()
+    else:
+        _loop.call_soon_threadsafe(event.set)
+
+
+@metrics.timed_query("jobs")
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Состояние задачи"""
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _row_to_job(row) if row else None
+    finally:
+        conn.close()
+
+
+@metrics.timed_query("jobs")
+def _claim(queue: str) -> Optional[sqlite3.Row]:
+    """Атомарный захват следующей готовой задачи очереди"""
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE queue = ? AND status = 'queued' AND run_after <= ? ORDER BY created_at LIMIT 1",
+            (queue, now)
+        ).fetchone()
+        if row is None:
+            conn.rollback()
+            return None
+        conn.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_by = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+            (_worker_id, now + JOB_LEASE_SECONDS, datetime.now().isoformat(), row["id"])
+        )
+        conn.commit()
+        return conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+    finally:
+        conn.close()
+
+
+@metrics.timed_query("jobs")
+def _finish(job_id: str, status: str, result: Any = None, error: Optional[str] = None, run_after: float = 0):
+    conn = _connect()
+    try:
+        # Только владелец аренды: после ее истечения задачу мог взять другой воркер
+        cursor = conn.execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, run_after = ?, progress = CASE WHEN ? = 'completed' THEN 1 ELSE progress END, "
+            "locked_by = NULL, lease_until = NULL, updated_at = ? WHERE id = ? AND locked_by = ?",
+            (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, run_after, status,
+             datetime.now().isoformat(), job_id, _worker_id)
+        )
+        conn.commit()
+        if not cursor.rowcount:
+            logging.warning(f"Результат задачи {job_id} отброшен: аренда истекла и задача передана другому воркеру")
+    finally:
+        conn.close()
+
+
+async def _finish_async(job_id: str, status: str, **kwargs):
+    # Через поток записи: после уже отправленных отчетов о прогрессе этой задачи
+    await asyncio.get_running_loop().run_in_executor(_get_writer(), functools.partial(_finish, job_id, status, **kwargs))
+
+
+def recover_expired():
+    """Возврат в очередь задач, чья аренда истекла (воркер упал или перезапущен)
+
+    Задача, исчерпавшая попытки, помечается failed: иначе задача, роняющая
+    воркер, перезапускалась бы бесконечно.
+    """
+    now, expired = datetime.now().isoformat(), time.time()
+    conn = _connect()
+    try:
+        failed = conn.execute(
+            "UPDATE jobs SET status = 'failed', error = 'Аренда истекла: воркер завершился во время выполнения', "
+            "locked_by = NULL, lease_until = NULL, updated_at = ? "
+            "WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts",
+            (now, expired)
+        ).rowcount
+        cursor = conn.execute(
+            "UPDATE jobs SET status = 'queued', locked_by = NULL, lease_until = NULL, updated_at = ? "
+            "WHERE status = 'running' AND lease_until < ?",
+            (now, expired)
+        )
+        conn.commit()
+        if cursor.rowcount:
+            logging.warning(f"Восстановлено прерванных задач: {cursor.rowcount}")
+        if failed:
+            logging.error(f"Прерванных задач без оставшихся попыток: {failed}")
+    finally:
+        conn.close()
+
+
+def _extend_leases():
+    """Продление аренды задач, выполняемых этим воркером"""
+    if not _running:
+        return
+    conn = _connect()
+    try:
+        conn.executemany(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND locked_by = ?",
+            [(time.time() + JOB_LEASE_SECONDS, job_id, _worker_id) for job_id in _running]
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def _execute(row: sqlite3.Row):
+    spec = HANDLERS.get(row["kind"])
+    if spec is None:
+        await _finish_async(row["id"], "failed", error=f"Нет обработчика для {row['kind']}")
+        return
+
+    ctx = JobContext(row["id"], json.loads(row["state"] or "{}"))
+    payload = json.loads(row["payload"])
+    func = spec["func"]
+    loop = asyncio.get_running_loop()
+    _running[row["id"]] = time.time()
+    try:
+        if spec["executor"] == "process":
+            result = await loop.run_in_executor(_process_pool, func, ctx, payload)
+        elif spec["executor"] == "thread":
+            result = await loop.run_in_executor(_thread_pool, functools.partial(func, ctx, payload))
+        else:
+            result = await func(ctx, payload)
+        await _finish_async(row["id"], "completed", result=result)
+    except Exception as e:
+        logging.error(f"Ошибка выполнения задачи {row['kind']} ({row['id']}): {e}")
+        if row["attempts"] < row["max_attempts"]:
+            delay = JOB_RETRY_BASE_DELAY * (2 ** (row["attempts"] - 1))
+            await _finish_async(row["id"], "queued", error=str(e), run_after=time.time() + delay)
+        else:
+            await _finish_async(row["id"], "failed", error=str(e))
+    finally:
+        _running.pop(row["id"], None)
+
+
+async def _worker(queue: str):
+    event = _wakeup[queue]
+    while True:
+        try:
+            row = await asyncio.to_thread(_claim, queue)
+        except Exception as e:
+            logging.error(f"Ошибка очереди {queue}: {e}")
+            row = None
+        if row is None:
+            event.clear()
+            try:
+                await asyncio.wait_for(event.wait(), timeout=JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            await _execute(row)
+        except Exception as e:
+            # Не удалось записать итог (например, база заблокирована): аренда истечет,
+            # и recover_expired вернет задачу в очередь; воркер продолжает работу
+            logging.error(f"Ошибка завершения задачи {row['id']} в очереди {queue}: {e}")
+
+
+async def _maintenance():
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            await asyncio.to_thread(_extend_leases)
+            await asyncio.to_thread(recover_expired)
+        except Exception as e:
+            logging.error(f"Ошибка обслуживания очереди задач: {e}")
+
+
+async def start():
+    """Запуск воркеров всех очередей (вызывается при старте приложения)"""
+    global _thread_pool, _process_pool, _loop
+    if _workers:
+        return
+    _loop = asyncio.get_running_loop()
+    await asyncio.to_thread(init_db)
+    if not JOBS_ENABLED:
+        # Задачи из этого процесса ставятся в очередь, выполняют их другие воркеры
+        logging.info("Очередь задач в этом процессе не запускается (JOBS_ENABLED=0)")
+        return
+    await asyncio.to_thread(recover_expired)
+    _thread_pool = ThreadPoolExecutor(max_workers=max(QUEUE_CONCURRENCY.values()), thread_name_prefix="jobs")
+    _process_pool = ProcessPoolExecutor(max_workers=CPU_COUNT)
+    for queue, concurrency in QUEUE_CONCURRENCY.items():
+        _wakeup[queue] = asyncio.Event()
+        for _ in range(concurrency):
+            _workers.append(asyncio.create_task(_worker(queue)))
+    _workers.append(asyncio.create_task(_maintenance()))
+    logging.info(f"Очередь задач запущена: {QUEUE_CONCURRENCY}")
+
+
+def _release_running():
+    """Прерванные задачи этого воркера сразу возвращаются в очередь"""
+    conn = _connect()
+    try:
+        conn.execute(
+            "UPDATE jobs SET status = 'queued', attempts = MAX(attempts - 1, 0), locked_by = NULL, lease_until = NULL WHERE status = 'running' AND locked_by = ?",
+            (_worker_id,)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+async def stop():
+    """Остановка воркеров. Незавершенные задачи подхватятся после перезапуска"""
+    global _thread_pool, _process_pool, _writer
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    if _writer is not None:
+        # Отправленные записи прогресса и итогов доходят до базы до освобождения задач
+        writer, _writer = _writer, None
+        await asyncio.to_thread(writer.shutdown, wait=True)
+    await asyncio.to_thread(_release_running)
+    if _thread_pool:
+        _thread_pool.shutdown(wait=False, cancel_futures=True)
+        _thread_pool = None
+    if _process_pool:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
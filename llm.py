@@ -0,0 +1,108 @@
+import os
+import re
+import json
+import asyncio
+import logging
+from typing import Dict, List
+
+import httpx
+
+import metrics
+
+# Бэкенд LLM: groq или stub (локальная детерминированная заглушка для тестов)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "groq")
+# Интеграция с Groq API (OpenAI-совместимый протокол)
+GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
+GROQ_API_URL = os.getenv("GROQ_API_URL", "https://api.groq.com/openai/v1/chat/completions")
+GROQ_MODEL = os.getenv("GROQ_MODEL", "llama3-70b-8192")
+# Искусственная задержка ответа заглушки (секунды)
+LLM_STUB_DELAY = float(os.getenv("LLM_STUB_DELAY", "0"))
+
+SENTENCE_RE = re.compile(r"[^.!?\n]+[.!?]?")
+
+
+class GroqBackend:
+    """Groq chat/completions"""
+    name = "groq"
+
+    async def complete(self, messages: List[Dict[str, str]], temperature: float, max_tokens: int, timeout: float, json_mode: bool) -> str:
+        headers = {
+            "Authorization": f"Bearer {GROQ_API_KEY}",
+            "Content-Type": "application/json",
+        }
+        payload = {
+            "model": GROQ_MODEL,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }
+        if json_mode:
+            payload["response_format"] = {"type": "json_object"}
+        async with httpx.AsyncClient(timeout=timeout) as client:
+            resp = await client.post(GROQ_API_URL, headers=headers, json=payload)
+        resp.raise_for_status()
+        data = resp.json()
+        content = data.get("choices", [{}])[0].get("message", {}).get("content", "")
+        logging.debug(f"Groq usage: {data.get('usage')}")
+        return content
+
+
+class StubBackend:
+    """Детерминированная заглушка: первые предложения последнего сообщения пользователя
+
+    В json_mode возвращает объект {summary, key_points, risks, recommendations}.
+    """
+    name = "stub"
+
+    def __init__(self, delay: float = LLM_STUB_DELAY):
+        self.delay = delay
+        self.calls = 0
+
+    async def complete(self, messages: List[Dict[str, str]], temperature: float, max_tokens: int, timeout: float, json_mode: bool) -> str:
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        text = next((m["content"] for m in reversed(messages) if m.get("role") == "user"), "")
+        sentences = [s.strip() for s in SENTENCE_RE.findall(text) if len(s.strip()) > 10]
+        if not json_mode:
+            return " ".join(sentences[:3]) or "Заглушка LLM: пустой запрос."
+        return json.dumps({
+            "summary": sentences[0] if sentences else "",
+            "key_points": sentences[1:4],
+            "risks": [],
+            "recommendations": [],
+        }, ensure_ascii=False)
+
+
+_backend = None
+
+
+def get_backend():
+    """Текущий бэкенд LLM"""
+    global _backend
+    if _backend is None:
+        _backend = StubBackend() if LLM_BACKEND == "stub" else GroqBackend()
+    return _backend
+
+
+def set_backend(backend):
+    """Подмена бэкенда LLM (например, StubBackend в тестах)"""
+    global _backend
+    _backend = backend
+
+
+def is_available() -> bool:
+    """Настроен ли доступ к LLM (внешней или заглушке)"""
+    if _backend is not None and not isinstance(_backend, GroqBackend):
+        return True  # Подмененный бэкенд (заглушка или тестовый) не требует ключа
+    return LLM_BACKEND == "stub" or bool(GROQ_API_KEY)
+
+
+async def chat_completion(messages: List[Dict[str, str]], temperature: float = 0.3, max_tokens: int = 2000, timeout: float = 60, json_mode: bool = False) -> str:
+    """Запрос к chat/completions. Ошибки пробрасываются вызывающему коду
+
+    json_mode - просить модель вернуть JSON-объект.
+    """
+    backend = get_backend()
+    with metrics.track_upstream("llm", getattr(backend, "name", type(backend).__name__), "chat_json" if json_mode else "chat"):
+        return await backend.complete(messages, temperature, max_tokens, timeout, json_mode)
@@ -0,0 +1,331 @@
+"""Нагрузочный тест API: открытая модель нагрузки с заданным RPS, отчет p50/p95/p99 в JSON
+
+Запуск против уже работающего сервера:
+    python loadtest.py --base-url http://127.0.0.1:8000 --rps 20 --duration 30 --output report.json
+
+С автоматическим запуском заглушки Groq/HeyGen и приложения (uvicorn main:app):
+    python loadtest.py --spawn --rps 20 --duration 30 --output report.json --baseline baseline.json
+
+При --baseline сравниваются задержки и пропускная способность; при регрессии
+больше --tolerance код выхода 1.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from bench_compare import make_contract, edit_contract
+
+SCENARIOS = ("chat", "chats", "compare", "compliance", "audio")
+# Доли сценариев в нагрузке по умолчанию
+DEFAULT_MIX = "chat=3,chats=2,compare=2,compliance=2,audio=1"
+
+QUESTIONS = [
+    "Какие риски несет пункт о неустойке?",
+    "Можно ли расторгнуть договор в одностороннем порядке?",
+    "Что говорит ст. 354 ГК о договоре?",
+    "Кто отвечает за просрочку поставки?",
+    "Какие сроки претензионного порядка?",
+]
+COMPLIANCE_TEXT = (
+    "Оператор обрабатывает персональные данные субъекта с его согласия. Субъект вправе отозвать согласие "
+    "и потребовать удаления данных. Данные передаются третьим лицам только по договору.\n\n"
+)
+AUDIO_PHRASES = [
+    "Договор вступает в силу с момента подписания.",
+    "Стороны несут ответственность в соответствии с законодательством.",
+    "Оплата производится в течение десяти банковских дней.",
+]
+
+
+def percentile(values: List[float], share: float) -> float:
+    """Перцентиль методом ближайшего ранга (values отсортированы)"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, math.ceil(share * len(values)) - 1))
+    return values[index]
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.mix = self._parse_mix(args.mix)
+        self.results: Dict[str, List[Dict[str, Any]]] = {name: [] for name, _ in self.mix}
+        self.dropped: Counter = Counter()
+        self.user_id: Optional[int] = None
+        self.chat_ids: List[str] = []
+        lines = make_contract(args.compare_pages, self.rng)
+        self.contract_a = "\n".join(lines)
+        self.contract_b = "\n".join(edit_contract(lines, self.rng))
+
+    @staticmethod
+    def _parse_mix(mix: str) -> List[tuple]:
+        pairs = []
+        for part in mix.split(","):
+            name, _, weight = part.partition("=")
+            if name.strip() not in SCENARIOS:
+                raise SystemExit(f"Неизвестный сценарий: {name} (доступны: {', '.join(SCENARIOS)})")
+            pairs.append((name.strip(), float(weight or 1)))
+        return pairs
+
+    async def setup(self, client: httpx.AsyncClient):
+        """Пользователь для сценариев чата и истории"""
+        email = f"load-{int(time.time() * 1000)}-{self.rng.randrange(10 ** 6)}@example.com"
+        resp = await client.post("/api/register", json={"username": email.split("@")[0], "email": email, "password": "loadtest123"})
+        resp.raise_for_status()
+        self.user_id = resp.json()["user"]["id"]
+
+    # Сценарии: возвращают (метод, путь, тело запроса или параметры)
+    def chat(self) -> tuple:
+        body = {"message": self.rng.choice(QUESTIONS), "user_id": self.user_id}
+        if self.chat_ids and self.rng.random() < 0.5:
+            body["chat_id"] = self.rng.choice(self.chat_ids)  # Продолжение диалога: память и история
+        if self.rng.random() < 0.3:
+            body["documents"] = [{"id": "load", "name": "contract.txt", "content": self.contract_a[:20000]}]
+        return "POST", "/api/chat", {"json": body}
+
+    def chats(self) -> tuple:
+        return "GET", "/chats", {"params": {"user_id": self.user_id}}
+
+    def compare(self) -> tuple:
+        return "POST", "/api/compare", {"json": {"doc_a": self.contract_a, "doc_b": self.contract_b, "limit": 20}}
+
+    def compliance(self) -> tuple:
+        text = COMPLIANCE_TEXT * self.rng.randint(5, 40)
+        return "POST", "/api/compliance", {"json": {"text": text, "profiles": ["GDPR"], "incremental": self.rng.random() < 0.5}}
+
+    def audio(self) -> tuple:
+        text = self.rng.choice(AUDIO_PHRASES)
+        if self.rng.random() < self.args.audio_unique:
+            text = f"{text} Вариант {self.rng.randrange(10 ** 9)}."  # Промах кеша TTS
+        return "POST", "/api/audio", {"json": {"text": text}}
+
+    async def _one(self, client: httpx.AsyncClient, name: str, semaphore: asyncio.Semaphore):
+        method, path, kwargs = getattr(self, name)()
+        started = time.perf_counter()
+        record = {"status": 0}
+        try:
+            async with client.stream(method, path, **kwargs) as resp:
+                body = await resp.aread()  # Ответ читается целиком: учитываются и потоковые ответы
+            record["status"] = resp.status_code
+            if name == "chat" and resp.status_code == 200:
+                chat_id = json.loads(body).get("chat_id")
+                if chat_id and chat_id not in self.chat_ids:
+                    self.chat_ids.append(chat_id)
+        except httpx.HTTPError as e:
+            record["error"] = type(e).__name__
+        finally:
+            record["ms"] = (time.perf_counter() - started) * 1000
+            self.results[name].append(record)
+            semaphore.release()
+
+    async def run(self) -> Dict[str, Any]:
+        args = self.args
+        limits = httpx.Limits(max_connections=args.max_in_flight, max_keepalive_connections=args.max_in_flight)
+        async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+            await self.setup(client)
+            names = [name for name, _ in self.mix]
+            weights = [weight for _, weight in self.mix]
+            semaphore = asyncio.Semaphore(args.max_in_flight)
+            tasks = []
+            total = int(args.rps * args.duration)
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            # Открытая модель: запросы отправляются по расписанию независимо от ответов
+            for i in range(total):
+                delay = started + i / args.rps - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                name = self.rng.choices(names, weights)[0]
+                if semaphore.locked():
+                    self.dropped[name] += 1  # Сервер не успевает: запрос не отправлен
+                    continue
+                await semaphore.acquire()
+                tasks.append(asyncio.create_task(self._one(client, name, semaphore)))
+            await asyncio.gather(*tasks)
+            elapsed = loop.time() - started
+            mock_stats = await self._mock_stats(client)
+        return self.report(elapsed, mock_stats)
+
+    async def _mock_stats(self, client: httpx.AsyncClient) -> Optional[Dict[str, Any]]:
+        if not self.args.mock_url:
+            return None
+        try:
+            resp = await client.get(f"{self.args.mock_url.rstrip('/')}/stats")
+            return resp.json()
+        except httpx.HTTPError:
+            return None
+
+    def _summary(self, records: List[Dict[str, Any]], dropped: int, elapsed: float) -> Dict[str, Any]:
+        latencies = sorted(record["ms"] for record in records)
+        statuses = Counter(str(record["status"]) if not record.get("error") else record["error"] for record in records)
+        ok = sum(1 for record in records if 200 <= record["status"] < 400)
+        return {
+            "requests": len(records),
+            "ok": ok,
+            "errors": len(records) - ok,
+            "dropped": dropped,
+            "statuses": dict(statuses),
+            "throughput_rps": round(ok / elapsed, 2) if elapsed else 0.0,
+            "latency_ms": {
+                "mean": round(sum(latencies) / len(latencies), 1) if latencies else 0.0,
+                "p50": round(percentile(latencies, 0.50), 1),
+                "p95": round(percentile(latencies, 0.95), 1),
+                "p99": round(percentile(latencies, 0.99), 1),
+                "max": round(latencies[-1], 1) if latencies else 0.0,
+            },
+        }
+
+    def report(self, elapsed: float, mock_stats: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        args = self.args
+        endpoints = {name: self._summary(records, self.dropped[name], elapsed) for name, records in self.results.items()}
+        all_records = [record for records in self.results.values() for record in records]
+        return {
+            "config": {
+                "base_url": args.base_url, "rps": args.rps, "duration": args.duration, "mix": args.mix,
+                "max_in_flight": args.max_in_flight, "compare_pages": args.compare_pages, "seed": args.seed,
+            },
+            "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "elapsed_s": round(elapsed, 2),
+            "overall": self._summary(all_records, sum(self.dropped.values()), elapsed),
+            "endpoints": endpoints,
+            "upstream_mock": mock_stats,
+        }
+
+
+def compare_with_baseline(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Регрессии относительно базового отчета: рост p95/p99 или падение пропускной способности"""
+    regressions = []
+    sections = [("overall", report["overall"], baseline.get("overall"))]
+    sections += [(name, data, baseline.get("endpoints", {}).get(name)) for name, data in report["endpoints"].items()]
+    for name, current, base in sections:
+        if not base or not current["requests"]:
+            continue
+        deltas = {}
+        for key in ("p50", "p95", "p99"):
+            before, after = base["latency_ms"][key], current["latency_ms"][key]
+            deltas[key] = round((after - before) / before * 100, 1) if before else 0.0
+            if key != "p50" and before and after > before * (1 + tolerance):
+                regressions.append(f"{name}: {key} {before} -> {after} мс ({deltas[key]:+}%)")
+        before, after = base["throughput_rps"], current["throughput_rps"]
+        deltas["throughput"] = round((after - before) / before * 100, 1) if before else 0.0
+        # Пропускная способность отдельного сценария зависит от доли в смеси - сравнивается только итог
+        if name == "overall" and before and after < before * (1 - tolerance):
+            regressions.append(f"{name}: пропускная способность {before} -> {after} rps ({deltas['throughput']:+}%)")
+        current["vs_baseline_percent"] = deltas
+    return regressions
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"⏱  {report['elapsed_s']} c, цель {report['config']['rps']} rps")
+    print(f"{'сценарий':<12}{'ok/всего':>12}{'drop':>6}{'rps':>8}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for name, data in [*report["endpoints"].items(), ("ИТОГО", report["overall"])]:
+        latency = data["latency_ms"]
+        print(f"{name:<12}{data['ok']:>6}/{data['requests']:<5}{data['dropped']:>6}{data['throughput_rps']:>8}"
+              f"{latency['p50']:>9}{latency['p95']:>9}{latency['p99']:>9}")
+    if report.get("upstream_mock"):
+        print(f"🧪 Заглушка: {report['upstream_mock']}")
+
+
+def wait_ready(url: str, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=2).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.3)
+    raise SystemExit(f"Сервис не поднялся: {url}")
+
+
+def spawn(args: argparse.Namespace) -> List[subprocess.Popen]:
+    """Заглушка Groq/HeyGen и приложение с переменными окружения, указывающими на нее"""
+    mock_url = f"http://127.0.0.1:{args.mock_port}"
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    processes = [subprocess.Popen([
+        sys.executable, "mock_upstreams.py", "--port", str(args.mock_port),
+        "--latency-ms", str(args.mock_latency_ms), "--rate-429", str(args.mock_rate_429),
+    ], cwd=cwd)]
+    wait_ready(f"{mock_url}/stats")
+    env = {
+        **os.environ,
+        "LLM_BACKEND": "groq",
+        "GROQ_API_KEY": "mock",
+        "GROQ_API_URL": f"{mock_url}/openai/v1/chat/completions",
+        "HEYGEN_API_KEY": "mock",
+        "HEYGEN_API_URL": mock_url,
+        "TTS_ENGINE": os.environ.get("TTS_ENGINE", "stub"),
+        "EMBEDDING_BACKEND": os.environ.get("EMBEDDING_BACKEND", "stub"),
+    }
+    processes.append(subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.app_port),
+        "--workers", str(args.workers), "--log-level", "warning",
+    ], env=env, cwd=cwd))
+    args.base_url = f"http://127.0.0.1:{args.app_port}"
+    args.mock_url = args.mock_url or mock_url
+    wait_ready(f"{args.base_url}/health")
+    return processes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест explAiner API")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--rps", type=float, default=10)
+    parser.add_argument("--duration", type=float, default=30, help="секунды")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"доли сценариев ({', '.join(SCENARIOS)})")
+    parser.add_argument("--max-in-flight", type=int, default=200, help="больше запросов в работе - новые отбрасываются")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--compare-pages", type=int, default=50, help="размер договоров для /api/compare")
+    parser.add_argument("--audio-unique", type=float, default=0.2, help="доля уникальных текстов (промахов кеша TTS)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="путь JSON-отчета")
+    parser.add_argument("--baseline", help="базовый JSON-отчет для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="допустимое ухудшение (0.1 = 10%%)")
+    parser.add_argument("--mock-url", help="адрес mock_upstreams.py (для статистики вызовов)")
+    parser.add_argument("--spawn", action="store_true", help="запустить заглушку и приложение")
+    parser.add_argument("--app-port", type=int, default=8765)
+    parser.add_argument("--mock-port", type=int, default=9100)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--mock-latency-ms", type=float, default=800)
+    parser.add_argument("--mock-rate-429", type=float, default=0.0)
+    args = parser.parse_args()
+
+    processes = spawn(args) if args.spawn else []
+    try:
+        report = asyncio.run(LoadTest(args).run())
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait(timeout=10)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare_with_baseline(report, json.load(f), args.tolerance)
+        report["regressions"] = regressions
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"📄 Отчет: {args.output}")
+    for regression in regressions:
+        print(f"❌ Регрессия: {regression}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
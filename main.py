@@ -3,11 +3,10 @@ import logging
 import json
 import httpx
 import base64
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Depends, Cookie, Request
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Depends, Cookie, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, HTMLResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
@@ -16,6 +15,29 @@ load_dotenv()
 import asyncio
 import io
 import database
+import context_builder
+import conversation_memory
+import llm
+import tts
+import jobs
+import video_jobs
+import rag_indexer
+import crawler
+import translation
+import compliance
+import documents
+import diff_engine
+import template_matcher
+import analysis_pipeline
+import whatif
+import statutes
+import metrics
+import tracing
+import warmup
+import embeddings
+import embedding_service
+import delivery
+import coordination
 
 # Логирование
 logging.basicConfig(level=logging.INFO)
@@ -29,31 +51,48 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# gzip для крупных JSON-ответов (/chats, сравнения, отчеты) и NDJSON-потоков (сжимаются по чанкам)
+app.add_middleware(delivery.JSONCompressionMiddleware)
+# Метрики запросов: длительность по маршрутам и запросы в обработке (GET /metrics)
+app.add_middleware(metrics.MetricsMiddleware)
+# Трассировка: заголовок Server-Timing, журнал медленных запросов (TRACING_ENABLED=0 - выключить)
+app.add_middleware(tracing.TracingMiddleware)
 
 # Подключение статических файлов (если нужны картинки, css, js)
 app.mount("/templates", StaticFiles(directory="templates"), name="templates")
 
-# Подключение шаблонов (HTML)
-templates = Jinja2Templates(directory="templates")
-
-# 🔹 Главная страница (рендерит HTML)
+# 🔹 Главная страница: предсжатый HTML из памяти, ETag (повторная загрузка - 304)
 @app.get("/", response_class=HTMLResponse)
 async def home(request: Request):
-    return templates.TemplateResponse("new.html", {"request": request})
+    return delivery.page_response(request)
 
 # 🔹 Health-check (Render будет проверять этот URL)
 @app.get("/status")
 async def status():
     return {"status": "ok", "service": "explAiner AI API"}
 
+# 🔹 Готовность: тяжелые подсистемы прогреты (503, пока идет прогрев)
+@app.get("/ready")
+async def ready():
+    state = warmup.status()
+    return JSONResponse(status_code=200 if state["ready"] else 503, content=state)
+
 # 🔹 Альтернативные роуты для прямого доступа к HTML
 @app.get("/app")
-async def serve_app():
-    return FileResponse("templates/new.html")
+async def serve_app(request: Request):
+    return delivery.page_response(request)
 
 @app.get("/ui")
-async def serve_ui():
-    return FileResponse("templates/new.html")
+async def serve_ui(request: Request):
+    return delivery.page_response(request)
+
+# 🔹 CSS/JS интерфейса с хешем в имени (python build_assets.py): кэшируются навсегда
+@app.get("/assets/{name}")
+async def serve_asset(name: str, request: Request):
+    response = delivery.asset_response(request, name)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Файл не найден")
+    return response
 
 
 class ChatRequest(BaseModel):
@@ -64,6 +103,7 @@ class ChatRequest(BaseModel):
     rag: Optional[Dict[str, Any]] = None
     user_id: Optional[int] = None
     chat_id: Optional[str] = None
+    documents: Optional[List[Dict[str, Any]]] = None  # [{id, name, content}] для контекста
 
 
 class ChatMessage(BaseModel):
@@ -93,9 +133,13 @@ class ChatHistory(BaseModel):
 
 
 # Интеграция с Groq API (с безопасным фолбэком)
-GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
+GROQ_API_KEY = llm.GROQ_API_KEY
 
+# История чатов без авторизации (обратная совместимость); один файл на все воркеры
+CHAT_HISTORY_FILE = os.getenv("CHAT_HISTORY_FILE", "chat_history.json")
 
+
+@tracing.traced("history.load")
 def load_chat_history() -> List[Dict[str, Any]]:
     """Загрузка истории чата из файла"""
     try:
@@ -107,15 +151,33 @@ def load_chat_history() -> List[Dict[str, Any]]:
     return []
 
 
+@tracing.traced("history.save")
 def save_chat_history(history: List[Dict[str, Any]]):
     """Сохранение истории чата в файл"""
     try:
-        with open(CHAT_HISTORY_FILE, 'w', encoding='utf-8') as f:
+        # Через временный файл: читатели без блокировки не увидят недописанный JSON
+        tmp = f"{CHAT_HISTORY_FILE}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
             json.dump(history, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, CHAT_HISTORY_FILE)
     except Exception as e:
         logging.error(f"Ошибка сохранения истории чата: {e}")
 
 
+def modify_chat_history(change) -> Any:
+    """Чтение-изменение-запись истории под межпроцессной блокировкой
+
+    change(history) меняет список на месте и возвращает результат; история
+    сохраняется, если результат не False (например, чат не найден).
+    """
+    with coordination.file_lock(CHAT_HISTORY_FILE):
+        history = load_chat_history()
+        result = change(history)
+        if result is not False:
+            save_chat_history(history)
+        return result
+
+
 def generate_chat_id() -> str:
     """Генерация уникального ID для чата"""
     return f"chat_{int(datetime.now().timestamp())}"
@@ -163,13 +225,18 @@ def generate_chat_title(query: str) -> str:
     return title.strip()
 
 
-async def call_groq(prompt: str, model: str = "gpt-4o", multilingual: bool = True, factCheck: bool = True) -> str:
+async def call_groq(prompt: str, model: str = "gpt-4o", multilingual: bool = True, factCheck: bool = True, memory: Optional[Dict[str, Any]] = None, citations: Optional[List[Dict[str, Any]]] = None) -> str:
     """Вызов Groq API. При отсутствии ключа возвращает фолбэк-ответ.
 
+    memory - сводка и последние сообщения диалога (см. conversation_memory.build_memory).
+    citations - найденные тексты статей (см. statutes.find_citations).
     Для продакшена укажите переменную окружения GROQ_API_KEY.
     """
-    if not GROQ_API_KEY:
-        # Фолбэк: локальный ответ без внешней LLM
+    if not llm.is_available():
+        # Фолбэк: локальный ответ без внешней LLM; на точную ссылку отвечаем текстом статьи
+        metrics.fallback("chat")
+        if citations:
+            return statutes.format_answer(citations)
         return generate_fallback_response(prompt)
 
     # Системный промпт для explAiner
@@ -178,32 +245,19 @@ async def call_groq(prompt: str, model: str = "gpt-4o", multilingual: bool = Tru
     if factCheck:
         system_prompt += " Проверяй факты и указывай источники информации, когда это возможно."
 
+    messages = [{"role": "system", "content": system_prompt}]
+    if memory:
+        if memory.get("summary"):
+            messages.append({"role": "system", "content": f"Краткое содержание предыдущей части диалога:\n{memory['summary']}"})
+        messages.extend(memory.get("recent", []))
+    messages.append({"role": "user", "content": prompt})
+
     try:
-        headers = {
-            "Authorization": f"Bearer {GROQ_API_KEY}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "model": "llama3-70b-8192" if model == "gpt-4o" else "llama3-70b-8192",
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt},
-            ],
-            "temperature": 0.3,
-            "max_tokens": 2000,
-        }
-        async with httpx.AsyncClient(timeout=60) as client:
-            resp = await client.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers=headers,
-                json=payload,
-            )
-        resp.raise_for_status()
-        data = resp.json()
-        content = data.get("choices", [{}])[0].get("message", {}).get("content", "")
+        content = await llm.chat_completion(messages, temperature=0.3, max_tokens=2000)
         return content or "Не удалось получить ответ от ИИ."
     except Exception as e:
         logging.error(f"Groq API error: {e}")
+        metrics.fallback("chat")
         return generate_fallback_response(prompt)
 
 
@@ -285,8 +339,19 @@ async def chat_with_ai(request: ChatRequest):
         if not request.message.strip():
             raise HTTPException(status_code=400, detail="Запрос не может быть пустым")
         
-        # Получаем ответ от ИИ
-        answer = await call_groq(request.message, request.model, request.multilingual, request.factCheck)
+        # Отбираем релевантные фрагменты приложенных документов под бюджет токенов
+        prompt = request.message
+        context_sources = []
+        if request.documents:
+            context = await asyncio.to_thread(context_builder.build_context, request.message, request.documents)
+            prompt = context_builder.compose_prompt(request.message, context)
+            context_sources = context["sources"]
+        
+        # Точные ссылки на статьи ("ст. 354 ГК") - текст из индекса статей, без векторного поиска
+        citations = await asyncio.to_thread(statutes.find_citations, request.message)
+        if citations:
+            prompt = statutes.compose_prompt(prompt, citations)
+        sources = statutes.to_sources(citations)
         
         # Если указан user_id, сохраняем в базе данных
         if request.user_id:
@@ -300,10 +365,16 @@ async def chat_with_ai(request: ChatRequest):
                 # Чат существует
                 messages = chat_data["chat"]["messages"]
                 title = chat_data["chat"]["title"]
+                # Сводка старых ходов + последние ходы дословно
+                memory = await conversation_memory.build_memory(request.user_id, chat_id, messages)
             else:
                 # Создаем новый чат
                 messages = []
                 title = generate_chat_title(request.message)
+                memory = None
+            
+            # Получаем ответ от ИИ с учетом контекста диалога
+            answer = await call_groq(prompt, request.model, request.multilingual, request.factCheck, memory, citations)
             
             # Добавляем сообщения
             messages.append({
@@ -315,7 +386,9 @@ async def chat_with_ai(request: ChatRequest):
             messages.append({
                 "role": "assistant",
                 "content": answer,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": datetime.now().isoformat(),
+                "context": context_sources,
+                "sources": sources
             })
             
             # Сохраняем в базу
@@ -325,11 +398,13 @@ async def chat_with_ai(request: ChatRequest):
             return JSONResponse(content={
                 "answer": answer,
                 "chat_id": chat_id,
-                "title": title
+                "title": title,
+                "context": context_sources,
+                "sources": sources
             })
         else:
-            # Обратная совместимость - сохраняем в файл
-            history = load_chat_history()
+            # Получаем ответ от ИИ
+            answer = await call_groq(prompt, request.model, request.multilingual, request.factCheck, citations=citations)
             
             # Создаем новый чат
             chat_id = generate_chat_id()
@@ -340,7 +415,6 @@ async def chat_with_ai(request: ChatRequest):
                 "created_at": datetime.now().isoformat(),
                 "updated_at": datetime.now().isoformat()
             }
-            history.append(new_chat)
             current_chat = new_chat
             
             # Добавляем сообщение пользователя
@@ -355,18 +429,25 @@ async def chat_with_ai(request: ChatRequest):
             assistant_message = {
                 "role": "assistant",
                 "content": answer,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": datetime.now().isoformat(),
+                "context": context_sources,
+                "sources": sources
             }
             current_chat["messages"].append(assistant_message)
             
             # Обновляем время последнего изменения
             current_chat["updated_at"] = datetime.now().isoformat()
             
-            # Сохраняем историю
-            save_chat_history(history)
+            # Обратная совместимость - сохраняем в файл
+            await asyncio.to_thread(modify_chat_history, lambda history: history.append(new_chat))
             
             # Возвращаем ответ
-            return answer
+            return JSONResponse(content={
+                "answer": answer,
+                "chat_id": chat_id,
+                "context": context_sources,
+                "sources": sources
+            })
         
     except Exception as e:
         logging.error(f"Ошибка генерации ответа: {e}")
@@ -431,9 +512,9 @@ async def delete_chat(chat_id: str, user_id: Optional[int] = None):
                 raise HTTPException(status_code=404, detail=result["message"])
         else:
             # Обратная совместимость - удаляем из файла
-            history = load_chat_history()
-            history = [chat for chat in history if chat["id"] != chat_id]
-            save_chat_history(history)
+            def remove(history):
+                history[:] = [chat for chat in history if chat["id"] != chat_id]
+            await asyncio.to_thread(modify_chat_history, remove)
             return JSONResponse(content={"message": "Чат удален", "chat_id": chat_id})
     except Exception as e:
         logging.error(f"Ошибка удаления чата: {e}")
@@ -453,13 +534,15 @@ async def update_chat_title(chat_id: str, title: str, user_id: Optional[int] = N
                 raise HTTPException(status_code=404, detail=result["message"])
         else:
             # Обратная совместимость - обновляем в файле
-            history = load_chat_history()
-            for chat in history:
-                if chat["id"] == chat_id:
-                    chat["title"] = title
-                    chat["updated_at"] = datetime.now().isoformat()
-                    save_chat_history(history)
-                    return JSONResponse(content={"message": "Заголовок обновлен", "title": title})
+            def rename(history):
+                for chat in history:
+                    if chat["id"] == chat_id:
+                        chat["title"] = title
+                        chat["updated_at"] = datetime.now().isoformat()
+                        return True
+                return False
+            if await asyncio.to_thread(modify_chat_history, rename):
+                return JSONResponse(content={"message": "Заголовок обновлен", "title": title})
             raise HTTPException(status_code=404, detail="Чат не найден")
     except HTTPException:
         raise
@@ -499,13 +582,47 @@ async def get_stats():
         raise HTTPException(status_code=500, detail=f"Ошибка получения статистики: {str(e)}")
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """Метрики в формате Prometheus (со всех воркеров при заданном METRICS_DIR)"""
+    content = await asyncio.to_thread(metrics.exposition)
+    return Response(content=content, media_type=metrics.CONTENT_TYPE)
+
+
+# Прогрев в фоне после старта, в порядке регистрации: модель эмбеддингов нужна библиотеке What-if
+warmup.register("ui", delivery.warm_up)
+warmup.register("embeddings", lambda: embeddings.encode(["прогрев модели эмбеддингов"]))
+warmup.register("tokenizer", lambda: context_builder.count_tokens("прогрев токенизатора"))
+warmup.register("compliance_rules", compliance.get_ruleset)
+warmup.register("template_index", template_matcher.get_index)
+warmup.register("whatif_library", whatif.get_library)
+warmup.register("tts", tts.warm_up)
+warmup.register("pdf", documents.warm_up)
+
+
 # Инициализация при запуске приложения
 @app.on_event("startup")
 async def startup_event():
     """Инициализация при запуске приложения"""
+    # Базы создаются здесь, а не при импорте модулей: импорт остается дешевым
+    database.init_db()
     logging.info("ExplAiner AI система инициализирована")
     if not GROQ_API_KEY:
         logging.warning("GROQ_API_KEY не установлен. Работаем в локальном режиме.")
+    # Воркеры очереди задач (подхватывают и прерванные до перезапуска задачи)
+    await jobs.start()
+    metrics.start()
+    warmup.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Остановка фоновых воркеров"""
+    await warmup.stop()
+    await jobs.stop()
+    compliance.shutdown_pool()
+    embedding_service.shutdown()
+    metrics.stop()
 
 
 # Обработка загрузки файлов
@@ -514,10 +631,10 @@ async def upload_file(file: UploadFile = File(...), encrypted: str = Form("0")):
     """Загрузка файла"""
     try:
         # Создаем директорию для загруженных файлов, если её нет
-        os.makedirs("uploads", exist_ok=True)
+        os.makedirs(documents.UPLOAD_DIR, exist_ok=True)
         
         # Сохраняем файл
-        file_path = os.path.join("uploads", file.filename)
+        file_path = os.path.join(documents.UPLOAD_DIR, file.filename)
         with open(file_path, "wb") as f:
             content = await file.read()
             f.write(content)
@@ -538,35 +655,27 @@ class AudioRequest(BaseModel):
     voice: Optional[str] = None
 
 
-# Генерация аудио (заглушка)
+def audio_file_response(path: str, key: str, http_request: Request):
+    """Ответ с MP3 из кеша: ETag, долгое кеширование и поддержка Range"""
+    etag = f'"{key}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Content-Location": f"/api/audio/{key}",
+    }
+    if http_request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type="audio/mpeg", headers=headers)
+
+
+# Генерация аудио
 @app.post("/api/audio")
-async def generate_audio(request: AudioRequest):
-    """Генерация аудио из текста с использованием gTTS"""
+async def generate_audio(request: AudioRequest, http_request: Request):
+    """Генерация аудио из текста с использованием gTTS (в пуле потоков, с кешем)"""
     try:
-        from gtts import gTTS
-        import tempfile
-        import os
-        
-        # Создаем временный файл
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp3') as temp_file:
-            temp_path = temp_file.name
-        
-        # Генерируем аудио с помощью gTTS
-        tts = gTTS(text=request.text, lang='ru' if not request.voice else 'en')
-        tts.save(temp_path)
-        
-        # Возвращаем аудио файл
-        def cleanup():
-            try:
-                os.unlink(temp_path)
-            except:
-                pass
-                
-        return FileResponse(
-            temp_path, 
-            media_type="audio/mpeg",
-            background=cleanup
-        )
+        lang = 'ru' if not request.voice else 'en'
+        path, key = await tts.synthesize(request.text, lang, request.voice)
+        return audio_file_response(path, key, http_request)
     except ImportError:
         logging.warning("gTTS не установлен. Возвращаем пустой MP3.")
         return FileResponse("templates/empty.mp3", media_type="audio/mpeg")
@@ -575,6 +684,28 @@ async def generate_audio(request: AudioRequest):
         raise HTTPException(status_code=500, detail=f"Ошибка генерации аудио: {str(e)}")
 
 
+@app.post("/api/audio/stream")
+async def stream_audio(request: AudioRequest):
+    """Потоковая озвучка по предложениям: первый звук готов после синтеза первого предложения"""
+    if not request.text.strip():
+        raise HTTPException(status_code=400, detail="Текст не может быть пустым")
+    lang = 'ru' if not request.voice else 'en'
+    return StreamingResponse(
+        tts.stream_sentences(request.text, lang, request.voice),
+        media_type="audio/mpeg",
+        headers={"Cache-Control": "no-store"}
+    )
+
+
+@app.get("/api/audio/{key}")
+async def get_cached_audio(key: str, http_request: Request):
+    """Повторное воспроизведение уже синтезированного аудио"""
+    path = tts.get_cached(key)
+    if not path:
+        raise HTTPException(status_code=404, detail="Аудио не найдено")
+    return audio_file_response(path, key, http_request)
+
+
 class VideoRequest(BaseModel):
     text: str
     avatar: Optional[str] = "none"
@@ -584,6 +715,19 @@ class VideoRequest(BaseModel):
 class ComplianceRequest(BaseModel):
     text: str
     profiles: List[str] = ["GDPR"]
+    incremental: bool = False  # Перепроверять только измененные абзацы
+
+
+class ComplianceBatchDocument(BaseModel):
+    id: Optional[str] = None
+    text: str
+
+
+class ComplianceBatchRequest(BaseModel):
+    documents: List[ComplianceBatchDocument] = []  # Тексты, переданные в запросе
+    document_ids: List[str] = []  # Ранее загруженные документы (/api/upload)
+    profiles: List[str] = ["GDPR"]
+    include_matches: bool = False
 
 
 class ComplianceResponse(BaseModel):
@@ -595,11 +739,26 @@ class ComplianceResponse(BaseModel):
 class CompareRequest(BaseModel):
     doc_a: str
     doc_b: str
+    context: int = 3  # Строк контекста вокруг изменений
+    stream: bool = False  # NDJSON: сводка, затем блоки по мере формирования
+    cursor: Optional[str] = None  # Курсор страницы из next_cursor предыдущего ответа
+    limit: int = 50  # Блоков на страницу
 
 
 class CompareResponse(BaseModel):
-    diffs: List[Dict[str, Any]]
+    hunks: List[Dict[str, Any]]
     summary: str
+    next_cursor: Optional[str] = None
+
+
+class TemplateRequest(BaseModel):
+    name: str
+    content: str
+
+
+class TemplateCompareRequest(BaseModel):
+    document: str
+    top_k: int = 3  # Против скольких лучших шаблонов строить полный diff
 
 
 class WhatIfRequest(BaseModel):
@@ -616,6 +775,7 @@ class DocumentAnalysisRequest(BaseModel):
     document_id: str
     document_text: str
     analysis_type: str = "general"  # general, legal, risks
+    background: bool = False  # Выполнить в очереди задач и вернуть job_id
 
 
 class DocumentAnalysisResponse(BaseModel):
@@ -625,83 +785,77 @@ class DocumentAnalysisResponse(BaseModel):
     recommendations: Optional[List[str]] = None
 
 
-# Генерация видео (заглушка)
-@app.post("/api/video")
-async def generate_video(request: VideoRequest):
-    try:
-        HEYGEN_API_KEY = os.getenv('HEYGEN_API_KEY')
-        if not HEYGEN_API_KEY:
-            raise ValueError("HeyGen API key not found")
+class TranslationRequest(BaseModel):
+    text: str
+    source: str = "auto"
+    target: str = "ru"
+    legal_terms: bool = True  # Постобработка юридической терминологии
+    preserve_formatting: bool = True  # Иначе переносы внутри абзацев заменяются пробелами
 
+
+# Генерация видео: задача ставится в очередь, клиент опрашивает статус
+@app.post("/api/video", status_code=202)
+async def generate_video(request: VideoRequest, idempotency_key: Optional[str] = Header(None)):
+    """Создание задачи генерации видео. Возвращает job_id сразу"""
+    try:
         logging.info(f"Generating video with text: {request.text[:50]}...")
+        job = await asyncio.to_thread(video_jobs.submit, request.text, request.avatar, request.voice, idempotency_key)
+        return JSONResponse(status_code=202, content=job)
+    except Exception as e:
+        logging.error(f"Video generation error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Video generation error: {str(e)}")
 
-        url = "https://api.heygen.com/v1/video.generate"
-        headers = {
-            "accept": "application/json",
-            "content-type": "application/json",
-            "x-api-key": HEYGEN_API_KEY
-        }
-        payload = {
-            "test": True,
-            "caption": False,
-            "aspect_ratio": "16:9",
-            "video_inputs": [
-                {
-                    "character": {
-                        "type": "avatar",
-                        "avatar_name": request.avatar or "Jessica-2k-20190523"  # Replace with your valid avatar name
-                    },
-                    "voice": {
-                        "type": "text",
-                        "input_text": request.text,
-                        "voice_name": request.voice or "Sara-neutral"  # Replace with valid voice name
-                    }
-                }
-            ]
-        }
 
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(url, headers=headers, json=payload)
-            logging.info(f"Generation response status: {resp.status_code}")
-            resp.raise_for_status()
-            data = resp.json()
-            logging.info(f"Generation data: {data}")
-            video_id = data.get("data", {}).get("video_id")
-            if not video_id:
-                raise ValueError("No video_id in response")
-
-            # Poll for status
-            status_url = f"https://api.heygen.com/v1/video_status/{video_id}"
-            attempts = 0
-            max_attempts = 60  # 5 min
-            while attempts < max_attempts:
-                attempts += 1
-                status_resp = await client.get(status_url, headers=headers)
-                logging.info(f"Status check {attempts}: {status_resp.status_code}")
-                status_resp.raise_for_status()
-                status_data = status_resp.json()
-                logging.info(f"Status data: {status_data}")
-                status = status_data.get("data", {}).get("status")
-                if status == "completed":
-                    video_url = status_data.get("data", {}).get("video_url")
-                    break
-                elif status == "failed" or status == "error":
-                    raise ValueError(f"Video generation failed: {status_data.get('data', {}).get('error_msg', 'Unknown error')}")
-                await asyncio.sleep(5)
-
-            if not video_url:
-                raise ValueError("Video generation timed out")
-
-            # Download video
-            video_resp = await client.get(video_url)
-            logging.info(f"Download response: {video_resp.status_code}")
-            video_resp.raise_for_status()
-
-            return StreamingResponse(io.BytesIO(video_resp.content), media_type="video/mp4")
+@app.get("/api/video/{job_id}")
+async def get_video_status(job_id: str):
+    """Статус задачи генерации видео"""
+    job = await asyncio.to_thread(jobs.get_job, job_id)
+    if not job or job["kind"] != "video.generate":
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return JSONResponse(content=job)
+
+
+@app.get("/api/video/{job_id}/result")
+async def get_video_result(job_id: str):
+    """Готовое видео (с поддержкой Range)"""
+    job = await asyncio.to_thread(jobs.get_job, job_id)
+    if not job or job["kind"] != "video.generate":
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    if job["status"] != "completed":
+        raise HTTPException(status_code=409, detail=f"Видео еще не готово: {job['status']}")
+    return FileResponse(video_jobs.result_path(job_id), media_type="video/mp4")
+
+
+# Фоновые задачи
+@app.get("/api/jobs/{job_id}")
+async def get_job_status(job_id: str):
+    """Статус, прогресс и результат фоновой задачи"""
+    job = await asyncio.to_thread(jobs.get_job, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+    return JSONResponse(content=job)
+
 
+@app.post("/api/index/rebuild", status_code=202)
+async def rebuild_index(idempotency_key: Optional[str] = Header(None)):
+    """Перестроение векторной базы kodeks в фоне"""
+    try:
+        job = await asyncio.to_thread(jobs.enqueue, "index.build", {}, idempotency_key)
+        return JSONResponse(status_code=202, content=job)
     except Exception as e:
-        logging.error(f"Video generation error: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Video generation error: {str(e)}")
+        logging.error(f"Ошибка постановки индексации: {e}")
+        raise HTTPException(status_code=500, detail=f"Ошибка постановки индексации: {str(e)}")
+
+
+@app.post("/api/corpus/refresh", status_code=202)
+async def refresh_corpus(idempotency_key: Optional[str] = Header(None)):
+    """Обход источников kodeks в фоне; переиндексируются только изменившиеся файлы"""
+    try:
+        job = await asyncio.to_thread(jobs.enqueue, "corpus.crawl", {}, idempotency_key)
+        return JSONResponse(status_code=202, content=job)
+    except Exception as e:
+        logging.error(f"Ошибка постановки обхода корпуса: {e}")
+        raise HTTPException(status_code=500, detail=f"Ошибка постановки обхода корпуса: {str(e)}")
 
 
 # Комплаенс-чекер
@@ -716,113 +870,145 @@ async def check_compliance(request: ComplianceRequest):
                 "suggestions": ["Пожалуйста, предоставьте текст для проверки"]
             })
             
-        text = request.text.lower()
-        profiles = request.profiles
-        issues = []
-        suggestions = []
-        
-        # Базовые проверки для GDPR
-        if "gdpr" in profiles:
-            if not any(term in text for term in ["consent", "согласие", "соглас"]):
-                issues.append("Нет явного основания обработки (consent/contract).")
-                suggestions.append("Добавьте правовое основание обработки (Art.6 GDPR) и цели.")
-                
-            if any(term in text for term in ["third party", "third-party", "третьим лицам", "третьих лиц"]):
-                issues.append("Указана передача третьим лицам — требуется DPA и SCC при трансграничной передаче.")
-                suggestions.append("Заключите DPA с процессорами и укажите меры безопасности (Art.28).")
-                
-            if not any(term in text for term in ["retention", "срок хранения", "период хранения"]):
-                issues.append("Не указан срок хранения.")
-                suggestions.append("Укажите сроки хранения и критерии их определения.")
-                
-            if not any(term in text for term in ["rights", "права субъекта", "право на доступ"]):
-                issues.append("Нет описания прав субъекта (доступ, удаление, перенос).")
-                suggestions.append("Опишите права субъекта и порядок их реализации.")
-        
-        # Проверки для CCPA
-        if "ccpa" in profiles:
-            if not any(term in text for term in ["california", "калифорния", "ccpa"]):
-                issues.append("Нет упоминания CCPA для пользователей из Калифорнии.")
-                suggestions.append("Добавьте раздел о правах резидентов Калифорнии согласно CCPA.")
-                
-            if not any(term in text for term in ["opt-out", "отказаться", "отказ от"]):
-                issues.append("Нет механизма отказа от продажи данных (Do Not Sell).")
-                suggestions.append("Добавьте механизм Do Not Sell My Personal Information.")
-        
-        # Проверки для 152-ФЗ (Россия)
-        if "152fz" in profiles:
-            if not any(term in text for term in ["оператор", "обработка персональных данных", "субъект персональных данных"]):
-                issues.append("Отсутствуют основные термины согласно 152-ФЗ.")
-                suggestions.append("Добавьте определения оператора, субъекта ПДн и процессов обработки.")
-                
-            if not any(term in text for term in ["согласие на обработку", "отзыв согласия"]):
-                issues.append("Не описан порядок получения и отзыва согласия.")
-                suggestions.append("Укажите порядок получения и отзыва согласия на обработку ПДн.")
+        # Все термины всех правил ищутся за один проход (автомат Ахо-Корасик);
+        # в инкрементальном режиме сканируются только абзацы, которых нет в кеше
+        check = compliance.check_incremental if request.incremental else compliance.check
+        result = await asyncio.to_thread(check, request.text, request.profiles)
         
-        # Расчет оценки соответствия
-        score = max(0, 100 - len(issues)*15)  # Снижаем штраф за каждую проблему
-        
-        return JSONResponse(content={
-            "score": score,
-            "issues": issues,
-            "suggestions": list(set(suggestions))  # Убираем дубликаты
-        })
+        return JSONResponse(content=result)
     except Exception as e:
         logging.error(f"Ошибка проверки комплаенса: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка проверки комплаенса: {str(e)}")
 
 
+@app.post("/api/compliance/batch")
+async def check_compliance_batch(request: ComplianceBatchRequest):
+    """Пакетная проверка комплаенса в пуле процессов
+
+    Ответ - NDJSON: по строке на документ по мере готовности и итоговая сводка по профилям.
+    """
+    items = [(doc.id or f"doc_{index}", doc.text) for index, doc in enumerate(request.documents)]
+    items.extend((document_id, None) for document_id in request.document_ids)
+    if not items:
+        raise HTTPException(status_code=400, detail="Не переданы документы для проверки")
+    
+    async def stream():
+        async for result in compliance.check_batch(items, request.profiles, request.include_matches):
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
 # Сравнение документов
 @app.post("/api/compare")
 async def compare_documents(request: CompareRequest):
-    """Сравнение двух документов и выявление различий"""
+    """Сравнение двух документов и выявление различий
+
+    Различия отдаются блоками с контекстом: постранично по курсору или потоком NDJSON (stream=true).
+    """
     try:
-        # В реальном приложении здесь была бы более сложная логика сравнения
-        # С использованием библиотек для работы с документами разных форматов
-        
-        # Простое сравнение текста
-        import difflib
-        
-        doc_a = request.doc_a
-        doc_b = request.doc_b
-        
-        # Используем difflib для сравнения
-        diff = difflib.ndiff(doc_a.splitlines(), doc_b.splitlines())
-        
-        # Формируем результат
-        diffs = []
-        for line in diff:
-            if line.startswith('+ '):
-                diffs.append({'type': 'added', 'text': line[2:]})
-            elif line.startswith('- '):
-                diffs.append({'type': 'removed', 'text': line[2:]})
-            elif line.startswith('? '):
-                # Игнорируем метаданные
-                continue
-            else:
-                diffs.append({'type': 'unchanged', 'text': line[2:] if line.startswith('  ') else line})
-        
-        # Анализ различий
-        added = len([d for d in diffs if d['type'] == 'added'])
-        removed = len([d for d in diffs if d['type'] == 'removed'])
-        total_changes = added + removed
-        
-        # Формируем краткий отчет
-        summary = f"Найдено {total_changes} изменений: {added} добавлений, {removed} удалений."
-        
+        if request.context < 0 or request.limit < 1:
+            raise HTTPException(status_code=400, detail="context и limit должны быть положительными")
+        start = 0
+        if request.cursor:
+            if not request.cursor.isdigit():
+                raise HTTPException(status_code=400, detail="Некорректный курсор")
+            start = int(request.cursor)
+
+        # Patience/Майерс по хешированным строкам в пуле потоков: длинные договоры не блокируют цикл событий.
+        # Результат кэшируется, поэтому следующие страницы не пересчитывают diff
+        result = await asyncio.to_thread(diff_engine.compare_cached, request.doc_a, request.doc_b, request.context)
+        header = {
+            "summary": diff_engine.summarize(result),
+            "added": result["added"],
+            "removed": result["removed"],
+            "moved": result["moved"],
+            "total_hunks": len(result["hunks"])
+        }
+
+        if request.stream:
+            def stream():
+                # Синхронный генератор выполняется в пуле потоков; в памяти только текущий блок
+                yield json.dumps({"type": "summary", **header}, ensure_ascii=False) + "\n"
+                for hunk in diff_engine.iter_hunks(result, start):
+                    yield json.dumps({"type": "hunk", **hunk}, ensure_ascii=False) + "\n"
+
+            return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+        # Пословные различия считаются только для блоков этой страницы
+        hunks = await asyncio.to_thread(lambda: list(diff_engine.iter_hunks(result, start, request.limit)))
+        end = start + len(hunks)
         return JSONResponse(content={
-            "diffs": diffs[:500],  # Ограничиваем размер ответа
-            "summary": summary
+            **header,
+            "hunks": hunks,
+            "next_cursor": str(end) if end < len(result["hunks"]) else None
         })
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Ошибка сравнения документов: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка сравнения документов: {str(e)}")
 
 
+# Библиотека шаблонов договоров
+@app.post("/api/templates")
+async def add_template(request: TemplateRequest):
+    """Добавление шаблона в библиотеку"""
+    if not request.name.strip() or not request.content.strip():
+        raise HTTPException(status_code=400, detail="Название и текст шаблона не могут быть пустыми")
+    try:
+        result = await asyncio.to_thread(template_matcher.add_template, request.name.strip(), request.content)
+    except Exception as e:
+        logging.error(f"Ошибка добавления шаблона: {e}")
+        raise HTTPException(status_code=500, detail=f"Ошибка добавления шаблона: {str(e)}")
+    if not result["success"]:
+        status_code = 409 if "template_id" in result else 500
+        raise HTTPException(status_code=status_code, detail=result["message"])
+    return JSONResponse(content={"template_id": result["template_id"], "name": request.name.strip()})
+
+
+@app.get("/api/templates")
+async def list_templates():
+    """Список шаблонов библиотеки"""
+    result = database.get_templates()
+    if not result["success"]:
+        raise HTTPException(status_code=500, detail=result["message"])
+    return JSONResponse(content={"templates": result["templates"]})
+
+
+@app.delete("/api/templates/{template_id}")
+async def delete_template(template_id: int):
+    """Удаление шаблона из библиотеки"""
+    result = await asyncio.to_thread(template_matcher.delete_template, template_id)
+    if not result["success"]:
+        raise HTTPException(status_code=404, detail=result["message"])
+    return JSONResponse(content={"message": result["message"], "template_id": template_id})
+
+
+@app.post("/api/compare/templates")
+async def compare_with_templates(request: TemplateCompareRequest):
+    """Сравнение документа с библиотекой шаблонов: MinHash/LSH-ранжирование и diff с лучшими"""
+    if not request.document.strip():
+        raise HTTPException(status_code=400, detail="Документ не может быть пустым")
+    if request.top_k < 1:
+        raise HTTPException(status_code=400, detail="top_k должен быть положительным")
+    try:
+        result = await asyncio.to_thread(template_matcher.compare_with_templates, request.document, request.top_k)
+        if not result["results"]:
+            result["summary"] = "Похожих шаблонов не найдено"
+        else:
+            best = result["results"][0]
+            result["summary"] = f"Ближайший шаблон: {best['name']} (сходство {best['similarity']:.0%}). {best['summary']}"
+        return JSONResponse(content=result)
+    except Exception as e:
+        logging.error(f"Ошибка сравнения с шаблонами: {e}")
+        raise HTTPException(status_code=500, detail=f"Ошибка сравнения с шаблонами: {str(e)}")
+
+
 # What-if симулятор
 @app.post("/api/whatif")
 async def generate_whatif(request: WhatIfRequest):
-    """Генерация Mermaid-диаграмм для What-if сценариев"""
+    """Mermaid-диаграмма What-if сценария из библиотеки или сгенерированная (с кэшированием)"""
     try:
         if not request.question or request.question.strip() == "":
             return JSONResponse(status_code=400, content={
@@ -843,178 +1029,59 @@ async def generate_whatif(request: WhatIfRequest):
                 "explanation": "Для использования What-If симулятора необходимо сначала загрузить документ. Пожалуйста, загрузите документ через панель загрузки файлов."
             })
         
-        # Проверка на наличие API ключа
-        if not GROQ_API_KEY:
-            # Заглушка для what-if симулятора
-            return JSONResponse(content={
-                "diagram": """flowchart TD
-                A["What-If Симулятор (демо-режим)"] --> B{{"Для полной версии требуется API ключ"}}
-                B --> C["Базовая диаграмма"]
-                C --> D["Для активации полной версии"]
-                D --> E["Укажите GROQ_API_KEY в переменных окружения"]
-                """,
-                "explanation": "Это демонстрационная версия What-If симулятора. Для доступа к полной функциональности необходимо указать GROQ_API_KEY в переменных окружения."
-            })
-            
-        question = request.question
-        context = request.context or ""
-        
-        # Выбираем шаблон в зависимости от вопроса
-        diagram = ""
-        explanation = ""
-        
-        # Юридические сценарии
-        if any(term in question.lower() for term in ["gdpr", "персонал", "personal data", "данные"]):
-            diagram = """flowchart TD
-            A[Обработка персональных данных] --> B{Есть основание?}
-            B -->|Consent/Contract| C[Определить цели и объем]
-            B -->|Нет| H[Запрет/Ограничить]
-            C --> D{Передача за пределы ЕЭЗ?}
-            D -->|Да| E[SCC/Адекватность]
-            D -->|Нет| F[Локальная обработка]
-            C --> G[Права субъекта, сроки хранения]"""
-            explanation = "Диаграмма показывает процесс обработки персональных данных в соответствии с GDPR. Ключевые требования: наличие правового основания, особые условия для трансграничной передачи, обеспечение прав субъектов."
-            
-        elif any(term in question.lower() for term in ["наруш", "breach", "неконкурен", "non-compete", "договор", "контракт"]):
-            diagram = """flowchart TD
-            A[Нарушение договора] --> B{Уведомление контрагента?}
-            B -->|Да| C[Попытка урегулирования]
-            B -->|Нет| D[Расторжение/штраф]
-            C --> E{Согласие достигнуто?}
-            E -->|Да| F[Доп. соглашение]
-            E -->|Нет| D
-            D --> G[Судебная перспектива]"""
-            explanation = "Диаграмма показывает возможные сценарии при нарушении договора. В случае нарушения пункта о неконкуренции возможны штрафные санкции, судебные разбирательства и запрет на ведение деятельности."
-            
-        # Корпоративные сценарии
-        elif any(term in question.lower() for term in ["компания", "корпоратив", "акционер", "устав", "company", "corporate"]):
-            diagram = """flowchart TD
-            A[Корпоративное решение] --> B{Требуется согласие?}
-            B -->|Совет директоров| C[Созыв заседания]
-            B -->|Общее собрание| D[Созыв ОСА]
-            B -->|Нет| E[Решение исп. органа]
-            C --> F[Протокол СД]
-            D --> G[Протокол ОСА]
-            F --> H[Исполнение решения]
-            G --> H
-            E --> H"""
-            explanation = "Диаграмма показывает процесс принятия корпоративных решений в зависимости от компетенции органов управления. Для разных типов решений требуется одобрение соответствующего органа."
-            
-        # Налоговые сценарии
-        elif any(term in question.lower() for term in ["налог", "tax", "ндс", "налогообложение"]):
-            diagram = """flowchart TD
-            A[Налоговый сценарий] --> B{Тип операции?}
-            B -->|Внутренняя| C[Стандартный учет]
-            B -->|Международная| D[Проверка на BEPS]
-            C --> E[Налоговые риски]
-            D --> F{Есть соглашение?}
-            F -->|Да| G[Применение СОИДН]
-            F -->|Нет| H[Общий порядок]
-            G --> I[Отчетность]
-            H --> I
-            E --> I"""
-            explanation = "Диаграмма показывает процесс налогового планирования и учета в зависимости от типа операций. Для международных операций важно учитывать наличие соглашений об избежании двойного налогообложения."
-            
-        # Общий шаблон для других сценариев
-        else:
-            # Создаем более детальную диаграмму на основе ключевых слов в вопросе
-            keywords = ["риск", "срок", "ответственность", "санкция", "штраф", "суд", "арбитраж", "спор"]
-            scenario = question[:40] + '...' if len(question) > 40 else question
-            
-            # Определяем тип сценария
-            scenario_type = "Юридический сценарий"
-            for word in ["бизнес", "компания", "продажи", "маркетинг"]:
-                if word in question.lower():
-                    scenario_type = "Бизнес-сценарий"
-                    break
-                    
-            diagram = f"""flowchart TD
-            A["{scenario_type}: {scenario}"] --> B{{Оценка рисков}}
-            B -->|Высокий| C[Детальный анализ]
-            B -->|Средний| D[Мониторинг]
-            B -->|Низкий| E[Стандартная процедура]
-            C --> F[Юридическая консультация]
-            C --> G[План снижения рисков]
-            D --> H[Контрольные точки]
-            F --> I[Принятие решения]
-            G --> I
-            H --> I
-            E --> I"""
-            
-            explanation = f"Диаграмма показывает процесс анализа и принятия решений для сценария: '{question}'. После оценки рисков применяются различные стратегии в зависимости от их уровня, с последующим контролем и принятием окончательного решения."
-        
-        return JSONResponse(content={
-            "diagram": diagram,
-            "explanation": explanation
-        })
+        # Кэш сгенерированных сценариев, затем библиотека (эмбеддинги + ключевые слова), затем LLM
+        result = await whatif.resolve(request.question, request.context)
+        return JSONResponse(content=result)
     except Exception as e:
         logging.error(f"Ошибка генерации What-if диаграммы: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка генерации What-if диаграммы: {str(e)}")
 
 
+@jobs.handler("document.analyze", queue="analysis", executor="async")
+async def analyze_document_job(ctx: jobs.JobContext, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Фоновый map-reduce анализ документа"""
+    return await analysis_pipeline.analyze(payload["document_text"], payload["analysis_type"], progress=ctx.report)
+
+
 # Анализ документов
 @app.post("/api/analyze")
-async def analyze_document(request: DocumentAnalysisRequest):
-    """Анализ документа с выделением ключевых моментов, рисков и рекомендаций"""
+async def analyze_document(request: DocumentAnalysisRequest, idempotency_key: Optional[str] = Header(None)):
+    """Map-reduce анализ документа по фрагментам. С background=true ставится в очередь и возвращает задачу"""
     try:
-        document_text = request.document_text
-        analysis_type = request.analysis_type
-        
-        # В реальном приложении здесь был бы вызов LLM для анализа документа
-        # В демо используем шаблонный анализ
-        
-        # Базовый анализ документа
-        summary = "Документ содержит примерно {len(document_text.split())} слов и относится к юридической документации."
-        key_points = [
-            "Определены основные стороны договора и их обязательства",
-            "Указаны сроки исполнения и условия оплаты",
-            "Присутствуют положения о конфиденциальности"
-        ]
-        risks = []
-        recommendations = []
-        
-        # Дополнительный анализ в зависимости от типа
-        if analysis_type == "legal":
-            key_points.extend([
-                "Прописаны правовые основания и юрисдикция",
-                "Указан порядок разрешения споров"
-            ])
-        elif analysis_type == "risks":
-            risks = [
-                "Нечетко прописаны условия ответственности сторон",
-                "Отсутствуют четкие критерии приемки работ",
-                "Не прописан порядок изменения условий договора"
-            ]
-            recommendations = [
-                "Уточнить пределы ответственности сторон",
-                "Добавить четкие критерии приемки работ",
-                "Прописать порядок изменения условий договора"
-            ]
+        if request.background:
+            job = await asyncio.to_thread(jobs.enqueue, "document.analyze", {
+                "document_id": request.document_id,
+                "document_text": request.document_text,
+                "analysis_type": request.analysis_type
+            }, idempotency_key)
+            return JSONResponse(status_code=202, content=job)
         
-        # Анализ ключевых слов в документе
-        text_lower = document_text.lower()
-        if "gdpr" in text_lower or "персональн" in text_lower:
-            key_points.append("Содержит положения о персональных данных")
-            if analysis_type == "risks":
-                risks.append("Требуется проверка на соответствие GDPR")
-                recommendations.append("Провести комплаенс-чек по GDPR")
-        
-        if "неконкурен" in text_lower or "non-compete" in text_lower:
-            key_points.append("Содержит положения о неконкуренции")
-            if analysis_type == "risks":
-                risks.append("Требуется проверка положений о неконкуренции на соответствие законодательству")
-        
-        return JSONResponse(content={
-            "summary": summary,
-            "key_points": key_points,
-            "risks": risks,
-            "recommendations": recommendations
-        })
+        result = await analysis_pipeline.analyze(request.document_text, request.analysis_type)
+        return JSONResponse(content=result)
     except Exception as e:
         logging.error(f"Ошибка анализа документа: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка анализа документа: {str(e)}")
 
 
+# Перевод документов
+@app.post("/api/translate")
+async def translate_document(request: TranslationRequest):
+    """Перевод текста по сегментам: повторяющиеся сегменты берутся из памяти переводов, остальные переводятся пакетами"""
+    if not request.text.strip():
+        raise HTTPException(status_code=400, detail="Текст не может быть пустым")
+    if len(request.text) > translation.TRANSLATION_MAX_CHARS:
+        raise HTTPException(status_code=400, detail=f"Текст длиннее {translation.TRANSLATION_MAX_CHARS} символов")
+    try:
+        result = await translation.translate_text(
+            request.text, request.source, request.target,
+            legal_terms=request.legal_terms, preserve_formatting=request.preserve_formatting,
+        )
+        return JSONResponse(content=result)
+    except Exception as e:
+        logging.error(f"Ошибка перевода: {e}")
+        raise HTTPException(status_code=500, detail=f"Ошибка перевода: {str(e)}")
+
+
 # Регистрация пользователя
 @app.post("/api/register")
 async def register(user: UserRegister):
@@ -1074,7 +1141,7 @@ async def login(user: UserLogin):
 async def get_current_user(user_id: int):
     """Получение информации о текущем пользователе"""
     try:
-        conn = sqlite3.connect(database.DB_PATH)
+        conn = database.get_connection()
         cursor = conn.cursor()
         
         cursor.execute("SELECT id, username, email, created_at FROM users WHERE id = ?", (user_id,))
@@ -0,0 +1,513 @@
+import os
+import json
+import time
+import bisect
+import logging
+import functools
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import tracing
+
+# Каталог снимков метрик воркеров (uvicorn --workers N). Пусто - только метрики текущего процесса
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+# Как часто воркер сбрасывает снимок своих метрик на диск (секунды)
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "5"))
+
+# Границы корзин гистограмм длительности (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Границы корзин размера пакета (число элементов)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self) -> float:
+        return self.value
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1.0):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # Счетчики по корзинам без накопления; последняя корзина - +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self) -> List[Any]:
+        with self._lock:
+            return [list(self.counts), self.sum]
+
+
+class _Metric:
+    """Метрика с набором серий по значениям меток
+
+    Общего лока на обновление нет: лок реестра берется только при создании
+    новой серии, у каждой серии свой короткий лок.
+    """
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: Any):
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "type": self.kind,
+            "help": self.documentation,
+            "labelnames": list(self.labelnames),
+            "samples": [[list(key), child.snapshot()] for key, child in list(self._children.items())],
+        }
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount: float = 1.0):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {**super().snapshot(), "buckets": list(self.buckets)}
+
+
+_registry: Dict[str, _Metric] = {}
+_registry_lock = threading.Lock()
+
+
+def _register(metric: _Metric) -> _Metric:
+    with _registry_lock:
+        existing = _registry.get(metric.name)
+        if existing is not None:
+            return existing
+        _registry[metric.name] = metric
+        return metric
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    """Счетчик из реестра (создается при первом обращении)"""
+    return _register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    """Текущее значение из реестра"""
+    return _register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """Гистограмма из реестра"""
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+
+# Метрики сервиса
+HTTP_REQUESTS = counter("explainer_http_requests_total", "HTTP-запросы по маршруту и коду ответа", ("method", "route", "status"))
+HTTP_DURATION = histogram("explainer_http_request_duration_seconds", "Длительность HTTP-запроса до последнего байта ответа", ("method", "route"))
+HTTP_IN_FLIGHT = gauge("explainer_http_requests_in_flight", "HTTP-запросы в обработке")
+UPSTREAM_DURATION = histogram("explainer_upstream_duration_seconds", "Длительность вызова внешнего сервиса (LLM, TTS, видео)", ("upstream", "backend", "operation", "outcome"))
+DB_QUERY_DURATION = histogram("explainer_db_query_duration_seconds", "Длительность операции с SQLite", ("db", "operation"), buckets=DB_BUCKETS)
+CACHE_REQUESTS = counter("explainer_cache_requests_total", "Обращения к кешам: попадания и промахи", ("cache", "result"))
+FALLBACKS = counter("explainer_fallback_responses_total", "Ответы из локального фолбэка вместо внешнего сервиса", ("kind",))
+EMBEDDING_BATCH_SIZE = histogram("explainer_embedding_batch_size", "Число текстов в одном пакете кодирования запросов", buckets=BATCH_BUCKETS)
+EMBEDDING_QUEUE_WAIT = histogram("explainer_embedding_queue_wait_seconds", "Ожидание запроса на кодирование до начала его пакета", buckets=DB_BUCKETS)
+
+
+@contextmanager
+def track_upstream(upstream: str, backend: str, operation: str) -> Iterator[None]:
+    """Замер вызова внешнего сервиса (и спан трассировки); исключение учитывается как outcome=error"""
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        with tracing.span(f"{upstream}.{operation}"):
+            yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        UPSTREAM_DURATION.labels(upstream, backend, operation, outcome).observe(time.perf_counter() - start)
+
+
+def timed_query(db: str):
+    """Декоратор: длительность функции работы с базой (и спан трассировки), operation - имя функции"""
+    def decorator(func):
+        span_name = f"{db}.{func.__name__.lstrip('_')}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                with tracing.span(span_name):
+                    return func(*args, **kwargs)
+            finally:
+                DB_QUERY_DURATION.labels(db, func.__name__).observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def cache_lookup(cache: str, hit: bool, count: int = 1):
+    """Учет обращения к кешу"""
+    if count:
+        CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc(count)
+
+
+def fallback(kind: str):
+    """Учет ответа из фолбэка"""
+    FALLBACKS.labels(kind).inc()
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: длительность и число запросов по шаблону маршрута, запросы в обработке
+
+    Длительность считается до отправки последнего байта, поэтому потоковые
+    ответы (NDJSON, аудио) учитываются целиком.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        HTTP_IN_FLIGHT.inc()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+            route = _route_template(scope)
+            HTTP_DURATION.labels(scope["method"], route).observe(time.perf_counter() - start)
+            HTTP_REQUESTS.labels(scope["method"], route, status).inc()
+
+
+def _route_template(scope: Dict[str, Any]) -> str:
+    # Шаблон пути (/api/jobs/{job_id}), а не сам путь: число серий не растет с числом id
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    if scope.get("root_path"):
+        return scope["root_path"] + "/*"  # Смонтированные статические файлы
+    return "unmatched"
+
+
+def snapshot() -> Dict[str, Any]:
+    """Снимок всех метрик текущего процесса"""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    return {"pid": os.getpid(), "started": _started, "metrics": {metric.name: metric.snapshot() for metric in metrics}}
+
+
+# Экземпляр процесса: файл снимка не перезаписывается процессом, получившим тот же pid позже
+_started = time.time()
+_instance = uuid.uuid4().hex[:8]
+
+
+def _snapshot_path() -> str:
+    return os.path.join(METRICS_DIR, f"metrics-{os.getpid()}-{_instance}.json")
+
+
+def clear_snapshots():
+    """Удаление снимков прошлых запусков (вызывается мастером до старта воркеров)
+
+    Иначе счетчики всех прежних запусков и завершившихся воркеров суммируются в /metrics бесконечно.
+    """
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return
+    for filename in os.listdir(METRICS_DIR):
+        if filename.startswith("metrics-"):
+            try:
+                os.remove(os.path.join(METRICS_DIR, filename))
+            except OSError:
+                pass
+
+
+def expire_snapshots():
+    """Удаление снимков завершившихся процессов (при старте каждого воркера)
+
+    Без мастера serve.py (uvicorn --workers N) снимки прошлых запусков иначе никто не удаляет.
+    """
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return
+    for filename in os.listdir(METRICS_DIR):
+        if not (filename.startswith("metrics-") and filename.endswith(".json")):
+            continue
+        try:
+            pid = int(filename.split("-")[1])
+        except (IndexError, ValueError):
+            continue
+        if pid != os.getpid() and not _pid_alive(pid):
+            try:
+                os.remove(os.path.join(METRICS_DIR, filename))
+            except OSError:
+                pass
+
+
+def flush():
+    """Запись снимка метрик процесса в METRICS_DIR (атомарная замена файла)"""
+    if not METRICS_DIR:
+        return
+    path = _snapshot_path()
+    temp_path = f"{path}.tmp"
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot(), f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logging.warning(f"Не удалось сохранить снимок метрик: {e}")
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def collect() -> List[Dict[str, Any]]:
+    """Снимки всех воркеров: текущий процесс - живые значения, остальные - с диска
+
+    Значения gauge завершившихся воркеров отбрасываются, счетчики и гистограммы сохраняются.
+    Из нескольких снимков с одним pid живым может быть только самый поздний.
+    """
+    snapshots = [snapshot()]
+    if not METRICS_DIR or not os.path.isdir(METRICS_DIR):
+        return snapshots
+    own = os.path.basename(_snapshot_path())
+    others = []
+    for filename in os.listdir(METRICS_DIR):
+        if not (filename.startswith("metrics-") and filename.endswith(".json")):
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, filename), "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue  # Файл удален или еще пишется
+        if filename == own:
+            continue
+        others.append(data)
+    latest: Dict[int, float] = {os.getpid(): _started}
+    for data in others:
+        pid = data.get("pid", 0)
+        latest[pid] = max(latest.get(pid, 0.0), data.get("started", 0.0))
+    for data in others:
+        pid = data.get("pid", 0)
+        data["alive"] = data.get("started", 0.0) == latest[pid] and pid != os.getpid() and _pid_alive(pid)
+        snapshots.append(data)
+    return snapshots
+
+
+def merge(snapshots: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """Сложение серий одинаковых метрик из разных процессов"""
+    merged: Dict[str, Dict[str, Any]] = {}
+    for data in snapshots:
+        for name, metric in data["metrics"].items():
+            if metric["type"] == "gauge" and not data.get("alive", True):
+                continue
+            target = merged.setdefault(name, {**metric, "samples": {}})
+            samples = target["samples"]
+            for labels, value in metric["samples"]:
+                key = tuple(labels)
+                if metric["type"] != "histogram":
+                    samples[key] = samples.get(key, 0) + value
+                elif metric["buckets"] == target["buckets"]:
+                    counts, total = samples.get(key, ([0] * len(value[0]), 0.0))
+                    samples[key] = ([a + b for a, b in zip(counts, value[0])], total + value[1])
+    return merged
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def render(merged: Dict[str, Dict[str, Any]]) -> str:
+    """Текстовый формат Prometheus 0.0.4"""
+    lines = []
+    for name in sorted(merged):
+        metric = merged[name]
+        names = metric["labelnames"]
+        lines.append(f"# HELP {name} {_escape(metric['help'])}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        for key in sorted(metric["samples"]):
+            value = metric["samples"][key]
+            if metric["type"] != "histogram":
+                lines.append(f"{name}{_labels(names, key)} {_number(value)}")
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(metric["buckets"] + [None], counts):
+                cumulative += count
+                le = "+Inf" if bound is None else repr(float(bound))
+                lines.append(f"{name}_bucket{_labels(names, key, ('le', le))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(names, key)} {_number(total)}")
+            lines.append(f"{name}_count{_labels(names, key)} {cumulative}")
+
+    # Доля попаданий в кеш - производная от счетчиков, для дашбордов без PromQL
+    cache = merged.get(CACHE_REQUESTS.name)
+    if cache:
+        totals: Dict[str, List[float]] = {}
+        for (name, result), value in cache["samples"].items():
+            entry = totals.setdefault(name, [0.0, 0.0])
+            entry[0 if result == "hit" else 1] += value
+        lines.append("# HELP explainer_cache_hit_ratio Доля попаданий в кеш с запуска")
+        lines.append("# TYPE explainer_cache_hit_ratio gauge")
+        for name in sorted(totals):
+            hits, misses = totals[name]
+            ratio = hits / (hits + misses) if hits + misses else 0.0
+            lines.append(f"explainer_cache_hit_ratio{_labels(('cache',), (name,))} {_number(round(ratio, 6))}")
+    return "\n".join(lines) + "\n"
+
+
+def exposition() -> str:
+    """Метрики всех воркеров в формате Prometheus"""
+    return render(merge(collect()))
+
+
+_flush_stop: Optional[threading.Event] = None
+
+
+def _flush_loop(stop: threading.Event):
+    while not stop.wait(METRICS_FLUSH_INTERVAL):
+        flush()
+
+
+def start():
+    """Периодический сброс снимка метрик (только при заданном METRICS_DIR)"""
+    global _flush_stop
+    if not METRICS_DIR or _flush_stop is not None:
+        return
+    expire_snapshots()
+    _flush_stop = threading.Event()
+    threading.Thread(target=_flush_loop, args=(_flush_stop,), name="metrics-flush", daemon=True).start()
+    flush()
+
+
+def stop():
+    """Остановка сброса с финальным снимком: счетчики воркера не теряются после его завершения"""
+    global _flush_stop
+    if _flush_stop is not None:
+        _flush_stop.set()
+        _flush_stop = None
+    flush()
+
+
+def _reset_after_fork():
+    # Дочерний процесс начинает со своих нулей: иначе значения родителя учитываются дважды
+    # Локи могли быть захвачены потоками родителя в момент fork - создаются заново
+    global _flush_stop, _registry_lock, _started, _instance
+    _flush_stop = None
+    _started = time.time()
+    _instance = uuid.uuid4().hex[:8]
+    _registry_lock = threading.Lock()
+    for metric in _registry.values():
+        metric._children = {}
+        metric._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,188 @@
+"""Локальная замена Groq (OpenAI-совместимый chat/completions) и HeyGen для нагрузочных тестов
+
+Запуск: python mock_upstreams.py [--port 9100] [--latency-ms 800] [--jitter-ms 200] [--rate-429 0.05]
+
+Приложение направляется на заглушку переменными окружения:
+    GROQ_API_URL=http://127.0.0.1:9100/openai/v1/chat/completions GROQ_API_KEY=mock
+    HEYGEN_API_URL=http://127.0.0.1:9100 HEYGEN_API_KEY=mock
+"""
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from collections import Counter
+from typing import Any, Dict, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+
+# Параметры заглушки (переопределяются аргументами командной строки)
+MOCK_LATENCY_MS = float(os.getenv("MOCK_LATENCY_MS", "800"))
+MOCK_JITTER_MS = float(os.getenv("MOCK_JITTER_MS", "200"))
+MOCK_RATE_429 = float(os.getenv("MOCK_RATE_429", "0"))
+MOCK_RETRY_AFTER = int(os.getenv("MOCK_RETRY_AFTER", "1"))
+# Потоковый ответ: пауза между чанками (мс) и число слов в чанке
+MOCK_STREAM_CHUNK_MS = float(os.getenv("MOCK_STREAM_CHUNK_MS", "30"))
+MOCK_STREAM_WORDS = 3
+# HeyGen: через сколько секунд видео готово и размер файла результата
+MOCK_VIDEO_RENDER_S = float(os.getenv("MOCK_VIDEO_RENDER_S", "5"))
+MOCK_VIDEO_BYTES = int(os.getenv("MOCK_VIDEO_BYTES", str(2 * 1024 * 1024)))
+
+ANSWER_WORDS = (
+    "Согласно условиям договора стороны обязаны уведомлять друг друга об изменении реквизитов "
+    "в течение пяти рабочих дней. Ответственность за просрочку оплаты ограничена неустойкой. "
+    "Рекомендуется уточнить порядок расторжения и сроки претензионного порядка."
+).split()
+
+app = FastAPI(title="explAiner upstream mock")
+calls: Counter = Counter()
+videos: Dict[str, float] = {}
+rng = random.Random()
+
+
+async def _delay():
+    await asyncio.sleep(max(0.0, MOCK_LATENCY_MS + rng.uniform(-MOCK_JITTER_MS, MOCK_JITTER_MS)) / 1000)
+
+
+def _throttled(name: str) -> Optional[Response]:
+    """429 с Retry-After с заданной вероятностью, иначе None"""
+    if MOCK_RATE_429 and rng.random() < MOCK_RATE_429:
+        calls[f"{name}_429"] += 1
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": str(MOCK_RETRY_AFTER)},
+            content={"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_exceeded"}},
+        )
+    return None
+
+
+def _answer(payload: Dict[str, Any]) -> str:
+    words = min(len(ANSWER_WORDS), max(5, int(payload.get("max_tokens") or 200) // 4))
+    text = " ".join(ANSWER_WORDS[:words])
+    if (payload.get("response_format") or {}).get("type") == "json_object":
+        # Формат, который ждут analysis_pipeline и whatif
+        return json.dumps({
+            "summary": text[:200],
+            "key_points": ANSWER_WORDS[:3],
+            "risks": [],
+            "recommendations": [],
+            "diagram": "flowchart TD\n    A[Вопрос] --> B{Риск}\n    B --> C[Решение]",
+            "explanation": text[:200],
+            "tags": ["mock"],
+        }, ensure_ascii=False)
+    return text
+
+
+@app.post("/openai/v1/chat/completions")
+async def chat_completions(request: Request):
+    calls["chat"] += 1
+    throttled = _throttled("chat")
+    if throttled:
+        return throttled
+    payload = await request.json()
+    content = _answer(payload)
+    model = payload.get("model", "mock")
+    usage = {"prompt_tokens": sum(len(m.get("content", "")) // 4 for m in payload.get("messages", [])), "completion_tokens": len(content) // 4}
+
+    if not payload.get("stream"):
+        await _delay()
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    async def events():
+        # Задержка до первого токена, затем чанки по MOCK_STREAM_WORDS слов (SSE, как у OpenAI)
+        await _delay()
+        words = content.split(" ")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        for start in range(0, len(words), MOCK_STREAM_WORDS):
+            piece = " ".join(words[start:start + MOCK_STREAM_WORDS]) + " "
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            await asyncio.sleep(MOCK_STREAM_CHUNK_MS / 1000)
+        final = {"id": completion_id, "object": "chat.completion.chunk", "model": model,
+                 "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        yield f"data: {json.dumps(final)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/v1/video.generate")
+async def video_generate(request: Request):
+    calls["video_generate"] += 1
+    throttled = _throttled("video_generate")
+    if throttled:
+        return throttled
+    await request.json()
+    await _delay()
+    video_id = uuid.uuid4().hex
+    videos[video_id] = time.monotonic()
+    return {"error": None, "data": {"video_id": video_id}}
+
+
+@app.get("/v1/video_status/{video_id}")
+async def video_status(video_id: str, request: Request):
+    calls["video_status"] += 1
+    started = videos.get(video_id)
+    if started is None:
+        return {"data": {"status": "failed", "error_msg": "unknown video_id"}}
+    if time.monotonic() - started < MOCK_VIDEO_RENDER_S:
+        return {"data": {"status": "processing"}}
+    return {"data": {"status": "completed", "video_url": f"{str(request.base_url).rstrip('/')}/files/{video_id}.mp4"}}
+
+
+@app.get("/files/{video_id}.mp4")
+async def video_file(video_id: str):
+    calls["video_download"] += 1
+
+    async def body():
+        chunk = b"\0" * (256 * 1024)
+        sent = 0
+        while sent < MOCK_VIDEO_BYTES:
+            part = chunk[:MOCK_VIDEO_BYTES - sent]
+            sent += len(part)
+            yield part
+
+    return StreamingResponse(body(), media_type="video/mp4", headers={"Content-Length": str(MOCK_VIDEO_BYTES)})
+
+
+@app.get("/stats")
+async def stats():
+    """Число обращений к заглушке (для отчета нагрузочного теста)"""
+    return dict(calls)
+
+
+def main():
+    global MOCK_LATENCY_MS, MOCK_JITTER_MS, MOCK_RATE_429, MOCK_STREAM_CHUNK_MS, MOCK_VIDEO_RENDER_S
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=MOCK_LATENCY_MS, help="задержка ответа (до первого токена при stream)")
+    parser.add_argument("--jitter-ms", type=float, default=MOCK_JITTER_MS)
+    parser.add_argument("--rate-429", type=float, default=MOCK_RATE_429, help="доля ответов 429")
+    parser.add_argument("--stream-chunk-ms", type=float, default=MOCK_STREAM_CHUNK_MS)
+    parser.add_argument("--video-render-s", type=float, default=MOCK_VIDEO_RENDER_S)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    MOCK_LATENCY_MS, MOCK_JITTER_MS, MOCK_RATE_429 = args.latency_ms, args.jitter_ms, args.rate_429
+    MOCK_STREAM_CHUNK_MS, MOCK_VIDEO_RENDER_S = args.stream_chunk_ms, args.video_render_s
+    if args.seed is not None:
+        rng.seed(args.seed)
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,59 @@
 import os
-from sentence_transformers import SentenceTransformer
+import re
+import bisect
 import numpy as np
 import sqlite3
 import json
 
-def build_vector_db():
-    """Создание векторной базы данных для документов"""
-    print("Начинаю создание векторной базы данных...")
-    
-    # Инициализация модели для эмбеддингов
-    try:
-        model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
-        print("[✓] Модель загружена")
-    except Exception as e:
-        print(f"[!] Ошибка загрузки модели: {e}")
-        return
-    
-    # Создание базы данных
-    conn = sqlite3.connect('vectors.db')
+import jobs
+
+# Корпус кодексов и база индексов
+KODEKS_DIR = os.getenv("KODEKS_DIR", "kodeks")
+VECTOR_DB_PATH = os.getenv("VECTOR_DB_PATH", "vectors.db")
+CHUNK_SIZE = 1000
+CHUNK_STEP = 950
+
+# Заголовок статьи в начале строки: "Статья 169." / "Статья 25-1." / "Статья 354. Название"
+ARTICLE_HEADING_RE = re.compile(r"^[ \t]*Статья[ \t]+(\d+(?:[.-]\d+)*)", re.MULTILINE)
+
+# Определение кодекса по имени файла или заголовку (процессуальные проверяются первыми)
+CODE_PATTERNS = [
+    ("УПК", re.compile(r"уголовно[- ]?процессуальн|ugolovno[-_ ]?process|upk", re.IGNORECASE)),
+    ("ГПК", re.compile(r"гражданск\w*[- ]?процессуальн|grazhdansk\w*[-_ ]?process|gpk", re.IGNORECASE)),
+    ("ЭПК", re.compile(r"экономическ\w*[- ]?процессуальн|хозяйственн\w*[- ]?процессуальн|epk|hpk", re.IGNORECASE)),
+    ("КоАП", re.compile(r"административн\w* ответственност|об административных|коап|koap", re.IGNORECASE)),
+    ("УК", re.compile(r"уголовн|ugolov|(?<![a-z])uk(?![a-z])", re.IGNORECASE)),
+    ("ГК", re.compile(r"гражданск|grazhd|(?<![a-z])gk(?![a-z])", re.IGNORECASE)),
+    ("ТК", re.compile(r"трудов|trudov|(?<![a-z])tk(?![a-z])", re.IGNORECASE)),
+    ("НК", re.compile(r"налогов|nalog|(?<![a-z])nk(?![a-z])", re.IGNORECASE)),
+    ("СК", re.compile(r"семейн|semejn|semein", re.IGNORECASE)),
+    ("ЖК", re.compile(r"жилищн|zhilishch", re.IGNORECASE)),
+    ("ЗК", re.compile(r"земельн|zemeln", re.IGNORECASE)),
+    ("ТмК", re.compile(r"таможенн|tamozhen", re.IGNORECASE)),
+    ("БК", re.compile(r"бюджетн|byudzhet|budzhet", re.IGNORECASE)),
+]
+
+def iter_chunks(content: str):
+    """Чанки текста с перекрытием: (смещение, текст)"""
+    for start in range(0, len(content), CHUNK_STEP):
+        yield start, content[start:start + CHUNK_SIZE]
+
+def read_corpus_file(full_path: str) -> str:
+    """Текст файла без преобразования переводов строк: смещения совпадают с файлом"""
+    with open(full_path, 'r', encoding='utf-8', newline='') as f:
+        return f.read()
+
+def detect_code(filename: str, content: str) -> str:
+    """Сокращение кодекса (УК, ГК, ...) по имени файла, иначе по заголовку документа"""
+    for source in (filename, content[:500]):
+        for code, pattern in CODE_PATTERNS:
+            if pattern.search(source):
+                return code
+    return os.path.splitext(filename)[0]
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
-    
     # Создание таблицы для векторов
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS document_vectors (
@@ -30,46 +64,221 @@ def build_vector_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    # Миграция: смещение чанка в файле (для связи со статьями)
+    cursor.execute("PRAGMA table_info(document_vectors)")
+    if "chunk_start" not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute("ALTER TABLE document_vectors ADD COLUMN chunk_start INTEGER")
+    # Точный индекс статей: (кодекс, номер статьи) -> файл, смещения и чанки
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS article_index (
+            code TEXT NOT NULL,
+            article TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            title TEXT NOT NULL,
+            start INTEGER NOT NULL,
+            end INTEGER NOT NULL,
+            byte_start INTEGER NOT NULL,
+            byte_end INTEGER NOT NULL,
+            chunk_ids TEXT NOT NULL,
+            PRIMARY KEY (code, article, filename)
+        )
+    ''')
+    return conn
+
+def load_model():
+    """Модель эмбеддингов для индексации; None, если недоступна"""
+    try:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+        print("[✓] Модель загружена")
+        return model
+    except Exception as e:
+        print(f"[!] Ошибка загрузки модели: {e}")
+        return None
+
+def index_file_vectors(cursor, model, filename: str, content: str) -> int:
+    """Чанки одного файла в векторной базе; прежние чанки файла удаляются"""
+    cursor.execute("DELETE FROM document_vectors WHERE filename = ?", (filename,))
+    count = 0
+    # Разбиваем на чанки (упрощенная версия)
+    for chunk_start, chunk in iter_chunks(content):
+        if len(chunk.strip()) < 50:  # Пропускаем слишком короткие чанки
+            continue
+            
+        # Создаем эмбеддинг
+        vector = model.encode(chunk)
+        vector_blob = vector.tobytes()
+        
+        # Сохраняем в базу
+        cursor.execute('''
+            INSERT INTO document_vectors (filename, content, vector, chunk_start)
+            VALUES (?, ?, ?, ?)
+        ''', (filename, chunk, vector_blob, chunk_start))
+        count += 1
+    return count
+
+def index_file_articles(cursor, filename: str, content: str) -> int:
+    """Статьи одного файла в точном индексе; прежние записи файла удаляются"""
+    cursor.execute("DELETE FROM article_index WHERE filename = ?", (filename,))
+    code = detect_code(filename, content)
+
+    cursor.execute(
+        "SELECT id, chunk_start FROM document_vectors WHERE filename = ? AND chunk_start IS NOT NULL ORDER BY chunk_start",
+        (filename,)
+    )
+    chunks = cursor.fetchall()
+    chunk_starts = [chunk_start for _, chunk_start in chunks]
+
+    article_count = 0
+    headings = list(ARTICLE_HEADING_RE.finditer(content))
+    byte_pos = 0
+    prev = 0
+    for index, match in enumerate(headings):
+        start = match.start()
+        end = headings[index + 1].start() if index + 1 < len(headings) else len(content)
+        # Байтовые смещения считаются нарастающим итогом - чтение статьи без загрузки всего файла
+        byte_pos += len(content[prev:start].encode('utf-8'))
+        byte_len = len(content[start:end].encode('utf-8'))
+        prev = start
+
+        line_end = content.find("\n", start, end)
+        title = content[start:line_end if line_end != -1 else end].strip()
+        # Чанки, пересекающие статью: начало в (start - CHUNK_SIZE, end)
+        first = bisect.bisect_right(chunk_starts, start - CHUNK_SIZE)
+        last = bisect.bisect_left(chunk_starts, end)
+        chunk_ids = [chunk_id for chunk_id, _ in chunks[first:last]]
+        # Номер повторяется, например, в приложениях: оставляем первое вхождение
+        cursor.execute('''
+            INSERT OR IGNORE INTO article_index (code, article, filename, title, start, end, byte_start, byte_end, chunk_ids)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (code, match.group(1), filename, title[:300], start, end, byte_pos, byte_pos + byte_len, json.dumps(chunk_ids)))
+        article_count += cursor.rowcount
+
+    print(f"[✓] Статьи проиндексированы: {filename} ({code}, {len(headings)})")
+    return article_count
+
+def build_vector_db(progress=None):
+    """Создание векторной базы данных для документов
+    
+    progress - необязательный callback(доля, сообщение) для фоновой задачи.
+    """
+    print("Начинаю создание векторной базы данных...")
+    
+    # Инициализация модели для эмбеддингов
+    model = load_model()
+    if model is None:
+        return
+    
+    # Создание базы данных
+    conn = _connect(VECTOR_DB_PATH)
+    cursor = conn.cursor()
     
-    path = "kodeks"
+    path = KODEKS_DIR
     processed_count = 0
+    filenames = sorted(f for f in os.listdir(path) if f.endswith(".txt"))
     
-    for filename in os.listdir(path):
-        if not filename.endswith(".txt"):
-            continue
-            
+    for file_index, filename in enumerate(filenames):
         full_path = os.path.join(path, filename)
         try:
-            with open(full_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
-            # Разбиваем на чанки (упрощенная версия)
-            chunks = [content[i:i+1000] for i in range(0, len(content), 950)]
-            
-            for chunk in chunks:
-                if len(chunk.strip()) < 50:  # Пропускаем слишком короткие чанки
-                    continue
-                    
-                # Создаем эмбеддинг
-                vector = model.encode(chunk)
-                vector_blob = vector.tobytes()
-                
-                # Сохраняем в базу
-                cursor.execute('''
-                    INSERT INTO document_vectors (filename, content, vector)
-                    VALUES (?, ?, ?)
-                ''', (filename, chunk, vector_blob))
-                
-                processed_count += 1
-                
+            content = read_corpus_file(full_path)
+            processed_count += index_file_vectors(cursor, model, filename, content)
             print(f"[✓] Обработан: {filename}")
             
         except Exception as e:
             print(f"[!] Ошибка при обработке {filename}: {e}")
+        
+        if progress:
+            progress((file_index + 1) / len(filenames), filename)
     
     conn.commit()
     conn.close()
     print(f"[✓] Векторная база создана! Обработано чанков: {processed_count}")
+    return processed_count
+
+def build_article_index(progress=None):
+    """Точный индекс статей кодексов: (кодекс, номер) -> смещения текста и id чанков
+
+    Модель эмбеддингов не нужна; id чанков заполняются, если векторная база уже построена.
+    """
+    conn = _connect(VECTOR_DB_PATH)
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM article_index")
+
+    path = KODEKS_DIR
+    article_count = 0
+    filenames = sorted(f for f in os.listdir(path) if f.endswith(".txt"))
+
+    for file_index, filename in enumerate(filenames):
+        try:
+            content = read_corpus_file(os.path.join(path, filename))
+            article_count += index_file_articles(cursor, filename, content)
+        except Exception as e:
+            print(f"[!] Ошибка при индексации статей {filename}: {e}")
+
+        if progress:
+            progress((file_index + 1) / len(filenames), filename)
+
+    conn.commit()
+    conn.close()
+    print(f"[✓] Индекс статей создан! Статей: {article_count}")
+    return article_count
+
+def update_index(filenames, progress=None):
+    """Инкрементальная переиндексация: только перечисленные файлы корпуса
+
+    Удаленные из kodeks файлы убираются из индекса. Без модели эмбеддингов
+    обновляется только индекс статей: прежние чанки остаются в поиске
+    до переиндексации с моделью (result["vectors"] = False).
+    """
+    model = load_model()
+    conn = _connect(VECTOR_DB_PATH)
+    cursor = conn.cursor()
+    result = {"files": len(filenames), "chunks": 0, "articles": 0, "removed": 0, "vectors": model is not None}
+
+    for file_index, filename in enumerate(filenames):
+        full_path = os.path.join(KODEKS_DIR, filename)
+        try:
+            if not os.path.exists(full_path):
+                cursor.execute("DELETE FROM document_vectors WHERE filename = ?", (filename,))
+                cursor.execute("DELETE FROM article_index WHERE filename = ?", (filename,))
+                result["removed"] += 1
+            else:
+                content = read_corpus_file(full_path)
+                if model is not None:
+                    result["chunks"] += index_file_vectors(cursor, model, filename, content)
+                result["articles"] += index_file_articles(cursor, filename, content)
+            # Фиксация по файлу: поиск видит либо старую, либо новую версию файла целиком
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"[!] Ошибка при переиндексации {filename}: {e}")
+
+        if progress:
+            progress((file_index + 1) / len(filenames), filename)
+
+    conn.close()
+    print(f"[✓] Переиндексировано файлов: {len(filenames)}, чанков: {result['chunks']}, статей: {result['articles']}")
+    return result
+
+@jobs.handler("index.build", queue="index", executor="process", max_attempts=1)
+def build_index_job(ctx, payload):
+    """Фоновое построение векторной базы и индекса статей (в пуле процессов)"""
+    processed_count = build_vector_db(progress=lambda share, message: ctx.report(share * 0.9, message))
+    # Индекс статей строится и без модели: точные ссылки работают без векторного поиска
+    article_count = build_article_index(progress=lambda share, message: ctx.report(0.9 + share * 0.1, message))
+    if processed_count is None:
+        raise RuntimeError(f"Не удалось загрузить модель эмбеддингов (индекс статей построен: {article_count})")
+    return {"chunks": processed_count, "articles": article_count}
+
+@jobs.handler("index.update", queue="index", executor="process", max_attempts=2)
+def update_index_job(ctx, payload):
+    """Фоновая переиндексация измененных файлов корпуса (после обхода crawler)"""
+    result = update_index(payload["files"], progress=ctx.report)
+    if not result["vectors"]:
+        # Ошибка, а не успех: задача повторится, когда модель станет доступна
+        raise RuntimeError(f"Не удалось загрузить модель эмбеддингов (индекс статей обновлен: {result['articles']})")
+    return result
 
 if __name__ == "__main__":
     build_vector_db()
+    build_article_index()
@@ -0,0 +1,153 @@
+"""Многопроцессный запуск: приложение и общие структуры загружаются в мастере один раз, воркеры - fork
+
+Запуск: python serve.py [--workers 4] [--host 0.0.0.0] [--port 8000] [--job-workers 1]
+
+В отличие от uvicorn --workers (каждый воркер заново импортирует приложение и строит
+свою копию модели эмбеддингов, индекса шаблонов, библиотеки сценариев и правил),
+здесь все это строится в мастере до fork, и воркеры делят страницы памяти
+copy-on-write; gc.freeze() не дает сборщику мусора их трогать. Матрицы, которые
+перестраиваются уже после fork, делятся через mmap (coordination.shared_array).
+Записи координируются через SQLite (WAL) и flock, кеши воркеров согласуются
+счетчиками версий (coordination.Channel). Только Linux/macOS: на Windows - uvicorn main:app.
+"""
+import os
+import gc
+import sys
+import time
+import signal
+import socket
+import logging
+import argparse
+
+# Число воркеров (по умолчанию - по числу ядер)
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", str(os.cpu_count() or 2)))
+# Сколько воркеров выполняют фоновые задачи: у каждого свои пулы потоков и процессов
+SERVE_JOB_WORKERS = int(os.getenv("SERVE_JOB_WORKERS", "1"))
+# Потоков torch на воркер (0 - ядра поровну между воркерами)
+SERVE_WORKER_THREADS = int(os.getenv("SERVE_WORKER_THREADS", "0"))
+# Переменные числа потоков OpenMP/MKL, читаемые torch при загрузке
+THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS")
+# Воркер, упавший быстрее этого срока после запуска, перезапускается с паузой (секунды)
+RESTART_MIN_UPTIME = 5.0
+RESTART_BACKOFF = 1.0
+
+logger = logging.getLogger("serve")
+
+
+def listen(host: str, port: int, backlog: int) -> socket.socket:
+    """Общий слушающий сокет: воркеры принимают соединения из одной очереди ядра"""
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=SERVE_WORKERS)
+    parser.add_argument("--job-workers", type=int, default=SERVE_JOB_WORKERS, help="сколько воркеров выполняют очередь задач")
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args()
+
+    if not hasattr(os, "fork"):
+        sys.exit("serve.py требует fork (Linux/macOS). На Windows: uvicorn main:app")
+
+    # Метрики воркеров сводятся через файлы: GET /metrics в любом воркере видит все процессы
+    os.environ.setdefault("METRICS_DIR", os.path.join("cache", "metrics"))
+    # Модель прогревается в мастере однопоточно: пул потоков OpenMP, созданный до fork,
+    # в дочерних процессах не работает (зависание на первой параллельной операции).
+    # Воркеры после fork делят ядра между собой (см. spawn)
+    inherited_threads = {name: os.environ.get(name) for name in THREAD_ENV_VARS}
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = "1"
+    worker_threads = SERVE_WORKER_THREADS or max(1, (os.cpu_count() or 1) // max(1, args.workers))
+
+    import uvicorn
+    from main import app
+    import database
+    import jobs
+    import warmup
+    import metrics
+    import embeddings
+
+    # Снимки метрик прошлых запусков не должны суммироваться с текущими
+    metrics.clear_snapshots()
+    # Базы и тяжелые структуры - один раз в мастере, до fork
+    started = time.perf_counter()
+    database.init_db()
+    jobs.init_db()
+    warmup.preload()
+    gc.collect()
+    gc.freeze()
+    logger.info(f"Мастер {os.getpid()}: предзагрузка за {time.perf_counter() - started:.1f}s")
+
+    sock = listen(args.host, args.port, args.backlog)
+    config = uvicorn.Config(app, log_level=args.log_level)
+    children = {}
+    stopping = False
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            # Своя группа процессов: Ctrl+C из терминала получает только мастер и передает SIGTERM
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            jobs.JOBS_ENABLED = index < args.job_workers
+            for name, value in inherited_threads.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+            embeddings.set_threads(worker_threads)
+            try:
+                uvicorn.Server(config).run(sockets=[sock])
+            finally:
+                os._exit(0)
+        children[pid] = (index, time.monotonic())
+        logger.info(f"Воркер {index} запущен: pid {pid}")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(args.workers):
+        spawn(index)
+    logger.info(f"Слушаем http://{args.host}:{args.port}, воркеров: {args.workers}")
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        if pid not in children:
+            continue
+        index, spawned_at = children.pop(pid)
+        if stopping:
+            continue
+        logger.warning(f"Воркер {index} (pid {pid}) завершился с кодом {os.waitstatus_to_exitcode(status)}, перезапуск")
+        if time.monotonic() - spawned_at < RESTART_MIN_UPTIME:
+            time.sleep(RESTART_BACKOFF)
+        if not stopping:
+            spawn(index)
+
+    sock.close()
+    logger.info("Все воркеры остановлены")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
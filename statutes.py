@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import sqlite3
+import logging
+from typing import Any, Dict, List, Tuple
+
+import metrics
+import tracing
+from rag_indexer import KODEKS_DIR, VECTOR_DB_PATH
+
+# Сколько ссылок на статьи из одного вопроса подставлять в контекст
+STATUTE_MAX_REFERENCES = int(os.getenv("STATUTE_MAX_REFERENCES", "3"))
+# Ограничение длины текста одной статьи в символах
+STATUTE_MAX_CHARS = int(os.getenv("STATUTE_MAX_CHARS", "4000"))
+
+# Кодекс в вопросе: сокращение или полное название в любом падеже
+CODE_ALIASES = [
+    ("УПК", r"УПК|уголовно[- ]процессуальн\w*\s+кодекс\w*"),
+    ("ГПК", r"ГПК|гражданск\w*\s+процессуальн\w*\s+кодекс\w*"),
+    ("ЭПК", r"ЭПК|ХПК|экономическ\w*\s+процессуальн\w*\s+кодекс\w*"),
+    ("КоАП", r"КоАП|кодекс\w*\s+об\s+административн\w*\s+ответственност\w*"),
+    ("УК", r"УК|уголовн\w*\s+кодекс\w*"),
+    ("ГК", r"ГК|гражданск\w*\s+кодекс\w*"),
+    ("ТК", r"ТК|трудов\w*\s+кодекс\w*"),
+    ("НК", r"НК|налогов\w*\s+кодекс\w*"),
+    ("СК", r"СК|семейн\w*\s+кодекс\w*"),
+    ("ЖК", r"ЖК|жилищн\w*\s+кодекс\w*"),
+    ("ЗК", r"ЗК|земельн\w*\s+кодекс\w*"),
+    ("ТмК", r"ТмК|таможенн\w*\s+кодекс\w*"),
+    ("БК", r"БК|бюджетн\w*\s+кодекс\w*"),
+]
+_CODE_GROUPS = "|".join(f"(?P<c{index}>{pattern})" for index, (_, pattern) in enumerate(CODE_ALIASES))
+_ARTICLE = r"(?:ст\.?|стать[яиеюй]\w*)\s*(?P<article{n}>\d+(?:[.-]\d+)*)"
+_CODE = r"(?:{groups})(?:\s+(?:РУз|РФ|Узбекистана|Республики\s+Узбекистан))?"
+
+# "ст. 354 ГК", "статья 169 УК РУз", "статьи 25 Трудового кодекса", "ч. 2 ст. 168 УК", "УК, ст. 169"
+ARTICLE_REF_RE = re.compile(
+    r"(?<!\w)(?:" + _ARTICLE.format(n=1) + r"\s*(?:" + _CODE.format(groups=_CODE_GROUPS) + r")"
+    + r"|" + _CODE.format(groups=_CODE_GROUPS.replace("(?P<c", "(?P<d")) + r"\s*,?\s*" + _ARTICLE.format(n=2) + r")(?!\w)",
+    re.IGNORECASE,
+)
+
+
+def _code_from_match(match: re.Match) -> str:
+    for index, (code, _) in enumerate(CODE_ALIASES):
+        if match.group(f"c{index}") or match.group(f"d{index}"):
+            return code
+    return ""
+
+
+def detect_references(text: str) -> List[Tuple[str, str]]:
+    """Ссылки на статьи в тексте: [(кодекс, номер статьи)] без повторов, в порядке появления"""
+    references = []
+    for match in ARTICLE_REF_RE.finditer(text):
+        reference = (_code_from_match(match), match.group("article1") or match.group("article2"))
+        if reference not in references:
+            references.append(reference)
+    return references
+
+
+@metrics.timed_query("vectors")
+def lookup(code: str, article: str) -> List[Dict[str, Any]]:
+    """Точный поиск статьи по индексу: текст читается из файла кодекса по байтовым смещениям"""
+    if not os.path.exists(VECTOR_DB_PATH):
+        return []
+    conn = sqlite3.connect(VECTOR_DB_PATH)
+    try:
+        rows = conn.execute(
+            "SELECT filename, title, start, end, byte_start, byte_end, chunk_ids FROM article_index WHERE code = ? AND article = ?",
+            (code, article)
+        ).fetchall()
+    except sqlite3.OperationalError:
+        # Индекс статей еще не построен
+        return []
+    finally:
+        conn.close()
+
+    results = []
+    for filename, title, start, end, byte_start, byte_end, chunk_ids in rows:
+        try:
+            with open(os.path.join(KODEKS_DIR, filename), "rb") as f:
+                f.seek(byte_start)
+                text = f.read(min(byte_end - byte_start, STATUTE_MAX_CHARS * 4)).decode("utf-8", errors="ignore")
+        except OSError as e:
+            logging.warning(f"Не удалось прочитать статью {code} ст. {article} из {filename}: {e}")
+            continue
+        text = text.strip()
+        if len(text) > STATUTE_MAX_CHARS:
+            text = text[:STATUTE_MAX_CHARS] + "…"
+        results.append({
+            "ref": f"{code} ст. {article}",
+            "code": code,
+            "article": article,
+            "title": title,
+            "filename": filename,
+            "start": start,
+            "end": end,
+            "chunk_ids": json.loads(chunk_ids),
+            "text": text,
+        })
+    return results
+
+
+@tracing.traced("statutes.find")
+def find_citations(question: str) -> List[Dict[str, Any]]:
+    """Тексты статей, на которые ссылается вопрос"""
+    citations = []
+    for code, article in detect_references(question)[:STATUTE_MAX_REFERENCES]:
+        citations.extend(lookup(code, article))
+    return citations
+
+
+def compose_prompt(prompt: str, citations: List[Dict[str, Any]]) -> str:
+    """Добавление точных текстов статей к запросу"""
+    blocks = "\n\n".join(f"[{citation['ref']}] {citation['text']}" for citation in citations)
+    return f"Тексты статей, на которые ссылается вопрос:\n{blocks}\n\nОпирайся на эти тексты и ссылайся на статьи.\n\n{prompt}"
+
+
+def format_answer(citations: List[Dict[str, Any]]) -> str:
+    """Ответ без LLM: найденные тексты статей"""
+    return "\n\n".join(f"**{citation['ref']}**\n\n{citation['text']}" for citation in citations)
+
+
+def to_sources(citations: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Источники для ответа API: без полного текста статьи"""
+    return [
+        {
+            "ref": citation["ref"],
+            "title": citation["title"],
+            "filename": citation["filename"],
+            "start": citation["start"],
+            "end": citation["end"],
+            "chunk_ids": citation["chunk_ids"],
+            "snippet": citation["text"][:200],
+        }
+        for citation in citations
+    ]
@@ -0,0 +1,214 @@
+import os
+import re
+import zlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+import coordination
+import database
+import diff_engine
+import metrics
+import tracing
+from context_builder import document_hash
+
+# Число хеш-функций MinHash и разбиение сигнатуры на полосы LSH (TEMPLATE_LSH_BANDS должно делить TEMPLATE_MINHASH_SIZE)
+TEMPLATE_MINHASH_SIZE = int(os.getenv("TEMPLATE_MINHASH_SIZE", "128"))
+TEMPLATE_LSH_BANDS = int(os.getenv("TEMPLATE_LSH_BANDS", "32"))
+# Длина шингла в словах
+TEMPLATE_SHINGLE_WORDS = int(os.getenv("TEMPLATE_SHINGLE_WORDS", "5"))
+# Против скольких лучших кандидатов запускается полный diff
+TEMPLATE_TOP_K = int(os.getenv("TEMPLATE_TOP_K", "3"))
+# Сколько блоков изменений возвращать по каждому шаблону
+TEMPLATE_MAX_HUNKS = int(os.getenv("TEMPLATE_MAX_HUNKS", "20"))
+# Кэш результатов сравнения по (хеш документа, хеш шаблона)
+TEMPLATE_RESULT_CACHE_SIZE = int(os.getenv("TEMPLATE_RESULT_CACHE_SIZE", "256"))
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+# Простое число больше 2^32: хеши шинглов 32-битные, коэффициенты < 2^31 - произведение помещается в uint64
+MERSENNE_PRIME = np.uint64(4294967311)
+# Шинглы обрабатываются порциями, чтобы матрица хешей не росла с размером документа
+SHINGLE_BATCH = 4096
+
+_rng = np.random.RandomState(1)
+_coef_a = _rng.randint(1, 2 ** 31 - 1, size=TEMPLATE_MINHASH_SIZE).astype(np.uint64)
+_coef_b = _rng.randint(0, 2 ** 31 - 1, size=TEMPLATE_MINHASH_SIZE).astype(np.uint64)
+
+
+def shingles(text: str, size: int = TEMPLATE_SHINGLE_WORDS) -> np.ndarray:
+    """32-битные хеши словесных шинглов (без учета регистра и пунктуации)"""
+    words = WORD_RE.findall(text.lower())
+    if len(words) < size:
+        words = words or [""]
+        return np.array([zlib.crc32(" ".join(words).encode("utf-8"))], dtype=np.uint64)
+    hashes = {zlib.crc32(" ".join(words[i:i + size]).encode("utf-8")) for i in range(len(words) - size + 1)}
+    return np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+
+
+def minhash(text: str) -> np.ndarray:
+    """MinHash-сигнатура текста: векторизованно по всем хеш-функциям сразу"""
+    values = shingles(text)
+    signature = np.full(TEMPLATE_MINHASH_SIZE, np.iinfo(np.uint64).max, dtype=np.uint64)
+    for start in range(0, len(values), SHINGLE_BATCH):
+        batch = values[start:start + SHINGLE_BATCH]
+        hashed = (np.outer(_coef_a, batch) + _coef_b[:, None]) % MERSENNE_PRIME
+        np.minimum(signature, hashed.min(axis=1), out=signature)
+    return signature
+
+
+def similarity(a: np.ndarray, b: np.ndarray) -> float:
+    """Оценка коэффициента Жаккара по сигнатурам"""
+    return float(np.count_nonzero(a == b)) / len(a)
+
+
+class TemplateIndex:
+    """LSH-индекс MinHash-сигнатур: кандидаты находятся по совпадению полос, без перебора библиотеки"""
+
+    def __init__(self, bands: int = TEMPLATE_LSH_BANDS):
+        self.bands = bands
+        self.rows = TEMPLATE_MINHASH_SIZE // bands
+        self.buckets: List[Dict[bytes, Set[int]]] = [{} for _ in range(bands)]
+        self.signatures: Dict[int, np.ndarray] = {}
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def add(self, template_id: int, signature: np.ndarray):
+        self.signatures[template_id] = signature
+        for band, key in enumerate(self._band_keys(signature)):
+            self.buckets[band].setdefault(key, set()).add(template_id)
+
+    def remove(self, template_id: int):
+        signature = self.signatures.pop(template_id, None)
+        if signature is None:
+            return
+        for band, key in enumerate(self._band_keys(signature)):
+            bucket = self.buckets[band].get(key)
+            if bucket is not None:
+                bucket.discard(template_id)
+                if not bucket:
+                    del self.buckets[band][key]
+
+    def query(self, signature: np.ndarray, limit: int) -> List[Tuple[int, float]]:
+        """Кандидаты из совпавших полос, отсортированные по оценке сходства"""
+        candidates: Set[int] = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            candidates.update(self.buckets[band].get(key, ()))
+        if not candidates:
+            return []
+        ids = list(candidates)
+        matrix = np.stack([self.signatures[template_id] for template_id in ids])
+        scores = np.count_nonzero(matrix == signature, axis=1) / len(signature)
+        order = np.argsort(-scores, kind="stable")[:limit]
+        return [(ids[i], float(scores[i])) for i in order]
+
+    def __len__(self):
+        return len(self.signatures)
+
+
+_index: Optional[TemplateIndex] = None
+_index_lock = threading.Lock()
+# Шаблоны добавляют и удаляют любые воркеры: индекс перестраивается при смене версии
+_index_channel = coordination.Channel("templates")
+_result_cache: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+_result_cache_lock = threading.Lock()
+
+
+def get_index() -> TemplateIndex:
+    """LSH-индекс шаблонов; строится из базы при первом обращении и после изменений в других воркерах"""
+    global _index
+    with _index_lock:
+        if _index is None or _index_channel.stale():
+            seen = _index_channel.current()
+            index = TemplateIndex()
+            result = database.get_template_signatures()
+            if not result["success"]:
+                raise RuntimeError(result["message"])
+            for template_id, blob in result["signatures"]:
+                index.add(template_id, np.frombuffer(blob, dtype=np.uint64))
+            logging.info(f"Индекс шаблонов построен: {len(index)} шаблонов")
+            _index = index
+            _index_channel.mark(seen)
+        return _index
+
+
+def add_template(name: str, content: str) -> Dict[str, Any]:
+    """Сохранение шаблона в базе и в индексе"""
+    signature = minhash(content)
+    result = database.add_template(name, content, document_hash(content), signature.tobytes())
+    if result["success"]:
+        index = get_index()
+        with _index_lock:
+            index.add(result["template_id"], signature)
+            _index_channel.published()
+    return result
+
+
+def delete_template(template_id: int) -> Dict[str, Any]:
+    """Удаление шаблона из базы и из индекса"""
+    result = database.delete_template(template_id)
+    if result["success"]:
+        index = get_index()
+        with _index_lock:
+            index.remove(template_id)
+            _index_channel.published()
+    return result
+
+
+def _compare_with(doc_hash: str, content: str, template: Dict[str, Any]) -> Dict[str, Any]:
+    """Полный diff документа с шаблоном (кэш по хешам документа и шаблона)"""
+    key = (doc_hash, template["content_hash"])
+    with _result_cache_lock:
+        cached = _result_cache.get(key)
+        if cached is not None:
+            _result_cache.move_to_end(key)
+    metrics.cache_lookup("template_compare", cached is not None)
+    if cached is not None:
+        return cached
+
+    # Шаблон - исходная версия, документ - измененная
+    result = diff_engine.compare_texts(template["content"], content)
+    comparison = {
+        "summary": diff_engine.summarize(result),
+        "added": result["added"],
+        "removed": result["removed"],
+        "moved": result["moved"],
+        "total_hunks": len(result["hunks"]),
+        "hunks": list(diff_engine.iter_hunks(result, 0, TEMPLATE_MAX_HUNKS)),
+    }
+    with _result_cache_lock:
+        _result_cache[key] = comparison
+        while len(_result_cache) > TEMPLATE_RESULT_CACHE_SIZE:
+            _result_cache.popitem(last=False)
+    return comparison
+
+
+@tracing.traced("templates.compare")
+def compare_with_templates(content: str, top_k: int = TEMPLATE_TOP_K) -> Dict[str, Any]:
+    """Сравнение документа с библиотекой шаблонов
+
+    Кандидаты ранжируются по MinHash через LSH-индекс, полный diff строится только для top_k лучших.
+    """
+    index = get_index()
+    signature = minhash(content)
+    with _index_lock:
+        candidates = index.query(signature, top_k)
+
+    doc_hash = document_hash(content)
+    results = []
+    for template_id, score in candidates:
+        template = database.get_template(template_id)
+        if not template["success"]:
+            continue  # Шаблон удален между поиском и сравнением
+        template = template["template"]
+        results.append({
+            "template_id": template_id,
+            "name": template["name"],
+            "similarity": round(score, 3),
+            **_compare_with(doc_hash, content, template),
+        })
+
+    return {"document_hash": doc_hash, "templates_total": len(index), "results": results}
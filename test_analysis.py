@@ -0,0 +1,79 @@
+"""Проверка map-reduce анализа на заглушке LLM: форма ответа, параллелизм, число вызовов, кэш после правки
+
+Запуск: python -m pytest test_analysis.py
+"""
+import math
+import asyncio
+
+import pytest
+
+import llm
+import analysis_pipeline
+
+
+class TrackingBackend(llm.StubBackend):
+    """Заглушка, запоминающая наибольшее число одновременных запросов"""
+
+    def __init__(self):
+        super().__init__(delay=0.01)
+        self.active = 0
+        self.max_active = 0
+
+    async def complete(self, *args, **kwargs):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            return await super().complete(*args, **kwargs)
+        finally:
+            self.active -= 1
+
+
+def make_sections(count=200):
+    return [
+        f"Статья {number}. Обязанности стороны {number}\n\n"
+        + " ".join(f"Сторона {number} обязуется исполнить условие {item} в установленный срок." for item in range(10))
+        for number in range(1, count + 1)
+    ]
+
+
+def reduce_calls(chunks):
+    calls = 0
+    while chunks > 1:
+        chunks = math.ceil(chunks / analysis_pipeline.ANALYSIS_REDUCE_FANOUT)
+        calls += chunks
+    return calls
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    monkeypatch.setattr(analysis_pipeline, "ANALYSIS_CONCURRENCY", 3)
+    analysis_pipeline._cache.clear()
+    stub = TrackingBackend()
+    llm.set_backend(stub)
+    yield stub
+    llm.set_backend(None)
+    analysis_pipeline._cache.clear()
+
+
+def test_map_reduce_shape_concurrency_and_calls(backend):
+    result = asyncio.run(analysis_pipeline.analyze("\n\n".join(make_sections()), "risks"))
+
+    assert set(result) == {"summary", "key_points", "risks", "recommendations", "chunks", "cached_chunks"}
+    assert result["summary"] and isinstance(result["key_points"], list)
+    assert result["chunks"] > analysis_pipeline.ANALYSIS_REDUCE_FANOUT and result["cached_chunks"] == 0
+    assert backend.calls == result["chunks"] + reduce_calls(result["chunks"])
+    assert 1 < backend.max_active <= analysis_pipeline.ANALYSIS_CONCURRENCY
+
+
+def test_edit_reruns_only_changed_chunks(backend):
+    sections = make_sections()
+    first = asyncio.run(analysis_pipeline.analyze("\n\n".join(sections)))
+
+    sections[3] += " " + " ".join(["Дополнительное условие о порядке приемки работ."] * 8)
+    calls = backend.calls
+    second = asyncio.run(analysis_pipeline.analyze("\n\n".join(sections)))
+
+    rerun = second["chunks"] - second["cached_chunks"]
+    assert abs(second["chunks"] - first["chunks"]) <= 1
+    assert 1 <= rerun <= 2
+    assert backend.calls - calls <= rerun + reduce_calls(second["chunks"])
@@ -0,0 +1,188 @@
+"""Проверка обхода корпуса на локальном HTTP-сервере: условные GET, хеши, вежливость к хосту, переиндексация
+
+Запуск: python -m pytest test_crawler.py
+"""
+import os
+import time
+import sqlite3
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import crawler
+import rag_indexer
+
+PAGE = """<html><head><title>{title}</title><script>var counter = {counter};</script></head>
+<body><nav>Главная | Поиск</nav>
+<div id="divCont">
+<h1>{title}</h1>
+<p><b>Статья 1.</b> Задачи&nbsp;кодекса</p>
+<p>Задачами настоящего кодекса являются {task} (см. <a href="#a2">Статья 2</a>).</p>
+<p><b>Статья 2.</b> Принципы</p>
+<p>Кодекс основывается на принципах законности.</p>
+</div><footer>© 2025</footer></body></html>"""
+
+
+class Fixture:
+    """Страницы фикстуры: путь -> (HTML, поддерживать ли ETag/Last-Modified)"""
+
+    def __init__(self):
+        self.pages = {}
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.delay = 0.0
+        self.throttle_once = set()
+        self.robots = "User-agent: *\nDisallow: /private/\n"
+        self.lock = threading.Lock()
+
+    def page(self, path, task="охрана прав граждан", counter=1, validators=True, title="Уголовный кодекс"):
+        self.pages[path] = (PAGE.format(title=title, task=task, counter=counter), validators)
+
+
+def make_handler(fixture: Fixture):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            with fixture.lock:
+                fixture.active += 1
+                fixture.max_active = max(fixture.max_active, fixture.active)
+                fixture.requests.append((self.path, self.headers.get("If-None-Match")))
+            try:
+                time.sleep(fixture.delay)
+                self._respond()
+            finally:
+                with fixture.lock:
+                    fixture.active -= 1
+
+        def _respond(self):
+            if self.path == "/robots.txt":
+                return self._send(200, fixture.robots.encode(), {"Content-Type": "text/plain"})
+            if self.path in fixture.throttle_once:
+                fixture.throttle_once.discard(self.path)
+                return self._send(429, b"", {"Retry-After": "0"})
+            if self.path not in fixture.pages:
+                return self._send(404, b"", {})
+            html, validators = fixture.pages[self.path]
+            body = html.encode("utf-8")
+            headers = {"Content-Type": "text/html; charset=utf-8"}
+            if validators:
+                etag = f'"{hash(html) & 0xffffffff:x}"'
+                headers["ETag"] = etag
+                if self.headers.get("If-None-Match") == etag:
+                    return self._send(304, b"", headers)
+            self._send(200, body, headers)
+
+        def _send(self, status, body, headers):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+@pytest.fixture
+def site():
+    fixture = Fixture()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(fixture))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    fixture.base = f"http://127.0.0.1:{server.server_address[1]}"
+    yield fixture
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    monkeypatch.setattr(rag_indexer, "KODEKS_DIR", str(tmp_path / "kodeks"))
+    monkeypatch.setattr(rag_indexer, "VECTOR_DB_PATH", str(tmp_path / "vectors.db"))
+    return tmp_path
+
+
+def crawl(corpus, sources, **kwargs):
+    kwargs.setdefault("host_delay", 0.0)
+    kwargs.setdefault("parse_workers", 1)
+    instance = crawler.Crawler(output_dir=str(corpus / "kodeks"), db_path=str(corpus / "crawler.db"), **kwargs)
+    return asyncio.run(instance.run(sources))
+
+
+def test_first_crawl_writes_normalized_text(site, corpus):
+    site.page("/docs/uk")
+    report = crawl(corpus, [{"url": site.base + "/docs/uk", "filename": "uk.txt"}])
+    assert report["changed"] == ["uk.txt"] and not report["failed"]
+
+    text = (corpus / "kodeks" / "uk.txt").read_text(encoding="utf-8")
+    assert "var counter" not in text and "Главная" not in text and "©" not in text
+    assert "\nСтатья 1. Задачи кодекса\n" in text
+    assert [match.group(1) for match in rag_indexer.ARTICLE_HEADING_RE.finditer(text)] == ["1", "2"]
+
+
+def test_recrawl_skips_unchanged_pages(site, corpus):
+    site.page("/docs/etag")
+    site.page("/docs/plain", validators=False)
+    sources = [
+        {"url": site.base + "/docs/etag", "filename": "etag.txt"},
+        {"url": site.base + "/docs/plain", "filename": "plain.txt"},
+    ]
+    crawl(corpus, sources)
+    mtimes = {name: os.stat(corpus / "kodeks" / name).st_mtime_ns for name in ("etag.txt", "plain.txt")}
+
+    report = crawl(corpus, sources)
+    # ETag -> 304 без тела; без валидаторов совпадает хеш ответа
+    assert report["changed"] == [] and report["not_modified"] == 1 and report["unchanged"] == 1
+    assert {name: os.stat(corpus / "kodeks" / name).st_mtime_ns for name in mtimes} == mtimes
+
+    # Изменилась только разметка (скрипт) - текст тот же, файл не переписывается
+    site.page("/docs/plain", counter=2, validators=False)
+    report = crawl(corpus, sources)
+    assert report["changed"] == [] and report["unchanged"] == 1
+
+    site.page("/docs/etag", task="защита общества")
+    report = crawl(corpus, sources)
+    assert report["changed"] == ["etag.txt"]
+    assert "защита общества" in (corpus / "kodeks" / "etag.txt").read_text(encoding="utf-8")
+
+
+def test_per_host_concurrency_and_robots(site, corpus):
+    site.delay = 0.1
+    for index in range(6):
+        site.page(f"/docs/{index}")
+    site.page("/private/secret")
+    site.throttle_once.add("/docs/0")
+    sources = [{"url": f"{site.base}/docs/{index}", "filename": f"doc{index}.txt"} for index in range(6)]
+    sources.append({"url": site.base + "/private/secret", "filename": "secret.txt"})
+
+    report = crawl(corpus, sources, concurrency=8, per_host=2)
+    assert site.max_active <= 2
+    assert len(report["changed"]) == 6 and report["skipped"] == 1 and not report["failed"]
+    assert not any(path == "/private/secret" for path, _ in site.requests)
+
+
+def test_changed_files_are_reindexed_incrementally(site, corpus):
+    site.page("/docs/uk")
+    site.page("/docs/gk", title="Гражданский кодекс")
+    sources = [
+        {"url": site.base + "/docs/uk", "filename": "ugolovnyj_kodeks.txt"},
+        {"url": site.base + "/docs/gk", "filename": "grazhdanskij_kodeks.txt"},
+    ]
+    report = crawl(corpus, sources)
+    crawler.trigger_reindex(report["changed"], "inline")
+
+    site.page("/docs/gk", title="Гражданский кодекс", task="регулирование имущественных отношений")
+    report = crawl(corpus, sources)
+    assert report["changed"] == ["grazhdanskij_kodeks.txt"]
+    result = crawler.trigger_reindex(report["changed"], "inline")
+    assert result["files"] == 1 and result["articles"] == 2
+
+    conn = sqlite3.connect(rag_indexer.VECTOR_DB_PATH)
+    rows = conn.execute("SELECT code, article FROM article_index ORDER BY code, article").fetchall()
+    conn.close()
+    assert rows == [("ГК", "1"), ("ГК", "2"), ("УК", "1"), ("УК", "2")]
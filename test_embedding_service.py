@@ -0,0 +1,103 @@
+"""Проверка пакетного кодирования запросов: пакеты, повторы, LRU-кеш, выигрыш под нагрузкой, отмена ожидающих
+
+Запуск: python -m pytest test_embedding_service.py
+"""
+import time
+import asyncio
+import threading
+
+import numpy as np
+
+import embedding_service
+
+
+class BlockingEncoder:
+    """Кодировщик, который держит первый пакет до сигнала"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.batches = []
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        self.started.set()
+        self.release.wait(5)
+        return np.ones((len(texts), 4), dtype=np.float32)
+
+
+class FixedCostEncoder:
+    """Кодировщик с постоянной стоимостью вызова, запоминающий размеры пакетов"""
+
+    def __init__(self, cost=0.005):
+        self.cost = cost
+        self.batches = []
+
+    def __call__(self, texts):
+        self.batches.append(len(texts))
+        time.sleep(self.cost)
+        return np.ones((len(texts), 4), dtype=np.float32)
+
+
+def run_load(service, queries):
+    started = time.perf_counter()
+    futures = [service.submit(text) for text in queries]
+    vectors = [future.result(5) for future in futures]
+    return vectors, time.perf_counter() - started
+
+
+def test_batches_duplicates_and_cache_under_load():
+    queries = [f"запрос {index}" for index in range(64)]
+    serial = embedding_service.EmbeddingService(max_batch=1, cache_size=0, encode=FixedCostEncoder())
+    batched_encoder = FixedCostEncoder()
+    batched = embedding_service.EmbeddingService(max_batch=32, cache_size=128, encode=batched_encoder)
+    try:
+        _, serial_time = run_load(serial, queries)
+        vectors, batched_time = run_load(batched, queries)
+        assert len(vectors) == 64 and not vectors[0].flags.writeable
+        # Пакеты собираются, и под нагрузкой это кратно быстрее кодирования по одному
+        assert max(batched_encoder.batches) > 1 and sum(batched_encoder.batches) == 64
+        assert batched_time * 3 < serial_time
+
+        # Повторы и пробелы в запросах одного пакета кодируются один раз
+        batched_encoder.batches.clear()
+        run_load(batched, [f"новый  запрос {index % 4}" for index in range(24)] + [f"новый запрос {index}" for index in range(4)])
+        assert sum(batched_encoder.batches) == 4
+
+        # Уже закодированные берутся из LRU без вызова модели; вытесняются самые старые
+        batched_encoder.batches.clear()
+        run_load(batched, queries)
+        assert batched_encoder.batches == []
+        run_load(batched, [f"еще запрос {index}" for index in range(128)])
+        batched_encoder.batches.clear()
+        run_load(batched, queries[:1])
+        assert batched_encoder.batches == [1]
+    finally:
+        serial.stop()
+        batched.stop()
+
+
+def test_cancelled_awaiter_does_not_stop_service():
+    encoder = BlockingEncoder()
+    service = embedding_service.EmbeddingService(max_wait_ms=1, encode=encoder)
+
+    async def scenario():
+        # Отмена во время кодирования: результат приходит уже отмененному ожидающему
+        running = asyncio.ensure_future(service.encode_async("первый запрос"))
+        await asyncio.to_thread(encoder.started.wait, 5)
+        running.cancel()
+        # Отмена до кодирования: запрос выбрасывается из пакета
+        queued = asyncio.ensure_future(service.encode_async("второй запрос"))
+        await asyncio.sleep(0.01)
+        queued.cancel()
+        encoder.release.set()
+        await asyncio.gather(running, queued, return_exceptions=True)
+        return await asyncio.wait_for(service.encode_async("третий запрос"), 5)
+
+    try:
+        vector = asyncio.run(scenario())
+        assert vector.shape == (4,)
+        assert service._thread.is_alive()
+        assert ["второй запрос"] not in encoder.batches
+    finally:
+        service.stop()
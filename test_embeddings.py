@@ -0,0 +1,34 @@
+"""Проверка эмбеддингов без sentence-transformers: режим auto переходит на локальные эмбеддинги
+
+Запуск: python -m pytest test_embeddings.py
+"""
+import sys
+
+import numpy as np
+import pytest
+
+import embeddings
+import embedding_service
+
+
+@pytest.fixture
+def failing_model(monkeypatch):
+    monkeypatch.setattr(embeddings, "EMBEDDING_BACKEND", "auto")
+    monkeypatch.setattr(embeddings, "_model", None)
+    # None в sys.modules: import sentence_transformers падает с ImportError
+    monkeypatch.setitem(sys.modules, "sentence_transformers", None)
+
+
+def test_auto_falls_back_to_stub_on_every_call(failing_model):
+    first = embeddings.encode(["неустойка за просрочку оплаты"])
+    second = embeddings.encode(["неустойка за просрочку оплаты", "расторжение договора"])
+    assert embeddings.get_model() is None
+    assert embeddings.backend_id() == f"stub-{embeddings.STUB_DIMENSION}"
+    assert first.shape == (1, embeddings.STUB_DIMENSION)
+    assert np.allclose(first[0], second[0])
+
+    service = embedding_service.EmbeddingService()
+    try:
+        assert service.encode("расторжение договора").shape == (embeddings.STUB_DIMENSION,)
+    finally:
+        service.stop()
@@ -0,0 +1,76 @@
+"""Проверка быстрого старта: время импорта main, тяжелые модули и базы данных не на критическом пути
+
+Запуск: python -m pytest test_startup.py  (или python test_startup.py)
+Бюджет задается STARTUP_IMPORT_BUDGET_S (секунды, по умолчанию 2).
+"""
+import os
+import sys
+import json
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STARTUP_IMPORT_BUDGET_S = float(os.getenv("STARTUP_IMPORT_BUDGET_S", "2.0"))
+
+# Загружаются только при прогреве или первом обращении
+HEAVY_MODULES = ["sentence_transformers", "torch", "transformers", "tiktoken", "gtts", "PyPDF2", "bs4"]
+
+IMPORT_SCRIPT = """
+import sys, json, time
+started = time.perf_counter()
+import main
+elapsed = time.perf_counter() - started
+print(json.dumps({"elapsed": elapsed, "modules": sorted(sys.modules)}))
+"""
+
+
+def import_main(runs: int = 3) -> dict:
+    """Импорт main в чистом процессе (каталог без баз данных); лучший результат из нескольких запусков"""
+    best = None
+    with tempfile.TemporaryDirectory(prefix="startup_") as workdir:
+        os.symlink(os.path.join(REPO_DIR, "templates"), os.path.join(workdir, "templates"))
+        env = {**os.environ, "PYTHONPATH": REPO_DIR, "EMBEDDING_BACKEND": "auto"}
+        for _ in range(runs):
+            output = subprocess.run(
+                [sys.executable, "-c", IMPORT_SCRIPT], cwd=workdir, env=env,
+                capture_output=True, text=True, check=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            if best is None or result["elapsed"] < best["elapsed"]:
+                best = result
+        best["files"] = sorted(os.listdir(workdir))
+    return best
+
+
+_result = None
+
+
+def _imported() -> dict:
+    global _result
+    if _result is None:
+        _result = import_main()
+    return _result
+
+
+def test_import_time_within_budget():
+    elapsed = _imported()["elapsed"]
+    assert elapsed <= STARTUP_IMPORT_BUDGET_S, f"import main: {elapsed:.2f}s > {STARTUP_IMPORT_BUDGET_S}s"
+
+
+def test_no_heavy_modules_at_import():
+    loaded = [name for name in HEAVY_MODULES if name in _imported()["modules"]]
+    assert not loaded, f"Тяжелые модули импортированы вместе с main: {loaded}"
+
+
+def test_no_databases_created_at_import():
+    created = [name for name in _imported()["files"] if name.endswith(".db") or ".db-" in name]
+    assert not created, f"Базы созданы при импорте: {created}"
+
+
+if __name__ == "__main__":
+    result = _imported()
+    print(f"import main: {result['elapsed']:.3f}s (бюджет {STARTUP_IMPORT_BUDGET_S}s)")
+    test_import_time_within_budget()
+    test_no_heavy_modules_at_import()
+    test_no_databases_created_at_import()
+    print("✅ OK")
@@ -0,0 +1,70 @@
+"""Проверка перевода на заглушке: сегментация с сохранением форматирования, пакеты, память переводов, терминология
+
+Запуск: python -m pytest test_translation.py
+"""
+import asyncio
+
+import pytest
+
+import translation
+
+DOCUMENT = """ДОГОВОР № 1
+
+1. The customer signs the agreement. The provider delivers services.
+   2. Liability of the parties is limited.
+
+1. The customer signs the agreement.
+"""
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch):
+    monkeypatch.setattr(translation, "TRANSLATION_DB_PATH", str(tmp_path / "memory.db"))
+    stub = translation.StubBackend()
+    translation.set_backend(stub)
+    yield stub
+    translation.set_backend(None)
+
+
+def translate(text, **kwargs):
+    return asyncio.run(translation.translate_text(text, kwargs.pop("source", "en"), kwargs.pop("target", "en"), **kwargs))
+
+
+def test_formatting_and_legal_terms(backend):
+    result = translate(DOCUMENT, source="en", target="en")
+    # source == target: бэкенд не вызывается, текст пользователя не переписывается терминологией
+    assert backend.calls == 0
+    assert result["translation"] == DOCUMENT
+
+    # Терминология - только в переведенных сегментах; номера пунктов и непереведенное не трогаются
+    result = translate("1. The customer signs the agreement.\n2025", source="ru", target="en")
+    assert result["translation"] == "1. [en] The client signs the contract.\n2025"
+
+    result = translate(DOCUMENT, source="en", target="ru", legal_terms=False)
+    lines = result["translation"].split("\n")
+    assert lines[0] == "[ru] ДОГОВОР № 1"
+    assert lines[2] == "1. [ru] The customer signs the agreement. [ru] The provider delivers services."
+    assert lines[3] == "   2. [ru] Liability of the parties is limited."
+    assert result["segments"] == 5 and result["unique"] == 4
+
+
+def test_repeated_segments_come_from_memory(backend, monkeypatch):
+    monkeypatch.setattr(translation, "TRANSLATION_BATCH_SEGMENTS", 2)
+    first = translate(DOCUMENT, source="en", target="ru")
+    assert first["translated"] == 4 and first["from_memory"] == 0
+    assert backend.calls == 2 and backend.segments == 4
+
+    # Тот же пункт в другом документе и с другими пробелами - из памяти, без обращения к бэкенду
+    second = translate("Preamble.\n1.  The customer   signs the agreement.", source="en", target="ru")
+    assert second["from_memory"] == 1 and second["translated"] == 1
+    assert backend.segments == 5
+    assert second["translation"].endswith("1.  [ru] The customer signs the agreement.")
+
+    # Другая языковая пара - отдельная запись памяти
+    translate("The customer signs the agreement.", source="en", target="de")
+    assert backend.segments == 6
+
+
+def test_legal_terms_keep_case():
+    assert translation.apply_legal_terms("Контракт с клиентом. КОНТРАКТ", "ru") == "Договор с заказчиком. ДОГОВОР"
+    assert translation.apply_legal_terms("Поставщиком услуг выступает", "ru") == "Исполнитель выступает"
@@ -0,0 +1,78 @@
+"""Проверка озвучки на заглушке: кеш, одно синтезирование на одинаковые запросы, ETag/304 и Range
+
+Запуск: python -m pytest test_tts.py
+"""
+import time
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import tts
+
+
+class TrackingEngine(tts.StubEngine):
+    """Заглушка с задержкой синтеза, считающая вызовы"""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.calls = 0
+
+    def synthesize(self, text, lang, voice, path):
+        self.calls += 1
+        time.sleep(self.delay)
+        with open(path, "wb") as f:
+            f.write(f"{lang}:{voice}:{text}".encode("utf-8") * 4)
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    monkeypatch.setattr(tts, "TTS_CACHE_DIR", str(tmp_path / "tts"))
+    stub = TrackingEngine()
+    tts.set_engine(stub)
+    yield stub
+    tts.set_engine(None)
+
+
+def test_cache_hits_and_inflight_dedupe(engine):
+    async def scenario():
+        # Одинаковые одновременные запросы ждут один синтез
+        results = await asyncio.gather(*(tts.synthesize("Договор вступает в силу.", "ru") for _ in range(5)))
+        assert engine.calls == 1 and len(set(results)) == 1
+        assert not tts._inflight
+
+        # Повтор - из кеша, другой голос - отдельная запись
+        assert await tts.synthesize("Договор вступает в силу.", "ru") == results[0]
+        assert engine.calls == 1
+        await tts.synthesize("Договор вступает в силу.", "en", "female")
+        assert engine.calls == 2
+        return results[0]
+
+    path, key = asyncio.run(scenario())
+    assert tts.get_cached(key) == path
+    assert tts.get_cached("../" + key) is None
+
+
+def test_cached_audio_etag_and_range(engine):
+    import main
+
+    path, key = asyncio.run(tts.synthesize("Стороны несут ответственность.", "ru"))
+    with open(path, "rb") as f:
+        content = f.read()
+    client = TestClient(main.app)
+
+    response = client.get(f"/api/audio/{key}")
+    assert response.status_code == 200 and response.content == content
+    assert response.headers["etag"] == f'"{key}"'
+    assert response.headers["content-type"] == "audio/mpeg"
+
+    response = client.get(f"/api/audio/{key}", headers={"If-None-Match": f'"{key}"'})
+    assert response.status_code == 304 and response.content == b""
+
+    response = client.get(f"/api/audio/{key}", headers={"Range": "bytes=4-13"})
+    assert response.status_code == 206
+    assert response.content == content[4:14]
+    assert response.headers["content-range"] == f"bytes 4-13/{len(content)}"
+
+    assert client.get(f"/api/audio/{'0' * 64}").status_code == 404
+    assert engine.calls == 1
@@ -0,0 +1,37 @@
+"""Проверка What-if на локальных эмбеддингах: вопросы с ключевыми словами библиотеки не уходят в LLM
+
+Запуск: python -m pytest test_whatif.py
+"""
+import asyncio
+
+import pytest
+
+import coordination
+import database
+import llm
+import whatif
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DB_PATH", str(tmp_path / "users.db"))
+    monkeypatch.setattr(coordination, "COORDINATION_DIR", str(tmp_path / "coordination"))
+    monkeypatch.setattr(coordination, "SHARED_ARRAYS_DIR", str(tmp_path / "arrays"))
+    monkeypatch.setattr(whatif, "_library", None)
+    database.init_db()
+    stub = llm.StubBackend()
+    llm.set_backend(stub)
+    yield stub
+    llm.set_backend(None)
+
+
+@pytest.mark.parametrize("question, scenario_id", [
+    ("Что будет при нарушение договора поставки?", "contract-breach"),
+    ("Какие последствия утечки персональных данных?", "personal-data"),
+    ("Что если налог пересчитают?", "tax"),
+])
+def test_library_keyword_question_returns_scenario(library, question, scenario_id):
+    result = asyncio.run(whatif.resolve(question, "Договор поставки"))
+    assert result["source"] == "library"
+    assert result["scenario_id"] == scenario_id
+    assert library.calls == 0
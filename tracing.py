@@ -0,0 +1,215 @@
+import os
+import time
+import random
+import asyncio
+import cProfile
+import logging
+import functools
+import threading
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+# Трассировка запросов: спаны, заголовок Server-Timing, журнал медленных запросов
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1") == "1"
+# Порог медленного запроса (мс) и доля медленных запросов, попадающих в журнал с деревом спанов
+TRACING_SLOW_MS = float(os.getenv("TRACING_SLOW_MS", "1000"))
+TRACING_SLOW_SAMPLE_RATE = float(os.getenv("TRACING_SLOW_SAMPLE_RATE", "1.0"))
+# cProfile: порог (мс, 0 - выключено), доля профилируемых запросов и каталог .prof файлов
+TRACING_PROFILE_MS = float(os.getenv("TRACING_PROFILE_MS", "0"))
+TRACING_PROFILE_SAMPLE_RATE = float(os.getenv("TRACING_PROFILE_SAMPLE_RATE", "0.1"))
+TRACING_PROFILE_DIR = os.getenv("TRACING_PROFILE_DIR", os.path.join("cache", "profiles"))
+# Сколько самых долгих групп спанов попадает в Server-Timing
+SERVER_TIMING_MAX_ENTRIES = 12
+
+# Символы, допустимые в имени метрики Server-Timing (token по RFC 7230)
+_TOKEN_CHARS = frozenset("!#$%&'*+-.^_`|~0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
+logger = logging.getLogger("tracing")
+
+
+class Span:
+    """Интервал работы внутри запроса с вложенными интервалами"""
+    __slots__ = ("name", "start", "end", "children")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.children: List["Span"] = []
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "ms": round(self.duration_ms, 2),
+            "children": [child.to_dict() for child in self.children],
+        }
+
+
+_current: ContextVar[Optional[Span]] = ContextVar("tracing_span", default=None)
+_profile_lock = threading.Lock()
+
+
+class _SpanContext:
+    __slots__ = ("span", "token")
+
+    def __init__(self, name: str, parent: Span):
+        self.span = Span(name)
+        # Список дополняется и из потоков asyncio.to_thread: append атомарен
+        parent.children.append(self.span)
+
+    def __enter__(self) -> Span:
+        self.token = _current.set(self.span)
+        return self.span
+
+    def __exit__(self, *exc_info):
+        self.span.end = time.perf_counter()
+        _current.reset(self.token)
+        return False
+
+
+class _NoopContext:
+    __slots__ = ()
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP = _NoopContext()
+
+
+def span(name: str):
+    """Контекст спана. Вне трассируемого запроса (или при выключенной трассировке) ничего не делает"""
+    parent = _current.get()
+    if parent is None:
+        return _NOOP
+    return _SpanContext(name, parent)
+
+
+def traced(name: str):
+    """Декоратор: вызов функции (обычной или async) оборачивается в спан"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _aggregate(root: Span) -> Dict[str, List[float]]:
+    """Суммарная длительность и число спанов по имени во всем дереве"""
+    totals: Dict[str, List[float]] = {}
+    stack = list(root.children)
+    while stack:
+        current = stack.pop()
+        entry = totals.setdefault(current.name, [0.0, 0])
+        entry[0] += current.duration_ms
+        entry[1] += 1
+        stack.extend(current.children)
+    return totals
+
+
+def _token(name: str) -> str:
+    return "".join(char if char in _TOKEN_CHARS else "_" for char in name)
+
+
+def server_timing(root: Span) -> str:
+    """Значение заголовка Server-Timing: самые долгие группы спанов и общее время"""
+    totals = sorted(_aggregate(root).items(), key=lambda item: -item[1][0])[:SERVER_TIMING_MAX_ENTRIES]
+    entries = [f'{_token(name)};dur={ms:.1f}' + (f';desc="x{count}"' if count > 1 else "") for name, (ms, count) in totals]
+    entries.append(f"total;dur={root.duration_ms:.1f}")
+    return ", ".join(entries)
+
+
+def format_tree(root: Span) -> str:
+    """Дерево спанов для журнала"""
+    lines = []
+
+    def walk(current: Span, depth: int):
+        lines.append(f"{'  ' * depth}{current.name} {current.duration_ms:.1f}ms")
+        for child in current.children:
+            walk(child, depth + 1)
+
+    walk(root, 0)
+    return "\n".join(lines)
+
+
+def _start_profiler() -> Optional[cProfile.Profile]:
+    # Профилировщик в процессе один: одновременно профилируется не больше одного запроса
+    if not TRACING_PROFILE_MS or random.random() >= TRACING_PROFILE_SAMPLE_RATE:
+        return None
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        _profile_lock.release()  # Уже работает другой профилировщик
+        return None
+    return profiler
+
+
+def _finish_profiler(profiler: cProfile.Profile, root: Span):
+    try:
+        profiler.disable()
+        if root.duration_ms < TRACING_PROFILE_MS:
+            return
+        os.makedirs(TRACING_PROFILE_DIR, exist_ok=True)
+        path = os.path.join(TRACING_PROFILE_DIR, f"{int(time.time() * 1000)}-{_token(root.name.replace(' ', '_').replace('/', '_'))[:80]}.prof")
+        profiler.dump_stats(path)
+        logger.warning(f"Профиль медленного запроса {root.name} ({root.duration_ms:.0f}ms): {path}")
+    except Exception as e:
+        logger.error(f"Не удалось сохранить профиль запроса: {e}")
+    finally:
+        _profile_lock.release()
+
+
+class TracingMiddleware:
+    """ASGI-middleware: корневой спан запроса, Server-Timing, журнал медленных запросов и cProfile
+
+    Профиль снимается со всего цикла событий, поэтому в него попадают и
+    параллельные запросы - это снимок того, чем был занят процесс.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not TRACING_ENABLED or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        root = Span(f"{scope['method']} {scope['path']}")
+        token = _current.set(root)
+        profiler = _start_profiler()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(root).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            root.end = time.perf_counter()
+            _current.reset(token)
+            if profiler is not None:
+                _finish_profiler(profiler, root)
+            if root.duration_ms >= TRACING_SLOW_MS and random.random() < TRACING_SLOW_SAMPLE_RATE:
+                logger.warning(f"Медленный запрос {root.name}: {root.duration_ms:.0f}ms\n{format_tree(root)}")
@@ -0,0 +1,276 @@
+import os
+import re
+import asyncio
+import hashlib
+import sqlite3
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+import metrics
+
+# Бэкенд перевода: google (публичный endpoint translate.googleapis.com) или stub (локальная заглушка для тестов)
+TRANSLATION_BACKEND = os.getenv("TRANSLATION_BACKEND", "google")
+TRANSLATION_GOOGLE_URL = os.getenv("TRANSLATION_GOOGLE_URL", "https://translate.googleapis.com/translate_a/single")
+# Память переводов: уже переведенные сегменты берутся из базы без обращения к бэкенду
+TRANSLATION_DB_PATH = os.getenv("TRANSLATION_DB_PATH", "translation_memory.db")
+# Размер пакета: сегментов и символов в одном запросе к бэкенду
+TRANSLATION_BATCH_SEGMENTS = int(os.getenv("TRANSLATION_BATCH_SEGMENTS", "40"))
+TRANSLATION_BATCH_CHARS = int(os.getenv("TRANSLATION_BATCH_CHARS", "4000"))
+# Сколько пакетов одного запроса переводится одновременно
+TRANSLATION_CONCURRENCY = int(os.getenv("TRANSLATION_CONCURRENCY", "4"))
+# Таймаут запроса к бэкенду (секунды)
+TRANSLATION_TIMEOUT = float(os.getenv("TRANSLATION_TIMEOUT", "30"))
+# Максимальный размер текста одного запроса (символы)
+TRANSLATION_MAX_CHARS = int(os.getenv("TRANSLATION_MAX_CHARS", "200000"))
+
+# Границы сегментов: переводы строк и пробелы после конца предложения (разделители сохраняются)
+SEGMENT_SPLIT_RE = re.compile(r"(\n+|(?<=[.!?…;])[ \t]+)")
+WHITESPACE_RE = re.compile(r"\s+")
+# Одиночный перенос внутри абзаца (режим без сохранения форматирования)
+SOFT_BREAK_RE = re.compile(r"[ \t]*(?<!\n)\n(?!\n)[ \t]*")
+SQLITE_MAX_VARIABLES = 500
+
+# Коды языков интерфейса, которые бэкенд называет иначе
+GOOGLE_LANGUAGE_CODES = {"zh": "zh-CN"}
+
+# Юридическая терминология после перевода: (шаблон начала слова, замена); окончания слова сохраняются
+LEGAL_TERMS: Dict[str, List[Tuple[str, str]]] = {
+    "ru": [
+        (r"поставщик(?:а|у|ом|е)? услуг", "исполнитель"),
+        (r"контракт", "договор"),
+        (r"клиент", "заказчик"),
+    ],
+    "en": [
+        (r"service provider", "contractor"),
+        (r"provider", "contractor"),
+        (r"agreement", "contract"),
+        (r"customer", "client"),
+        (r"liability", "responsibility"),
+    ],
+}
+
+
+class GoogleBackend:
+    """Google Translate (клиент gtx): пакет сегментов уходит одним запросом, по строке на сегмент"""
+    name = "google"
+
+    async def translate(self, segments: List[str], source: str, target: str) -> List[str]:
+        params = {
+            "client": "gtx",
+            "sl": GOOGLE_LANGUAGE_CODES.get(source, source),
+            "tl": GOOGLE_LANGUAGE_CODES.get(target, target),
+            "dt": "t",
+        }
+        async with httpx.AsyncClient(timeout=TRANSLATION_TIMEOUT) as client:
+            lines = (await self._request(client, params, "\n".join(segments))).split("\n")
+            if len(lines) == len(segments):
+                return [line.strip() for line in lines]
+            # Бэкенд склеил или разбил строки - пакет переводится по сегментам
+            logging.warning(f"Перевод пакета вернул {len(lines)} строк вместо {len(segments)}, переводим по сегментам")
+            return [(await self._request(client, params, segment)).strip() for segment in segments]
+
+    async def _request(self, client: httpx.AsyncClient, params: Dict[str, str], text: str) -> str:
+        # POST: текст пакета не упирается в ограничение длины URL
+        resp = await client.post(TRANSLATION_GOOGLE_URL, params=params, data={"q": text})
+        resp.raise_for_status()
+        data = resp.json()
+        return "".join(item[0] for item in (data[0] or []) if item and item[0])
+
+
+class StubBackend:
+    """Детерминированная заглушка: сегмент с префиксом целевого языка"""
+    name = "stub"
+
+    def __init__(self):
+        self.calls = 0
+        self.segments = 0
+
+    async def translate(self, segments: List[str], source: str, target: str) -> List[str]:
+        self.calls += 1
+        self.segments += len(segments)
+        return [f"[{target}] {segment}" for segment in segments]
+
+
+_backend = None
+
+
+def get_backend():
+    """Текущий бэкенд перевода"""
+    global _backend
+    if _backend is None:
+        _backend = StubBackend() if TRANSLATION_BACKEND == "stub" else GoogleBackend()
+    return _backend
+
+
+def set_backend(backend):
+    """Подмена бэкенда перевода (например, StubBackend в тестах)"""
+    global _backend
+    _backend = backend
+
+
+def normalize_segment(segment: str) -> str:
+    """Текст сегмента для перевода и ключа памяти: пробелы схлопнуты"""
+    return WHITESPACE_RE.sub(" ", segment).strip()
+
+
+def segment_hash(segment: str) -> str:
+    return hashlib.sha256(normalize_segment(segment).encode("utf-8")).hexdigest()
+
+
+def split_segments(text: str) -> List[str]:
+    """Текст как чередование [сегмент, разделитель, сегмент, ...]: "".join() восстанавливает исходник"""
+    return SEGMENT_SPLIT_RE.split(text)
+
+
+def _translatable(segment: str) -> bool:
+    # Номера пунктов, даты и разделительные линии переводить незачем
+    return any(ch.isalpha() for ch in segment)
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(TRANSLATION_DB_PATH, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS translation_memory (
+            segment_hash TEXT NOT NULL,
+            source TEXT NOT NULL,
+            target TEXT NOT NULL,
+            backend TEXT NOT NULL,
+            translation TEXT NOT NULL,
+            created_at TEXT,
+            PRIMARY KEY (segment_hash, source, target)
+        )
+    ''')
+    return conn
+
+
+@metrics.timed_query("translation_memory")
+def lookup(hashes: List[str], source: str, target: str, backend: str) -> Dict[str, str]:
+    """Переводы из памяти {хеш сегмента: перевод}; переводы другого бэкенда не используются"""
+    found: Dict[str, str] = {}
+    conn = _connect()
+    try:
+        for start in range(0, len(hashes), SQLITE_MAX_VARIABLES):
+            chunk = hashes[start:start + SQLITE_MAX_VARIABLES]
+            rows = conn.execute(
+                f"SELECT segment_hash, translation FROM translation_memory "
+                f"WHERE source = ? AND target = ? AND backend = ? AND segment_hash IN ({','.join('?' * len(chunk))})",
+                [source, target, backend, *chunk],
+            ).fetchall()
+            found.update(rows)
+    finally:
+        conn.close()
+    return found
+
+
+@metrics.timed_query("translation_memory")
+def remember(translations: Dict[str, str], source: str, target: str, backend: str):
+    """Сохранение переведенных сегментов {хеш: перевод}"""
+    now = datetime.now().isoformat()
+    conn = _connect()
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO translation_memory (segment_hash, source, target, backend, translation, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                [(key, source, target, backend, value, now) for key, value in translations.items()],
+            )
+    finally:
+        conn.close()
+
+
+def make_batches(segments: List[str]) -> List[List[str]]:
+    """Разбиение сегментов на пакеты по числу сегментов и символов"""
+    batches: List[List[str]] = []
+    current: List[str] = []
+    size = 0
+    for segment in segments:
+        if current and (len(current) >= TRANSLATION_BATCH_SEGMENTS or size + len(segment) > TRANSLATION_BATCH_CHARS):
+            batches.append(current)
+            current, size = [], 0
+        current.append(segment)
+        size += len(segment) + 1
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _match_case(found: str, replacement: str) -> str:
+    if len(found) > 1 and found.isupper():
+        return replacement.upper()
+    if found[:1].isupper():
+        return replacement[:1].upper() + replacement[1:]
+    return replacement
+
+
+def apply_legal_terms(text: str, target: str) -> str:
+    """Замена бытовых терминов юридическими для целевого языка (регистр первой буквы сохраняется)"""
+    for pattern, replacement in LEGAL_TERMS.get(target, []):
+        text = re.sub(rf"\b{pattern}", lambda match: _match_case(match.group(0), replacement), text, flags=re.IGNORECASE)
+    return text
+
+
+async def translate_segments(segments: List[str], source: str, target: str) -> Tuple[Dict[str, str], int]:
+    """Перевод уникальных сегментов {хеш: перевод}; второе значение - сколько взято из памяти
+
+    Недостающие переводятся пакетами параллельно, каждый пакет сохраняется
+    в память сразу: после сбоя повторный запрос переводит только остаток.
+    """
+    backend = get_backend()
+    unique = {segment_hash(segment): normalize_segment(segment) for segment in segments}
+    translated = await asyncio.to_thread(lookup, list(unique), source, target, backend.name)
+    metrics.cache_lookup("translation_memory", True, len(translated))
+    missing = [(key, segment) for key, segment in unique.items() if key not in translated]
+    metrics.cache_lookup("translation_memory", False, len(missing))
+    if not missing:
+        return translated, len(translated)
+
+    from_memory = len(translated)
+    keys = {segment: key for key, segment in missing}
+    semaphore = asyncio.Semaphore(TRANSLATION_CONCURRENCY)
+
+    async def run(batch: List[str]):
+        async with semaphore:
+            with metrics.track_upstream("translation", backend.name, "batch"):
+                results = await backend.translate(batch, source, target)
+        done = {keys[segment]: result for segment, result in zip(batch, results)}
+        await asyncio.to_thread(remember, done, source, target, backend.name)
+        translated.update(done)
+
+    await asyncio.gather(*(run(batch) for batch in make_batches([segment for _, segment in missing])))
+    return translated, from_memory
+
+
+async def translate_text(text: str, source: str, target: str, legal_terms: bool = True, preserve_formatting: bool = True) -> Dict[str, Any]:
+    """Перевод документа: сегментация, память переводов, пакетный перевод остатка и юридическая постобработка
+
+    Терминология применяется только к переведенным сегментам; при source == target текст возвращается как есть.
+    """
+    if not preserve_formatting:
+        text = SOFT_BREAK_RE.sub(" ", text)
+    parts = split_segments(text)
+    positions = [index for index in range(0, len(parts), 2) if _translatable(parts[index])]
+    stats = {"segments": len(positions), "unique": 0, "from_memory": 0, "translated": 0}
+
+    if source != target and positions:
+        translated, from_memory = await translate_segments([parts[index] for index in positions], source, target)
+        stats.update(unique=len(translated), from_memory=from_memory, translated=len(translated) - from_memory)
+        if legal_terms:
+            # Терминология только в переведенном: исходный текст, номера и даты не меняются
+            translated = {key: apply_legal_terms(value, target) for key, value in translated.items()}
+        for index in positions:
+            segment = parts[index]
+            # Отступы и хвостовые пробелы строки остаются на месте
+            lead = segment[:len(segment) - len(segment.lstrip())]
+            tail = segment[len(segment.rstrip()):]
+            parts[index] = lead + translated[segment_hash(segment)] + tail
+
+    return {
+        "translation": "".join(parts),
+        "source": source,
+        "target": target,
+        "backend": get_backend().name,
+        **stats,
+    }
@@ -0,0 +1,207 @@
+import os
+import re
+import shutil
+import asyncio
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import metrics
+
+# Движок синтеза: gtts (Google TTS) или stub (локальная заглушка для тестов)
+TTS_ENGINE = os.getenv("TTS_ENGINE", "gtts")
+# Каталог дискового кеша MP3
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", os.path.join("cache", "tts"))
+# Максимальный размер кеша в байтах (LRU-вытеснение)
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+# Размер пула потоков синтеза
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "4"))
+# Сколько предложений одного ответа синтезируется параллельно при стриминге
+TTS_STREAM_PARALLELISM = int(os.getenv("TTS_STREAM_PARALLELISM", "3"))
+# Минимальная длина фрагмента: короткие предложения склеиваются с соседними
+TTS_MIN_SENTENCE_CHARS = 40
+
+KEY_RE = re.compile(r"^[0-9a-f]{64}$")
+SENTENCE_END_RE = re.compile(r"(?<=[.!?…;])\s+|\n+")
+
+
+class GTTSEngine:
+    """Синтез через gTTS"""
+    name = "gtts"
+
+    def synthesize(self, text: str, lang: str, voice: Optional[str], path: str):
+        from gtts import gTTS
+        gTTS(text=text, lang=lang).save(path)
+
+    def warm_up(self):
+        import gtts
+
+
+class StubEngine:
+    """Локальная заглушка: отдает пустой MP3 без обращения к сети"""
+    name = "stub"
+
+    def synthesize(self, text: str, lang: str, voice: Optional[str], path: str):
+        shutil.copyfile(os.path.join("templates", "empty.mp3"), path)
+
+
+ENGINES = {"gtts": GTTSEngine, "stub": StubEngine}
+
+_engine = None
+_executor = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+_inflight: Dict[str, "asyncio.Future"] = {}
+_evict_lock = threading.Lock()
+
+
+def get_engine():
+    """Текущий движок синтеза"""
+    global _engine
+    if _engine is None:
+        _engine = ENGINES.get(TTS_ENGINE, GTTSEngine)()
+    return _engine
+
+
+def set_engine(engine):
+    """Подмена движка синтеза (например, StubEngine в тестах)"""
+    global _engine
+    _engine = engine
+
+
+def warm_up():
+    """Загрузка движка синтеза заранее (импорт gTTS не попадает в первый запрос)"""
+    engine = get_engine()
+    if hasattr(engine, "warm_up"):
+        engine.warm_up()
+
+
+def cache_key(text: str, lang: str, voice: Optional[str]) -> str:
+    """Ключ кеша по (тексту, языку, голосу и движку)"""
+    raw = "\0".join([get_engine().name, lang, voice or "", text])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def cache_path(key: str) -> str:
+    """Путь к MP3 в кеше"""
+    return os.path.join(TTS_CACHE_DIR, f"{key}.mp3")
+
+
+def get_cached(key: str) -> Optional[str]:
+    """Путь к закешированному MP3 или None. Обновляет время доступа для LRU"""
+    if not KEY_RE.match(key):
+        return None
+    path = cache_path(key)
+    try:
+        os.utime(path)
+        return path
+    except OSError:
+        return None
+
+
+def _evict():
+    """Удаление самых давно использованных файлов сверх лимита размера"""
+    with _evict_lock:
+        try:
+            entries = []
+            total = 0
+            with os.scandir(TTS_CACHE_DIR) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.endswith(".mp3"):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                        total += stat.st_size
+            if total <= TTS_CACHE_MAX_BYTES:
+                return
+            entries.sort()
+            for _, size, path in entries:
+                if total <= TTS_CACHE_MAX_BYTES:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                except OSError:
+                    pass
+        except Exception as e:
+            logging.error(f"Ошибка очистки кеша TTS: {e}")
+
+
+def _synthesize_to_cache(engine, text: str, lang: str, voice: Optional[str], path: str):
+    """Синтез во временный файл с атомарной заменой (выполняется в пуле потоков)"""
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        with metrics.track_upstream("tts", engine.name, "synthesize"):
+            engine.synthesize(text, lang, voice, temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+    _evict()
+
+
+async def synthesize(text: str, lang: str, voice: Optional[str] = None) -> Tuple[str, str]:
+    """Синтез речи с кешированием. Возвращает (путь к MP3, ключ кеша)
+
+    Одинаковые одновременные запросы ждут один и тот же синтез.
+    """
+    key = cache_key(text, lang, voice)
+    path = get_cached(key)
+    metrics.cache_lookup("tts", path is not None)
+    if path:
+        return path, key
+
+    future = _inflight.get(key)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(_executor, _synthesize_to_cache, get_engine(), text, lang, voice, cache_path(key))
+        _inflight[key] = future
+        future.add_done_callback(lambda _: _inflight.pop(key, None))
+    await asyncio.shield(future)
+    return cache_path(key), key
+
+
+def split_sentences(text: str) -> List[str]:
+    """Разбиение текста на предложения для поочередного синтеза"""
+    sentences = []
+    current = ""
+    for part in SENTENCE_END_RE.split(text):
+        part = part.strip()
+        if not part:
+            continue
+        current = f"{current} {part}" if current else part
+        if len(current) >= TTS_MIN_SENTENCE_CHARS:
+            sentences.append(current)
+            current = ""
+    if current:
+        if sentences and len(current) < TTS_MIN_SENTENCE_CHARS:
+            sentences[-1] = f"{sentences[-1]} {current}"
+        else:
+            sentences.append(current)
+    return sentences
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def stream_sentences(text: str, lang: str, voice: Optional[str] = None) -> AsyncIterator[bytes]:
+    """Потоковый синтез: MP3 предложений отдаются по порядку, как только готовы
+
+    Одновременно синтезируется не более TTS_STREAM_PARALLELISM предложений,
+    каждое кешируется отдельно.
+    """
+    sentences = split_sentences(text)
+    pending: List["asyncio.Task"] = []
+    next_index = 0
+    try:
+        while next_index < len(sentences) or pending:
+            while next_index < len(sentences) and len(pending) < TTS_STREAM_PARALLELISM:
+                pending.append(asyncio.ensure_future(synthesize(sentences[next_index], lang, voice)))
+                next_index += 1
+            path, _ = await pending.pop(0)
+            yield await asyncio.to_thread(_read_file, path)
+    finally:
+        for task in pending:
+            task.cancel()
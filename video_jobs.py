@@ -0,0 +1,184 @@
+import os
+import uuid
+import shutil
+import asyncio
+import logging
+from typing import Dict, Any, Optional
+
+import httpx
+
+import jobs
+import metrics
+
+# Бэкенд генерации видео: heygen или stub (локальная заглушка для тестов)
+VIDEO_BACKEND = os.getenv("VIDEO_BACKEND", "heygen")
+HEYGEN_API_URL = os.getenv("HEYGEN_API_URL", "https://api.heygen.com")
+# Каталог готовых видео
+VIDEO_DIR = os.getenv("VIDEO_DIR", os.path.join("cache", "video"))
+# Опрос статуса: начальная задержка, множитель, максимум и общий таймаут (секунды)
+VIDEO_POLL_INITIAL_DELAY = float(os.getenv("VIDEO_POLL_INITIAL_DELAY", "2"))
+VIDEO_POLL_BACKOFF = 1.5
+VIDEO_POLL_MAX_DELAY = float(os.getenv("VIDEO_POLL_MAX_DELAY", "15"))
+VIDEO_TIMEOUT = float(os.getenv("VIDEO_TIMEOUT", "600"))
+
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+
+class HeyGenClient:
+    """Клиент HeyGen API"""
+    name = "heygen"
+
+    def __init__(self, api_key: str, base_url: str = HEYGEN_API_URL):
+        self.base_url = base_url.rstrip("/")
+        self.headers = {
+            "accept": "application/json",
+            "content-type": "application/json",
+            "x-api-key": api_key
+        }
+
+    async def submit(self, text: str, avatar: Optional[str], voice: Optional[str]) -> str:
+        """Постановка генерации видео. Возвращает video_id"""
+        payload = {
+            "test": True,
+            "caption": False,
+            "aspect_ratio": "16:9",
+            "video_inputs": [
+                {
+                    "character": {
+                        "type": "avatar",
+                        "avatar_name": avatar or "Jessica-2k-20190523"  # Replace with your valid avatar name
+                    },
+                    "voice": {
+                        "type": "text",
+                        "input_text": text,
+                        "voice_name": voice or "Sara-neutral"  # Replace with valid voice name
+                    }
+                }
+            ]
+        }
+        async with httpx.AsyncClient(timeout=30) as client:
+            resp = await client.post(f"{self.base_url}/v1/video.generate", headers=self.headers, json=payload)
+            logging.info(f"Generation response status: {resp.status_code}")
+            resp.raise_for_status()
+            data = resp.json()
+        video_id = data.get("data", {}).get("video_id")
+        if not video_id:
+            raise ValueError("No video_id in response")
+        return video_id
+
+    async def status(self, video_id: str) -> Dict[str, Any]:
+        """Статус генерации: {status, video_url, error}"""
+        async with httpx.AsyncClient(timeout=30) as client:
+            resp = await client.get(f"{self.base_url}/v1/video_status/{video_id}", headers=self.headers)
+            resp.raise_for_status()
+            data = resp.json().get("data", {})
+        return {"status": data.get("status"), "video_url": data.get("video_url"), "error": data.get("error_msg")}
+
+    async def download(self, video_url: str, path: str):
+        """Потоковое скачивание видео на диск чанками"""
+        async with httpx.AsyncClient(timeout=None) as client:
+            async with client.stream("GET", video_url) as resp:
+                resp.raise_for_status()
+                with open(path, "wb") as f:
+                    async for chunk in resp.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+
+
+class StubVideoClient:
+    """Локальная заглушка HeyGen: видео «готово» после нескольких опросов"""
+    name = "stub"
+
+    def __init__(self, polls_until_ready: int = 2):
+        self.polls_until_ready = polls_until_ready
+        self.polls: Dict[str, int] = {}
+
+    async def submit(self, text: str, avatar: Optional[str], voice: Optional[str]) -> str:
+        video_id = uuid.uuid4().hex
+        self.polls[video_id] = 0
+        return video_id
+
+    async def status(self, video_id: str) -> Dict[str, Any]:
+        self.polls[video_id] = self.polls.get(video_id, 0) + 1
+        if self.polls[video_id] < self.polls_until_ready:
+            return {"status": "processing", "video_url": None, "error": None}
+        return {"status": "completed", "video_url": f"stub://{video_id}", "error": None}
+
+    async def download(self, video_url: str, path: str):
+        await asyncio.to_thread(shutil.copyfile, os.path.join("templates", "empty.mp4"), path)
+
+
+_client = None
+
+
+def get_client():
+    """Текущий клиент генерации видео"""
+    global _client
+    if _client is None:
+        if VIDEO_BACKEND == "stub":
+            _client = StubVideoClient()
+        else:
+            api_key = os.getenv("HEYGEN_API_KEY")
+            if not api_key:
+                raise ValueError("HeyGen API key not found")
+            _client = HeyGenClient(api_key)
+    return _client
+
+
+def set_client(client):
+    """Подмена клиента генерации видео (например, StubVideoClient в тестах)"""
+    global _client
+    _client = client
+
+
+def result_path(job_id: str) -> str:
+    """Путь к готовому видео задачи"""
+    return os.path.join(VIDEO_DIR, f"{job_id}.mp4")
+
+
+@jobs.handler("video.generate", queue="video", executor="async", max_attempts=2)
+async def generate_video_job(ctx: jobs.JobContext, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Фоновый опрос статуса с бэкоффом и скачивание результата
+
+    video_id сохраняется в состоянии задачи: после перезапуска опрос
+    продолжается без повторной постановки в HeyGen.
+    """
+    client = get_client()
+    video_id = ctx.state.get("video_id")
+    if not video_id:
+        with metrics.track_upstream("video", client.name, "submit"):
+            video_id = await client.submit(payload["text"], payload.get("avatar"), payload.get("voice"))
+        ctx.checkpoint(video_id=video_id)
+    ctx.report(0.1, "processing")
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + VIDEO_TIMEOUT
+    delay = VIDEO_POLL_INITIAL_DELAY
+    while True:
+        with metrics.track_upstream("video", client.name, "status"):
+            status = await client.status(video_id)
+        if status["status"] == "completed":
+            video_url = status["video_url"]
+            break
+        if status["status"] in ("failed", "error"):
+            raise ValueError(f"Video generation failed: {status.get('error') or 'Unknown error'}")
+        if loop.time() + delay > deadline:
+            raise ValueError("Video generation timed out")
+        ctx.report(0.1, "processing")
+        await asyncio.sleep(delay)
+        delay = min(delay * VIDEO_POLL_BACKOFF, VIDEO_POLL_MAX_DELAY)
+
+    ctx.report(0.8, "downloading")
+    os.makedirs(VIDEO_DIR, exist_ok=True)
+    path = result_path(ctx.job_id)
+    temp_path = f"{path}.part"
+    with metrics.track_upstream("video", client.name, "download"):
+        await client.download(video_url, temp_path)
+    os.replace(temp_path, path)
+    logging.info(f"Видео {ctx.job_id} готово")
+    return {"video_id": video_id, "size": os.path.getsize(path)}
+
+
+def submit(text: str, avatar: Optional[str] = None, voice: Optional[str] = None, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+    """Создание задачи генерации видео. Возвращается сразу, работа идет в очереди задач"""
+    get_client()  # Ошибка конфигурации должна вернуться сразу, а не в фоне
+    return jobs.enqueue("video.generate", {"text": text, "avatar": avatar, "voice": voice}, idempotency_key)
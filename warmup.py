@@ -0,0 +1,79 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Прогрев тяжелых подсистем в фоне после старта (0 - загрузка при первом обращении)
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "1") == "1"
+
+_steps: List[Tuple[str, Callable[[], Any]]] = []
+_state: Dict[str, Dict[str, Any]] = {}
+_task: Optional[asyncio.Task] = None
+
+
+def register(name: str, func: Callable[[], Any]):
+    """Шаг прогрева: синхронная функция, выполняется в потоке в порядке регистрации"""
+    _steps.append((name, func))
+    _state[name] = {"status": "pending", "seconds": None, "error": None}
+
+
+async def _run():
+    for name, func in _steps:
+        if _state[name]["status"] == "ready":
+            # Уже загружено до fork в мастер-процессе serve.py
+            continue
+        _state[name]["status"] = "running"
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(func)
+            _state[name]["status"] = "ready"
+        except Exception as e:
+            # Подсистема загрузится при первом обращении (или отработает свой фолбэк)
+            logging.error(f"Прогрев {name} не удался: {e}")
+            _state[name].update(status="failed", error=str(e))
+        _state[name]["seconds"] = round(time.perf_counter() - started, 3)
+    timings = ", ".join(f"{name} {state['seconds']}s" for name, state in _state.items())
+    logging.info(f"Прогрев завершен: {timings}")
+
+
+def preload():
+    """Синхронный прогрев в текущем потоке (мастер serve.py до fork: воркеры наследуют готовые структуры)"""
+    for name, func in _steps:
+        started = time.perf_counter()
+        try:
+            func()
+            _state[name]["status"] = "ready"
+        except Exception as e:
+            logging.error(f"Предзагрузка {name} не удалась: {e}")
+            _state[name].update(status="failed", error=str(e))
+        _state[name]["seconds"] = round(time.perf_counter() - started, 3)
+    timings = ", ".join(f"{name} {state['seconds']}s" for name, state in _state.items())
+    logging.info(f"Предзагрузка завершена: {timings}")
+
+
+def start():
+    """Запуск прогрева в фоне; сервер принимает запросы сразу"""
+    global _task
+    if _task is not None:
+        return
+    if not WARMUP_ENABLED:
+        for state in _state.values():
+            state["status"] = "skipped"
+        return
+    _task = asyncio.create_task(_run())
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+
+
+def status() -> Dict[str, Any]:
+    """Готовность: прогрев завершен (неудачные шаги не блокируют, но видны в ответе)"""
+    ready = _task is not None or not WARMUP_ENABLED
+    ready = ready and all(state["status"] not in ("pending", "running") for state in _state.values())
+    return {"ready": ready, "components": {name: dict(state) for name, state in _state.items()}}
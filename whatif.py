@@ -0,0 +1,294 @@
+import os
+import re
+import json
+import asyncio
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+import coordination
+import database
+import embeddings
+import embedding_service
+import llm
+import metrics
+
+# Библиотека сценариев: диаграмма, пояснение, теги и ключевые слова
+SCENARIOS_PATH = os.getenv("WHATIF_SCENARIOS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "whatif_scenarios.json"))
+# Минимальная оценка, при которой сценарий из библиотеки считается подходящим (с моделью эмбеддингов).
+# Выше веса ключевых слов: одного совпадения слова ("договор") без смысловой близости мало
+WHATIF_MATCH_THRESHOLD = float(os.getenv("WHATIF_MATCH_THRESHOLD", "0.5"))
+# Вес совпадения ключевых слов в оценке (остальное - косинусная близость эмбеддингов)
+WHATIF_KEYWORD_WEIGHT = 0.3
+# Сколько похожих сценариев возвращать в ответе
+WHATIF_TOP_K = 3
+
+MERMAID_HEADER_RE = re.compile(r"^(?:flowchart|graph)\s+(?:TD|TB|LR|RL|BT)$")
+MERMAID_EDGE_RE = re.compile(r"-->|---|-\.->|==>")
+MERMAID_NODE_RE = re.compile(r"^[\w-]+\s*[\[\(\{>]")
+MERMAID_KEYWORDS = ("subgraph", "end", "classDef", "class ", "style ", "linkStyle", "%%")
+# Интерактивные конструкции Mermaid в диаграммах от модели не допускаются
+MERMAID_FORBIDDEN = ("click ", "javascript:", "<script", "%%{")
+BRACKETS = {"]": "[", ")": "(", "}": "{"}
+
+GENERATE_PROMPT = (
+    "Ты юрист-аналитик. Построй Mermaid flowchart для What-if сценария по вопросу пользователя "
+    "с учетом фрагмента документа. Верни JSON-объект с полями diagram (код Mermaid, начинается с "
+    "'flowchart TD', подписи узлов в квадратных скобках или фигурных для решений, не более 12 узлов), "
+    "explanation (2-3 предложения) и tags (3-5 коротких тегов)."
+)
+# Сколько символов контекста документа передавать модели
+GENERATE_CONTEXT_CHARS = 4000
+
+
+def match_threshold() -> float:
+    """Порог совпадения для текущих эмбеддингов
+
+    Близость локальных эмбеддингов (заглушка, нет sentence-transformers)
+    почти не несет смысла: там, как и в прежней таблице ключевых слов,
+    достаточно совпадения ключевого слова.
+    """
+    if embeddings.get_model() is None:
+        return min(WHATIF_MATCH_THRESHOLD, WHATIF_KEYWORD_WEIGHT)
+    return WHATIF_MATCH_THRESHOLD
+
+
+def normalize_question(question: str) -> str:
+    """Нормализация вопроса для ключа кэша: регистр, пунктуация, пробелы"""
+    return " ".join(re.findall(r"\w+", question.lower()))
+
+
+def cache_key(question: str, context: str) -> str:
+    """Ключ сгенерированного сценария: нормализованный вопрос + хеш контекста"""
+    context_hash = hashlib.sha256(context.encode("utf-8")).hexdigest()
+    return hashlib.sha256(f"{normalize_question(question)}\0{context_hash}".encode("utf-8")).hexdigest()
+
+
+def validate_mermaid(diagram: str) -> Optional[str]:
+    """Проверка Mermaid flowchart. Возвращает описание ошибки или None"""
+    lines = [line.strip() for line in diagram.strip().splitlines() if line.strip()]
+    if not lines:
+        return "Пустая диаграмма"
+    if not MERMAID_HEADER_RE.match(lines[0]):
+        return f"Неверный заголовок диаграммы: {lines[0][:40]}"
+    lowered = diagram.lower()
+    for token in MERMAID_FORBIDDEN:
+        if token in lowered:
+            return f"Недопустимая конструкция: {token.strip()}"
+
+    edges = 0
+    for number, line in enumerate(lines[1:], start=2):
+        if line.startswith(MERMAID_KEYWORDS):
+            continue
+        if line.count('"') % 2:
+            return f"Строка {number}: незакрытая кавычка"
+        # Скобки проверяются вне кавычек
+        stack = []
+        for char in re.sub(r'"[^"]*"', "", line):
+            if char in "[({":
+                stack.append(char)
+            elif char in BRACKETS:
+                if not stack or stack.pop() != BRACKETS[char]:
+                    return f"Строка {number}: несбалансированные скобки"
+        if stack:
+            return f"Строка {number}: несбалансированные скобки"
+        if MERMAID_EDGE_RE.search(line):
+            edges += 1
+        elif not MERMAID_NODE_RE.match(line):
+            return f"Строка {number}: не узел и не связь"
+    if not edges:
+        return "В диаграмме нет связей"
+    return None
+
+
+class ScenarioLibrary:
+    """Сценарии с матрицей эмбеддингов: поиск - одно умножение матрицы на вектор"""
+
+    def __init__(self, scenarios: List[Dict[str, Any]]):
+        self.scenarios = scenarios
+        self.vectors = None
+        if scenarios:
+            # Матрица общая для воркеров (mmap): кодирует ее только первый из них
+            texts = [self._text(scenario) for scenario in scenarios]
+            key = "\0".join([embeddings.backend_id()] + texts)
+            self.vectors = coordination.shared_array("whatif", key, lambda: embeddings.encode(texts))
+
+    @staticmethod
+    def _text(scenario: Dict[str, Any]) -> str:
+        return " ".join([scenario.get("title", ""), " ".join(scenario.get("tags", [])), scenario.get("explanation", "")])
+
+    @classmethod
+    def encode(cls, scenario: Dict[str, Any]) -> np.ndarray:
+        """Вектор сценария (строка матрицы библиотеки)"""
+        return embeddings.encode([cls._text(scenario)])
+
+    def add(self, scenario: Dict[str, Any], vector: Optional[np.ndarray] = None):
+        if any(existing["id"] == scenario["id"] for existing in self.scenarios):
+            return
+        if vector is None:
+            vector = self.encode(scenario)
+        # Новые объекты вместо изменения на месте: параллельный поиск видит согласованный срез
+        self.scenarios = self.scenarios + [scenario]
+        self.vectors = vector if self.vectors is None else np.vstack([self.vectors, vector])
+
+    def search(self, question: str, top_k: int = WHATIF_TOP_K) -> List[Dict[str, Any]]:
+        """Лучшие сценарии по близости эмбеддингов и совпадению ключевых слов"""
+        vectors = self.vectors
+        if vectors is None:
+            return []
+        scenarios = self.scenarios[:len(vectors)]
+        query = embedding_service.encode_query(question)
+        scores = (1 - WHATIF_KEYWORD_WEIGHT) * np.clip(vectors @ query, 0, 1)
+        question_lower = question.lower()
+        for index, scenario in enumerate(scenarios):
+            keywords = scenario.get("keywords") or scenario.get("tags", [])
+            if any(keyword.lower() in question_lower for keyword in keywords):
+                scores[index] += WHATIF_KEYWORD_WEIGHT
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        return [{"scenario": scenarios[i], "score": float(scores[i])} for i in order]
+
+
+_library: Optional[ScenarioLibrary] = None
+_library_lock = threading.Lock()
+# Сгенерированный в одном воркере сценарий попадает в библиотеки остальных
+_library_channel = coordination.Channel("whatif")
+_inflight: Dict[str, asyncio.Future] = {}
+
+
+def load_scenarios() -> List[Dict[str, Any]]:
+    """Сценарии из файла библиотеки и ранее сгенерированные из базы"""
+    with open(SCENARIOS_PATH, "r", encoding="utf-8") as f:
+        scenarios = [{**scenario, "source": "library"} for scenario in json.load(f)]
+    generated = database.get_whatif_scenarios()
+    if generated["success"]:
+        for scenario in generated["scenarios"]:
+            scenarios.append(_generated_entry(scenario))
+    return scenarios
+
+
+def _generated_entry(scenario: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": f"generated-{scenario['cache_key'][:12]}",
+        "title": scenario["question"],
+        "tags": scenario["tags"],
+        "keywords": scenario["tags"],
+        "diagram": scenario["diagram"],
+        "explanation": scenario["explanation"],
+        "source": "generated",
+    }
+
+
+def get_library() -> ScenarioLibrary:
+    """Библиотека сценариев; загружается при первом обращении и после изменений в других воркерах"""
+    global _library
+    with _library_lock:
+        if _library is None or _library_channel.stale():
+            seen = _library_channel.current()
+            _library = ScenarioLibrary(load_scenarios())
+            _library_channel.mark(seen)
+            logging.info(f"Библиотека What-if сценариев загружена: {len(_library.scenarios)}")
+        return _library
+
+
+def generic_scenario(question: str) -> Dict[str, Any]:
+    """Общий шаблон, если в библиотеке ничего не подошло и LLM недоступна"""
+    scenario = question[:40] + '...' if len(question) > 40 else question
+    scenario = scenario.replace('"', "'")
+
+    # Определяем тип сценария
+    scenario_type = "Юридический сценарий"
+    for word in ["бизнес", "компания", "продажи", "маркетинг"]:
+        if word in question.lower():
+            scenario_type = "Бизнес-сценарий"
+            break
+
+    diagram = f"""flowchart TD
+    A["{scenario_type}: {scenario}"] --> B{{Оценка рисков}}
+    B -->|Высокий| C[Детальный анализ]
+    B -->|Средний| D[Мониторинг]
+    B -->|Низкий| E[Стандартная процедура]
+    C --> F[Юридическая консультация]
+    C --> G[План снижения рисков]
+    D --> H[Контрольные точки]
+    F --> I[Принятие решения]
+    G --> I
+    H --> I
+    E --> I"""
+    explanation = f"Диаграмма показывает процесс анализа и принятия решений для сценария: '{question}'. После оценки рисков применяются различные стратегии в зависимости от их уровня, с последующим контролем и принятием окончательного решения."
+    return {"diagram": diagram, "explanation": explanation}
+
+
+async def _generate(key: str, question: str, context: str) -> Optional[Dict[str, Any]]:
+    """Генерация сценария через LLM; валидный результат сохраняется в базе и в библиотеке"""
+    messages = [
+        {"role": "system", "content": GENERATE_PROMPT},
+        {"role": "user", "content": f"Вопрос: {question}\n\nФрагмент документа:\n{context[:GENERATE_CONTEXT_CHARS]}"},
+    ]
+    try:
+        content = await llm.chat_completion(messages, temperature=0.2, max_tokens=800, json_mode=True)
+        data = json.loads(content)
+        diagram = str(data.get("diagram") or "").strip()
+        explanation = str(data.get("explanation") or "").strip()
+        tags = [str(tag).strip().lower() for tag in data.get("tags") or [] if str(tag).strip()]
+    except Exception as e:
+        logging.warning(f"Генерация What-if сценария не удалась: {e}")
+        return None
+
+    error = validate_mermaid(diagram)
+    if error:
+        logging.warning(f"Сгенерированная диаграмма отклонена: {error}")
+        return None
+
+    scenario = {"cache_key": key, "question": question, "diagram": diagram, "explanation": explanation, "tags": tags}
+    await asyncio.to_thread(database.save_whatif_scenario, key, question, diagram, explanation, tags)
+    # Кодирование и ожидание блокировки библиотеки (ее может перестраивать другой поток) - вне цикла событий
+    entry = _generated_entry(scenario)
+    vector = await asyncio.to_thread(ScenarioLibrary.encode, entry)
+    await asyncio.to_thread(_publish, entry, vector)
+    return scenario
+
+
+def _publish(entry: Dict[str, Any], vector: np.ndarray):
+    """Добавление сгенерированного сценария в библиотеку этого воркера и оповещение остальных"""
+    library = get_library()
+    with _library_lock:
+        # Под блокировкой только замена массивов; перестроенная из базы библиотека уже содержит сценарий
+        library.add(entry, vector)
+        _library_channel.published()
+
+
+async def resolve(question: str, context: str) -> Dict[str, Any]:
+    """What-if сценарий: кэш сгенерированных, затем библиотека, затем генерация через LLM
+
+    Повтор вопроса с тем же контекстом LLM не вызывает.
+    """
+    key = cache_key(question, context)
+    cached = await asyncio.to_thread(database.get_whatif_scenario, key)
+    metrics.cache_lookup("whatif", cached["success"])
+    if cached["success"]:
+        scenario = cached["scenario"]
+        return {"diagram": scenario["diagram"], "explanation": scenario["explanation"], "source": "cache", "matches": []}
+
+    library = await asyncio.to_thread(get_library)
+    matches = await asyncio.to_thread(library.search, question)
+    summary = [{"id": match["scenario"]["id"], "title": match["scenario"]["title"], "score": round(match["score"], 3)} for match in matches]
+    if matches and matches[0]["score"] >= match_threshold():
+        best = matches[0]["scenario"]
+        return {"diagram": best["diagram"], "explanation": best["explanation"], "source": best["source"], "scenario_id": best["id"], "matches": summary}
+
+    if llm.is_available():
+        # Одинаковые одновременные запросы ждут одну генерацию
+        future = _inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(_generate(key, question, context))
+            _inflight[key] = future
+            future.add_done_callback(lambda _: _inflight.pop(key, None))
+        generated = await asyncio.shield(future)
+        if generated:
+            return {"diagram": generated["diagram"], "explanation": generated["explanation"], "source": "generated", "matches": summary}
+
+    metrics.fallback("whatif")
+    return {**generic_scenario(question), "source": "template", "matches": summary}